@@ -0,0 +1,82 @@
+"""
+Проверка: массовые отчёты за всё время формируются без отклонённых запросов к API Яндекс Метрики.
+
+Отчёт за всё время по каждому URL запрашивается частями периода, поэтому один массовый отчёт ожидает разрешения
+quota_governor сразу на сотни запросов. Воркер одновременно формирует --jobs таких отчётов по --urls URL
+нескольких счётчиков (запросы к заглушке API, отвечающей за --latency секунд). Проверка завершается с ошибкой,
+если хотя бы один URL получен с ошибкой или отчёт вернул не все URL.
+БД и внешние сервисы не нужны (см. offline.py).
+
+Запуск из корня проекта: PYTHONPATH=. python benchmarks/check_bulk_all_time.py [--urls 100] [--jobs 2]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+
+from benchmarks.offline import start_stub_services, use_in_memory_storage
+
+DOMAINS = 5
+
+
+async def run(args: argparse.Namespace) -> list[str]:
+    """
+    :return: список нарушений (пустой - проверка пройдена)
+    """
+    services = start_stub_services(['--latency', str(args.latency), '--fixed-latency',
+                                    '--error-rate', '0', '--throttle-rate', '0'])
+    from aiohttp import ClientSession
+    from utils.fair_scheduler import current_client
+    from utils.ym_api import YMRequest
+
+    domains = [f'bulk{i}.check.example' for i in range(DOMAINS)]
+    use_in_memory_storage({domain: 1000 + i for i, domain in enumerate(domains)})
+    ym = YMRequest()
+
+    async def bulk_report(user: int) -> dict:
+        # отдельный пользователь, как у отчётов, формируемых воркером одновременно
+        current_client.set((user, 'bulk'))
+        urls = {f'https://{domains[i % DOMAINS]}/user{user}/page{i}': f'{domains[i % DOMAINS]}/user{user}/page{i}'
+                for i in range(args.urls)}
+        rows = {}
+        async for part in ym.iter_statistics_batch(session, urls, None, None):
+            rows.update(part)
+        return rows
+
+    started = time.perf_counter()
+    try:
+        async with ClientSession() as session:
+            reports = await asyncio.gather(*(bulk_report(user) for user in range(args.jobs)))
+    finally:
+        services.stop()
+    elapsed = time.perf_counter() - started
+
+    from utils.quota_governor import quota_governor
+    print(f'отчётов за всё время: {len(reports)} по {args.urls} URL за {elapsed:.1f}с '
+          f'(запросов к API: {services.calls["metrika"]}); квота API: {quota_governor.stats()}')
+    errors = []
+    for user, rows in enumerate(reports):
+        if len(rows) != args.urls:
+            errors.append(f'отчёт {user}: получено {len(rows)} URL из {args.urls}')
+        failed = Counter(row.error for row in rows.values() if row.error)
+        for error, count in failed.items():
+            errors.append(f'отчёт {user}: {count} URL с ошибкой "{error}"')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--urls', type=int, default=100, help='URL в массовом отчёте')
+    parser.add_argument('--jobs', type=int, default=2, help='одновременно формируемых отчётов (WORKER_CONCURRENCY)')
+    parser.add_argument('--latency', type=float, default=0.01, help='время ответа API Метрики (сек)')
+    args = parser.parse_args()
+
+    errors = asyncio.run(run(args))
+    for error in errors:
+        print(f'ОШИБКА: {error}')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Проверка: пока выполняется запрос итоговых данных к медленному API Яндекс Метрики, цикл событий не блокируется.
+
+Несколько запросов итогов (get_sum_statistics) выполняются к заглушке API, отвечающей ровно за --latency секунд.
+Одновременно в том же цикле событий работает сопрограмма, просыпающаяся каждые 10 мс (как другие обработчики бота).
+Проверка завершается с ошибкой, если сопрограмма не просыпалась дольше --max-lag секунд, просыпалась реже,
+чем в половине интервалов, или запросы итогов завершились быстрее ответа API (т.е. не были в процессе выполнения).
+БД и внешние сервисы не нужны (см. offline.py).
+
+Запуск из корня проекта: PYTHONPATH=. python benchmarks/check_event_loop.py [--latency 1] [--totals 3]
+"""
+import argparse
+import asyncio
+import datetime
+import sys
+import time
+
+from benchmarks.load_test import measure_lag
+from benchmarks.offline import start_stub_services, use_in_memory_storage
+
+# интервал пробуждения сопрограммы (сек)
+HEARTBEAT_INTERVAL = 0.01
+DOMAIN = 'check.example'
+
+
+async def run(args: argparse.Namespace) -> list[str]:
+    """
+    :return: список нарушений (пустой - проверка пройдена)
+    """
+    services = start_stub_services(['--latency', str(args.latency), '--fixed-latency',
+                                    '--error-rate', '0', '--throttle-rate', '0'])
+    from aiohttp import ClientSession
+    from utils.ym_api import YMRequest
+
+    use_in_memory_storage({DOMAIN: 1})
+    ym = YMRequest()
+    date2 = datetime.date.today() - datetime.timedelta(days=1)
+    date1 = date2 - datetime.timedelta(days=29)
+    # разные URL, чтобы одновременные запросы итогов не объединялись в один запрос к API
+    reports = [{f'https://{DOMAIN}/report{i}/page{j}': f'{DOMAIN}/report{i}/page{j}' for j in range(3)}
+               for i in range(args.totals)]
+
+    stop = asyncio.Event()
+    heartbeat = asyncio.create_task(measure_lag(stop, HEARTBEAT_INTERVAL))
+    started = time.perf_counter()
+    try:
+        async with ClientSession() as session:
+            totals = await asyncio.gather(*(
+                ym.get_sum_statistics(session, urls.keys(), urls.values(), str(date1), str(date2))
+                for urls in reports))
+    finally:
+        elapsed = time.perf_counter() - started
+        stop.set()
+        lags = await heartbeat
+        services.stop()
+
+    max_lag = max(lags, default=elapsed)
+    print(f'запросов итогов: {len(totals)} за {elapsed:.2f}с (запросов к API: {services.calls["metrika"]}); '
+          f'пробуждений: {len(lags)}, максимальная задержка: {max_lag * 1000:.1f}мс')
+    errors = []
+    if elapsed < args.latency:
+        errors.append(f'запросы итогов выполнены за {elapsed:.2f}с - быстрее ответа API ({args.latency}с)')
+    if any(not total.visits for total in totals):
+        errors.append('получены пустые итоговые данные')
+    if max_lag > args.max_lag:
+        errors.append(f'цикл событий был заблокирован на {max_lag * 1000:.0f}мс '
+                      f'(допустимо {args.max_lag * 1000:.0f}мс)')
+    if len(lags) < elapsed / HEARTBEAT_INTERVAL / 2:
+        errors.append(f'сопрограмма проснулась {len(lags)} раз за {elapsed:.2f}с')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=1, help='время ответа API Метрики (сек)')
+    parser.add_argument('--totals', type=int, default=3, help='одновременных запросов итогов')
+    parser.add_argument('--max-lag', type=float, default=0.1, help='допустимая задержка пробуждения (сек)')
+    args = parser.parse_args()
+
+    errors = asyncio.run(run(args))
+    for error in errors:
+        print(f'ОШИБКА: {error}')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Проверка: строки отчёта следуют в порядке URL запроса после хранения URL в JSONB.
+
+JSONB не сохраняет порядок ключей объекта (ключи упорядочиваются по длине, затем побайтно), поэтому URL
+в состоянии диалога, задаче очереди и подписке хранятся списком пар (urls_to_json). Проверка проводит URL
+по цепочке подписка -> задача очереди -> параметры отчёта воркера: запросы к БД не выполняются, сохраняемые
+значения перехватываются и преобразуются так же, как их сохранил бы PostgreSQL. Проверка завершается с ошибкой,
+если порядок URL на каком-либо этапе изменился.
+
+Запуск из корня проекта: PYTHONPATH=. python benchmarks/check_url_order.py
+"""
+import asyncio
+import datetime
+import sys
+
+from benchmarks.offline import configure_offline_database
+
+# порядок ввода отличается от порядка ключей JSONB
+URLS = ['https://example.com/very/long/landing/page', 'https://example.com/b', 'https://www.example.com/a?utm=1',
+        'http://example.com/promo', 'https://example.com/aa']
+
+
+def jsonb(value):
+    """
+    Значение в том виде, в котором его вернёт PostgreSQL после сохранения в столбец JSONB
+    """
+    if isinstance(value, dict):
+        return {key: jsonb(value[key]) for key in sorted(value, key=lambda key: (len(key.encode()), key.encode()))}
+    if isinstance(value, (list, tuple)):
+        return [jsonb(item) for item in value]
+    return value
+
+
+class CapturingSession:
+    """
+    Сессия БД, которая запоминает параметры выполненных запросов и не обращается к БД
+    """
+
+    def __init__(self, params: list):
+        self.params = params
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def execute(self, statement):
+        from sqlalchemy.dialects import postgresql
+        self.params.append(statement.compile(dialect=postgresql.dialect()).params)
+        return self
+
+    def scalar_one(self):
+        return 1
+
+    async def commit(self):
+        pass
+
+
+async def run() -> list[str]:
+    """
+    :return: список нарушений (пустой - проверка пройдена)
+    """
+    configure_offline_database()
+    from database.models import ReportJob, ReportSubscription
+    from utils import job_queue as job_queue_module, subscriptions as subscriptions_module
+    from utils.job_queue import job_queue
+    from utils.report_cache import report_cache
+    from utils.subscriptions import subscriptions, subscription_job
+    from utils.url_processing import urls_processing, urls_to_json, urls_from_json
+
+    params = []
+    job_queue_module.async_session_maker = subscriptions_module.async_session_maker = lambda: CapturingSession(params)
+    urls = urls_processing(URLS)
+    errors = []
+
+    def check(stage: str, received: dict):
+        if list(received.items()) != list(urls.items()):
+            errors.append(f'{stage}: порядок URL изменился: {list(received)}')
+
+    if list(jsonb(urls)) == list(urls):
+        errors.append('порядок URL не меняется при сохранении словаря в JSONB - проверка не имеет смысла')
+
+    # состояние диалога
+    data = jsonb({'user_request': urls_to_json(urls), 'request_id': 1})
+    check('состояние диалога', urls_from_json(data['user_request']))
+
+    # подписка -> задача очереди -> параметры отчёта воркера
+    await subscriptions.add(1, 1, 1, 'user', urls, 30, datetime.time(9))
+    subscription = ReportSubscription(id=1, urls=jsonb(params.pop()['urls']), period_days=30, username='user',
+                                      telegram_id=1, chat_id=1)
+    job = subscription_job(subscription, datetime.date.today())
+    check('подписка', job['urls'])
+    await job_queue.enqueue(1, job)
+    payload = job_queue.payload(ReportJob(request_id=1, payload=jsonb(params.pop()['payload'])))
+    check('задача очереди', payload['urls'])
+    if report_cache.key(payload) != report_cache.key(job):
+        errors.append('хэш параметров отчёта изменился после хранения задачи в очереди')
+    return errors
+
+
+def main():
+    errors = asyncio.run(run())
+    print(f'URL: {len(URLS)}, нарушений: {len(errors)}')
+    for error in errors:
+        print(f'ОШИБКА: {error}')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Бенчмарк распределения запросов к API между отчётами пользователей.
+
+Моделирует воркер с ограниченным количеством одновременных запросов к API: несколько пользователей формируют
+массовые отчёты (по stream_workers одновременных запросов), а другие пользователи периодически отправляют
+отчёты по одному URL. Сравнивает время ожидания небольших отчётов при очереди в порядке поступления
+(asyncio.Semaphore, как раньше в QuotaGovernor) и при FairScheduler.
+
+Запуск из корня проекта: python benchmarks/fair_scheduling.py [--bulk-users N] [--capacity N]
+"""
+import argparse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from utils.fair_scheduler import FairScheduler, current_client
+
+
+class FifoScheduler:
+    """
+    Очередь в порядке поступления запросов
+    """
+
+    def __init__(self, capacity: int):
+        self._semaphore = asyncio.Semaphore(capacity)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            yield
+
+
+def percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def api_call(scheduler, duration: float):
+    async with scheduler.slot():
+        await asyncio.sleep(duration)
+
+
+async def bulk_report(scheduler, user: int, chunks: int, stream_workers: int, duration: float):
+    current_client.set((user, 'bulk'))
+    pending = iter(range(chunks))
+
+    async def stream():
+        for _ in pending:
+            await api_call(scheduler, duration)
+
+    await asyncio.gather(*(stream() for _ in range(stream_workers)))
+
+
+async def small_report(scheduler, user: int, duration: float) -> float:
+    current_client.set((user, 'interactive'))
+    started = time.perf_counter()
+    # отчёт по одному URL: статистика и итоги
+    await api_call(scheduler, duration)
+    await api_call(scheduler, duration)
+    return time.perf_counter() - started
+
+
+async def run(scheduler, args) -> tuple[list[float], float]:
+    started = time.perf_counter()
+    bulk = [asyncio.create_task(bulk_report(scheduler, user, args.chunks, args.stream_workers, args.duration))
+            for user in range(args.bulk_users)]
+    small = []
+    for i in range(args.small_reports):
+        await asyncio.sleep(args.small_interval)
+        small.append(asyncio.create_task(small_report(scheduler, 1000 + i, args.duration)))
+    latencies = await asyncio.gather(*small)
+    await asyncio.gather(*bulk)
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--capacity', type=int, default=3, help='одновременных запросов к API')
+    parser.add_argument('--bulk-users', type=int, default=2, help='пользователей с массовыми отчётами')
+    parser.add_argument('--chunks', type=int, default=100, help='запросов к API в массовом отчёте')
+    parser.add_argument('--stream-workers', type=int, default=5, help='одновременных запросов массового отчёта')
+    parser.add_argument('--small-reports', type=int, default=30, help='отчётов по одному URL')
+    parser.add_argument('--small-interval', type=float, default=0.1, help='интервал между отчётами по одному URL')
+    parser.add_argument('--duration', type=float, default=0.05, help='время запроса к API (сек)')
+    args = parser.parse_args()
+
+    for name, scheduler in (('в порядке поступления', FifoScheduler(args.capacity)),
+                            ('FairScheduler', FairScheduler(args.capacity))):
+        latencies, total = asyncio.run(run(scheduler, args))
+        print(f'{name:>22}: отчёт по одному URL p50={percentile(latencies, 50) * 1000:.0f}мс '
+              f'p95={percentile(latencies, 95) * 1000:.0f}мс max={max(latencies) * 1000:.0f}мс; '
+              f'все отчёты {total:.1f}с')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+"""
+Нагрузочный тест бота без внешних сервисов.
+
+Запускает локальные заглушки API Яндекс Метрики (stat/v1/data), S3-хранилища и Telegram Bot API,
+подаёт в диспетчер бота синтетические обновления telegram (сообщение или файл с URL, выбор периода, ввод дат)
+с заданной частотой и обрабатывает задачи воркерами в этом же процессе. Для запросов из 1, 20 и 1000 URL
+выводит время формирования отчёта (p50/p95), задержку цикла событий, пиковое потребление памяти
+и количество запросов к внешним сервисам на один отчёт.
+
+Нужна отдельная тестовая база PostgreSQL со структурой из database/models.py (параметры подключения - DB_*).
+Тест добавляет в неё счётчики доменов benchN.example и пользователей с telegram_id от 10^12
+и перед запуском удаляет кэш статистики по этим счётчикам.
+
+Запуск из корня проекта:
+PYTHONPATH=. python benchmarks/load_test.py [--sizes 1,20,1000] [--reports 5] [--rate 1] [--latency 0.2]
+    [--error-rate 0.01] [--throttle-rate 0.01] [--full-accuracy-days 92] [--days 30]
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import itertools
+import os
+import random
+import resource
+import statistics as stats
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# максимальное время формирования одного отчёта (сек)
+REPORT_TIMEOUT = 900
+# тексты сообщений бота, означающих, что отчёт не будет сформирован
+ERROR_MARKERS = ('ошибка', 'Не удалось', 'нет доступа')
+BENCH_USER_ID = 10 ** 12
+BENCH_COUNTER = 900000000
+BENCH_DOMAINS = 10
+
+S3_LOCATION = '<?xml version="1.0" encoding="UTF-8"?>' \
+              '<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">us-east-1</LocationConstraint>'
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота с заглушками внешних сервисов')
+    parser.add_argument('--sizes', default='1,20,1000', help='количество URL в запросе (через запятую)')
+    parser.add_argument('--reports', type=int, default=5, help='количество отчётов каждого размера')
+    parser.add_argument('--rate', type=float, default=1, help='частота поступления запросов (запросов в секунду)')
+    parser.add_argument('--days', type=int, default=30, help='длительность периода отчёта (дней, по вчерашний день)')
+    parser.add_argument('--latency', type=float, default=0.2, help='среднее время ответа API Метрики (сек)')
+    parser.add_argument('--fixed-latency', action='store_true',
+                        help='API Метрики отвечает ровно за --latency (по умолчанию - случайное время со средним --latency)')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='доля ответов 400 API Метрики')
+    parser.add_argument('--throttle-rate', type=float, default=0.01, help='доля ответов 429 API Метрики')
+    parser.add_argument('--full-accuracy-days', type=int, default=92,
+                        help='API Метрики отвечает 400 на запросы с accuracy=full за период длиннее этого')
+    parser.add_argument('--seed', type=int, default=1, help='начальное значение генератора случайных чисел')
+    return parser.parse_args(argv)
+
+
+class StubServices:
+    """
+    Заглушки API Яндекс Метрики, S3-хранилища и Telegram Bot API на локальных портах.
+    Работают в отдельном потоке со своим циклом событий, чтобы не влиять на измеряемую задержку цикла событий бота
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.loop = asyncio.new_event_loop()
+        self.urls = {}
+        # количество запросов к заглушкам: 'metrika', 'metrika_400', 's3_put', 'telegram.sendDocument', ...
+        self.calls = Counter()
+        # файлы, которые бот скачивает из telegram: file_id -> содержимое
+        self.files = {}
+        # загруженные в S3 объекты
+        self.objects = set()
+        # chat_id -> future, завершающийся при отправке пользователю отчёта или сообщения об ошибке
+        self.waiters = {}
+        self.main_loop = None
+        self._message_ids = itertools.count(1)
+        self._runners = []
+
+    def start(self, main_loop: asyncio.AbstractEventLoop):
+        self.main_loop = main_loop
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._serve())
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True, name='stub-services').start()
+        ready.wait()
+
+    async def _serve(self):
+        metrika = web.Application()
+        metrika.router.add_get('/stat/v1/data', self._metrika)
+        s3 = web.Application(client_max_size=1024 ** 3)
+        s3.router.add_route('*', '/{path:.*}', self._s3)
+        telegram = web.Application(client_max_size=1024 ** 3)
+        telegram.router.add_post('/bot{token}/{method}', self._telegram)
+        telegram.router.add_get('/file/bot{token}/{file_id}', self._telegram_file)
+        for name, app in (('metrika', metrika), ('s3', s3), ('telegram', telegram)):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', 0).start()
+            self._runners.append(runner)
+            self.urls[name] = 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+
+    def stop(self):
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _notify(self, chat_id: int, success: bool):
+        def resolve():
+            future = self.waiters.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result((success, time.perf_counter()))
+
+        self.main_loop.call_soon_threadsafe(resolve)
+
+    @staticmethod
+    def _metric_values(metrics: list[str], key: str) -> list:
+        # значения детерминированы для URL и дня, чтобы повторные запуски давали одинаковые отчёты
+        seed = int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+        visits = seed % 100 + 1
+        values = {'ym:s:visits': visits, 'ym:s:users': visits * 3 // 4 + 1, 'ym:s:pageviews': visits * 2,
+                  'ym:s:pageDepth': 2.0, 'ym:s:avgVisitDurationSeconds': float(seed % 300),
+                  'ym:s:bounceRate': float(seed % 50), 'ym:s:percentNewVisitors': float(seed % 80)}
+        return [values[metric] for metric in metrics]
+
+    async def _metrika(self, request: web.Request) -> web.Response:
+        """
+        Заглушка stat/v1/data: задержка ответа, случайные ответы 400 и 429, ответ 400 на запросы
+        с accuracy=full за длинный период, строки по дням (одна строка без группировки по дням)
+        """
+        self.calls['metrika'] += 1
+        query = request.query
+        if self.args.latency:
+            await asyncio.sleep(self.args.latency if self.args.fixed_latency
+                                else self.random.expovariate(1 / self.args.latency))
+        if self.random.random() < self.args.throttle_rate:
+            self.calls['metrika_429'] += 1
+            return web.json_response({'message': 'Quota exceeded'}, status=429, headers={'Retry-After': '1'})
+
+        date1 = datetime.date.fromisoformat(query['date1'])
+        date2 = datetime.date.fromisoformat(query['date2'])
+        too_long = query.get('accuracy') == 'full' and (date2 - date1).days + 1 > self.args.full_accuracy_days
+        if too_long or self.random.random() < self.args.error_rate:
+            self.calls['metrika_400'] += 1
+            return web.json_response({'message': 'Query is too complicated. Please reduce the date interval'},
+                                     status=400)
+
+        metrics = query['metrics'].split(',')
+        dimensions = query['dimensions'].split(',') if query.get('dimensions') else []
+        days = [date1 + datetime.timedelta(days=i) for i in range((date2 - date1).days + 1)] \
+            if 'ym:s:date' in dimensions else [None]
+        data = []
+        for day in days:
+            data.append({'dimensions': [{'name': str(day)}] if day is not None else [],
+                         'metrics': self._metric_values(metrics, f'{day}:{query.get("filters")}')})
+        return web.json_response({'data': data, 'sampled': query.get('accuracy') != 'full'})
+
+    async def _s3(self, request: web.Request) -> web.Response:
+        """
+        Заглушка S3: определение региона бакета, загрузка объекта (PUT) и проверка его наличия (HEAD)
+        """
+        if request.method == 'PUT':
+            self.calls['s3_put'] += 1
+            await request.read()
+            self.objects.add(request.path)
+            return web.Response(headers={'ETag': '"bench"'})
+        if request.method == 'HEAD':
+            self.calls['s3_head'] += 1
+            found = request.path in self.objects
+            return web.Response(status=200 if found else 404,
+                                headers={'ETag': '"bench"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        if 'location' in request.query:
+            return web.Response(text=S3_LOCATION, content_type='application/xml')
+        return web.Response()
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **fields}
+
+    async def _telegram(self, request: web.Request) -> web.Response:
+        """
+        Заглушка методов Telegram Bot API, которые использует бот
+        """
+        method = request.match_info['method']
+        self.calls[f'telegram.{method}'] += 1
+        data = await request.post()
+        chat_id = int(data['chat_id']) if 'chat_id' in data else None
+        if method == 'sendDocument':
+            # файл передаётся отдельной частью формы, поле document содержит ссылку attach://<имя части>
+            document = data[data['document'].removeprefix('attach://')]
+            document.file.read()
+            result = self._message(chat_id, document={'file_id': 'report', 'file_unique_id': 'report',
+                                                      'file_name': document.filename})
+            self._notify(chat_id, True)
+        elif method in ('sendMessage', 'editMessageText'):
+            text = data.get('text', '')
+            if method == 'sendMessage' and any(marker in text for marker in ERROR_MARKERS):
+                self._notify(chat_id, False)
+            result = self._message(chat_id, text=text)
+        elif method == 'getFile':
+            result = {'file_id': data['file_id'], 'file_unique_id': data['file_id'], 'file_path': data['file_id']}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _telegram_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.files[request.match_info['file_id']])
+
+
+def configure_environment(services: StubServices):
+    """
+    Направляет бота на заглушки. Вызывается до импорта модулей бота: настройки читаются при импорте
+    """
+    os.environ['YM_API_URL'] = f'{services.urls["metrika"]}/stat/v1/data'
+    os.environ['YM_TOKENS'] = 'bench-token'
+    os.environ['S3_ENDPOINT_URL'] = services.urls['s3'].removeprefix('http://')
+    os.environ['S3_ACCESS_KEY'] = 'bench'
+    os.environ['S3_SECRET_KEY'] = 'bench-secret'
+    os.environ['S3_BUCKET_NAME'] = 'bench'
+    os.environ['S3_SECURE'] = ''
+    os.environ['TG_TOKEN'] = '123456:bench'
+    os.environ['METRICS_PORT'] = '0'
+
+
+async def prepare_database(users: int):
+    """
+    Счётчики доменов benchN.example и пользователи бота; кэш статистики по счётчикам теста удаляется
+    """
+    from sqlalchemy import select, insert, delete
+
+    from database.db import async_session_maker
+    from database.models import DomainCounter, User, StatisticCache, DailyStatistic
+
+    counters = {f'bench{i}.example': BENCH_COUNTER + i for i in range(BENCH_DOMAINS)}
+    telegram_ids = [BENCH_USER_ID + i for i in range(users)]
+    async with async_session_maker() as session:
+        existing = set((await session.execute(
+            select(DomainCounter.domain_name).where(DomainCounter.domain_name.in_(counters)))).scalars())
+        new_counters = [{'domain_name': domain, 'counter': counter, 'created_at': datetime.datetime.now()}
+                        for domain, counter in counters.items() if domain not in existing]
+        if new_counters:
+            await session.execute(insert(DomainCounter), new_counters)
+
+        existing = set((await session.execute(
+            select(User.telegram_id).where(User.telegram_id.in_(telegram_ids)))).scalars())
+        new_users = [{'telegram_id': telegram_id, 'username': f'bench_{telegram_id}', 'active': True}
+                     for telegram_id in telegram_ids if telegram_id not in existing]
+        if new_users:
+            await session.execute(insert(User), new_users)
+
+        for model in (StatisticCache, DailyStatistic):
+            await session.execute(delete(model).where(model.counter.in_(counters.values())))
+        await session.commit()
+
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.01) -> list[float]:
+    """
+    Измеряет задержку пробуждения цикла событий относительно ожидаемого интервала
+    :return: список задержек (сек)
+    """
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+    return lags
+
+
+def current_rss() -> int:
+    """
+    Текущее потребление памяти процессом (байт)
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # без /proc (не Linux) - пиковое значение за всё время работы процесса
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def measure_rss(stop: asyncio.Event, interval: float = 0.1) -> int:
+    """
+    Пиковое потребление памяти процессом за время измерения (байт)
+    """
+    peak = current_rss()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        peak = max(peak, current_rss())
+    return peak
+
+
+class LoadTest:
+
+    def __init__(self, args: argparse.Namespace, services: StubServices, bot, dp):
+        self.args = args
+        self.services = services
+        self.bot = bot
+        self.dp = dp
+        self._update_ids = itertools.count(1)
+        self._users = itertools.count(BENCH_USER_ID)
+
+    async def feed(self, **update):
+        from aiogram.types import Update
+
+        update = Update.model_validate({'update_id': next(self._update_ids), **update}, context={'bot': self.bot})
+        await self.dp.feed_update(self.bot, update)
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {'message_id': next(self.services._message_ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f'bench_{user_id}'},
+                **fields}
+
+    async def run_report(self, size: int, number: int) -> tuple[bool, float]:
+        """
+        Сценарий пользователя: URL (сообщением или файлом), выбор периода, ввод дат; ожидание отчёта
+        :return: (отчёт получен, время от первого сообщения до получения отчёта)
+        """
+        user_id = next(self._users)
+        # уникальные URL, чтобы отчёты не использовали кэш статистики друг друга
+        urls = [f'https://bench{i % BENCH_DOMAINS}.example/size{size}/report{number}/page{i}' for i in range(size)]
+        date2 = datetime.date.today() - datetime.timedelta(days=1)
+        date1 = date2 - datetime.timedelta(days=self.args.days - 1)
+        future = asyncio.get_running_loop().create_future()
+        self.services.waiters[user_id] = future
+
+        started = time.perf_counter()
+        if size <= 20:
+            await self.feed(message=self._message(user_id, text='\n'.join(urls)))
+        else:
+            file_id = f'urls-{user_id}.csv'
+            self.services.files[file_id] = '\n'.join(urls).encode()
+            await self.feed(message=self._message(
+                user_id, document={'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'urls.csv'}))
+        await self.feed(callback_query={
+            'id': str(user_id), 'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat_instance': str(user_id), 'data': 'date_from-date_to',
+            'message': self._message(user_id, text='Задайте временной интервал сбора статистики:')})
+        await self.feed(message=self._message(user_id, text=f'{date1:%d.%m.%Y}-{date2:%d.%m.%Y}'))
+        try:
+            success, finished = await asyncio.wait_for(future, REPORT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.services.waiters.pop(user_id, None)
+            return False, REPORT_TIMEOUT
+        return success, finished - started
+
+    async def run_size(self, size: int):
+        calls_before = self.services.calls.copy()
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(measure_lag(stop))
+        rss_task = asyncio.create_task(measure_rss(stop))
+
+        tasks = []
+        for number in range(self.args.reports):
+            tasks.append(asyncio.create_task(self.run_report(size, number)))
+            await asyncio.sleep(1 / self.args.rate)
+        results = await asyncio.gather(*tasks)
+        stop.set()
+        lags_ms = sorted(lag * 1000 for lag in await lag_task)
+        peak_rss = await rss_task
+
+        latencies = sorted(latency for success, latency in results if success)
+        failed = len(results) - len(latencies)
+        calls = self.services.calls - calls_before
+        per_report = {name: round(count / len(results), 1) for name, count in sorted(calls.items())}
+        print(f'{size:>5} URL: отчётов={len(latencies)} ошибок={failed}', end=' ')
+        if latencies:
+            print(f'время отчёта: p50={stats.median(latencies):.2f}с p95={percentile(latencies, 0.95):.2f}с', end=' ')
+        print(f'задержка цикла: p95={percentile(lags_ms, 0.95):.1f}мс макс={max(lags_ms, default=0):.1f}мс '
+              f'пик памяти={peak_rss / 1024 ** 2:.0f}МБ')
+        print(f'{"":>10}запросов на отчёт: {per_report}')
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+async def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    services = StubServices(args)
+    services.start(asyncio.get_running_loop())
+    configure_environment(services)
+
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    from bot.main import dp
+    from bot.worker import worker_loop, on_startup, on_shutdown
+    from database.fsm_storage import PostgresStorage
+    from settings import WORKER_CONCURRENCY, tg_token
+
+    await prepare_database(len(sizes) * args.reports)
+    bot = Bot(token=tg_token, session=AiohttpSession(api=TelegramAPIServer.from_base(services.urls['telegram'])))
+    await on_startup()
+    await dp.emit_startup(bot=bot)
+    workers = [asyncio.create_task(worker_loop(bot, PostgresStorage(), f'bench:{i}'))
+               for i in range(WORKER_CONCURRENCY)]
+    print(f'Заглушки: {services.urls}; воркеров: {WORKER_CONCURRENCY}; период: {args.days} дн.; '
+          f'частота запросов: {args.rate}/с')
+    try:
+        test = LoadTest(args, services, bot, dp)
+        for size in sizes:
+            await test.run_size(size)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await on_shutdown()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        services.stop()
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(f'Пик памяти процессов формирования xlsx: {children_rss / 1024:.0f}МБ')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
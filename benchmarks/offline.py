@@ -0,0 +1,148 @@
+"""
+Хранилища в памяти вместо таблиц PostgreSQL для проверок YMRequest без тестовой базы.
+
+use_in_memory_storage() подменяет обращения к БД кэша счётчиков, кэша статистики, хранилища метрик по дням
+и ограничения квоты API (слоты токенов считаются в памяти процесса, ограничение частоты не применяется).
+Логика YMRequest, QuotaGovernor и FairScheduler при этом не меняется; API Метрики - заглушка StubServices
+из load_test.py. Модули бота импортируются после start_stub_services(): настройки читаются при импорте
+"""
+import asyncio
+import datetime
+import os
+
+from benchmarks.load_test import StubServices, configure_environment, parse_args
+
+
+def start_stub_services(argv: list[str]) -> StubServices:
+    """
+    Запускает заглушки внешних сервисов и направляет на них бота
+    :param argv: параметры заглушки API Метрики в формате load_test.py (--latency, --error-rate, ...)
+    :return: StubServices
+    """
+    services = StubServices(parse_args(argv))
+    services.start(asyncio.get_running_loop())
+    configure_environment(services)
+    configure_offline_database()
+    return services
+
+
+def configure_offline_database():
+    """
+    Параметры подключения к БД по умолчанию: подключение не выполняется, но строка подключения должна быть корректной
+    :return: None
+    """
+    for name, value in (('DB_USER', 'offline'), ('DB_PASSWORD', 'offline'), ('DB_HOST', '127.0.0.1'),
+                        ('DB_PORT', '5432'), ('DB_NAME', 'offline')):
+        os.environ.setdefault(name, value)
+
+
+class InMemoryQuota:
+    """
+    Слоты токенов QuotaGovernor в памяти процесса
+    """
+
+    def __init__(self, governor):
+        self.governor = governor
+        # (хэш токена, № слота) -> идентификатор запроса
+        self.holders = {}
+
+    async def ensure_rows(self):
+        if not self.governor.tokens:
+            raise RuntimeError('Не задан ни один токен API Яндекс Метрики (YM_TOKEN / YM_TOKENS)')
+
+    async def claim(self, key: str, holder: str) -> tuple[int, float] | None:
+        for slot in range(self.governor.max_parallel):
+            if (key, slot) not in self.holders:
+                self.holders[(key, slot)] = holder
+                return slot, 0
+        return None
+
+    async def release(self, key: str, slot: int, holder: str):
+        if self.holders.get((key, slot)) == holder:
+            del self.holders[(key, slot)]
+
+    async def throttle(self, token: str, retry_after: float = None):
+        self.governor.throttled += 1
+
+
+class InMemoryStatCache:
+    """
+    Кэш статистики по URL без таблицы statistic_cache
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        # (counter, url, date1, date2) -> (metrics, accuracy, expires_at)
+        self.rows = {}
+
+    async def get_many(self, counter: int, urls, date1: str, date2: str, min_accuracy: str = 'full',
+                       stale: bool = False) -> dict[str, list]:
+        result = {}
+        for url in urls:
+            row = self.rows.get((counter, url, date1, date2))
+            if row and (stale or self.cache._is_usable(row[1], row[2], min_accuracy)):
+                result[url] = row[0]
+        return result
+
+    async def set_many(self, counter: int, url_metrics: dict[str, list], date1: str, date2: str,
+                       accuracy: str):
+        expires_at = None
+        if datetime.date.fromisoformat(date2) >= datetime.date.today():
+            expires_at = datetime.datetime.now() + datetime.timedelta(seconds=self.cache.ttl)
+        for url, metrics in url_metrics.items():
+            self.rows[(counter, url, date1, date2)] = (metrics, accuracy, expires_at)
+
+
+class InMemoryDailyStore:
+    """
+    Метрики по дням без таблицы daily_statistic
+    """
+
+    def __init__(self):
+        # (counter, url) -> {день: метрики}
+        self.days = {}
+
+    async def get_days(self, counter: int, urls, date1: datetime.date,
+                       date2: datetime.date) -> dict[str, dict[datetime.date, list]]:
+        return {url: {day: metrics for day, metrics in self.days.get((counter, url), {}).items()
+                      if date1 <= day <= date2} for url in urls}
+
+    async def save_days(self, counter: int, url_days: dict[str, dict[datetime.date, list]]):
+        for url, days in url_days.items():
+            self.days.setdefault((counter, url), {}).update(days)
+
+
+def use_in_memory_storage(counters: dict[str, int]):
+    """
+    Подменяет обращения к БД модулей, через которые YMRequest получает статистику
+    :param counters: {домен: № счётчика}
+    :return: None
+    """
+    from utils.counter_cache import counter_cache
+    from utils.daily_store import daily_store
+    from utils.quota_governor import quota_governor
+    from utils.stat_cache import stat_cache
+
+    # счётчики без ограничения времени жизни: отсутствующие в counters домены считаются доменами без счётчика
+    counter_cache.ttl = counter_cache.negative_ttl = 10 ** 9
+    for domain, counter in counters.items():
+        counter_cache._put(domain, counter)
+
+    async def get_many(domains):
+        return {domain: counter_cache._lookup(domain)[1] for domain in domains}
+
+    counter_cache.get_many = get_many
+
+    memory_stat_cache = InMemoryStatCache(stat_cache)
+    stat_cache.get_many = memory_stat_cache.get_many
+    stat_cache.set_many = memory_stat_cache.set_many
+
+    memory_daily_store = InMemoryDailyStore()
+    daily_store.get_days = memory_daily_store.get_days
+    daily_store.save_days = memory_daily_store.save_days
+
+    quota = InMemoryQuota(quota_governor)
+    quota_governor._ensure_rows = quota.ensure_rows
+    quota_governor._claim = quota.claim
+    quota_governor._release = quota.release
+    quota_governor.throttle = quota.throttle
@@ -0,0 +1,71 @@
+"""
+Бенчмарк задержки цикла событий во время формирования xlsx-отчётов.
+
+Сравнивает синхронный вызов xlsx_writter в цикле событий (как раньше в request_processing)
+с xlsx_writter_async, который формирует отчёт в пуле процессов.
+
+Запуск из корня проекта: python benchmarks/report_loop_latency.py [кол-во отчётов] [кол-во строк]
+"""
+import asyncio
+import datetime
+import statistics as stats
+import sys
+import time
+from contextlib import ExitStack
+
+from utils.xlsx_file_formatter import xlsx_writter, xlsx_writter_async, temporary_report_file
+from utils.ym_api import statistic
+
+
+def make_rows(count: int) -> list[statistic]:
+    return [statistic(raw_url=f'https://example.com/page/{i}', visits=i, users=i, pageViews=i * 2, pageDepth=2.0,
+                      visitDuration=datetime.timedelta(seconds=i % 600), bounceRate=10.0, newUsers=50.0)
+            for i in range(count)]
+
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.01) -> list[float]:
+    """
+    Измеряет задержку пробуждения цикла событий относительно ожидаемого интервала
+    :return: список задержек (сек)
+    """
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+    return lags
+
+
+async def run(mode: str, reports: int, rows: list[statistic]):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        paths = [stack.enter_context(temporary_report_file()) for _ in range(reports)]
+        if mode == 'sync':
+            for path in paths:
+                xlsx_writter(rows, path, statistic(), 'header')
+                # даём циклу событий шанс обработать другие задачи между отчётами
+                await asyncio.sleep(0)
+        else:
+            await asyncio.gather(*(xlsx_writter_async(rows, path, statistic(), 'header') for path in paths))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lags = await lag_task
+    lags_ms = sorted(lag * 1000 for lag in lags)
+    p95 = lags_ms[int(len(lags_ms) * 0.95) - 1] if lags_ms else 0
+    print(f'{mode:>5}: отчётов={reports} время={elapsed:.2f}с задержка цикла: '
+          f'медиана={stats.median(lags_ms):.1f}мс p95={p95:.1f}мс макс={max(lags_ms):.1f}мс')
+
+
+async def main():
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rows = make_rows(row_count)
+    await run('sync', reports, rows)
+    await run('async', reports, rows)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""
+Бенчмарк пикового потребления памяти при формировании xlsx-отчёта.
+
+Строки отчёта генерируются итератором и записываются xlsx_writter в режиме constant_memory во временный файл,
+поэтому пиковое потребление памяти не должно расти с количеством строк.
+
+Запуск из корня проекта: python benchmarks/report_memory.py [кол-во строк через пробел]
+"""
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+from utils.xlsx_file_formatter import xlsx_writter, temporary_report_file
+from utils.ym_api import statistic
+
+
+def iter_rows(count: int):
+    for i in range(count):
+        yield statistic(raw_url=f'https://example.com/page/{i}', visits=i, users=i, pageViews=i * 2, pageDepth=2.0,
+                        visitDuration=datetime.timedelta(seconds=i % 600), bounceRate=10.0, newUsers=50.0)
+
+
+def main():
+    row_counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 100000]
+    for row_count in row_counts:
+        with temporary_report_file() as path:
+            tracemalloc.start()
+            start = time.perf_counter()
+            xlsx_writter(iter_rows(row_count), path, statistic(), 'header')
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size = os.path.getsize(path)
+        print(f'строк={row_count:>7} время={elapsed:.2f}с размер файла={size / 1024:.0f}КБ '
+              f'пик памяти={peak / 1024 / 1024:.1f}МБ')
+
+
+if __name__ == '__main__':
+    main()
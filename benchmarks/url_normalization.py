@@ -0,0 +1,62 @@
+"""
+Бенчмарк разбора URL массового отчёта.
+
+Сравнивает прежний разбор (urlparse и re.sub('www.', ...) в urls_processing и повторно при поиске счётчиков
+в YMRequest) с однократным разбором normalize_url и получением домена из очищенного URL.
+
+Запуск из корня проекта: python benchmarks/url_normalization.py [кол-во URL через пробел]
+"""
+import re
+import sys
+import time
+from urllib.parse import urlparse
+
+from utils.url_processing import urls_processing, url_domain
+
+
+def make_urls(count: int) -> list[str]:
+    return [f'https://www.site{i % 50}.ru/catalog/section{i % 100}/page{i}?utm_source=bot#top' for i in range(count)]
+
+
+def old_pipeline(raw_urls: list[str]) -> set:
+    # urls_processing
+    processed_urls = []
+    for raw_url in raw_urls:
+        parse_url = urlparse(raw_url)
+        process_url = re.sub('www.', '', parse_url.netloc) + parse_url.path
+        processed_urls.append(process_url)
+    raw_processed_urls = dict(zip(raw_urls, processed_urls))
+    # YMRequest._get_url_counters и YMRequest._get_counters
+    url_netlocs = {raw_url: re.sub('www.', '', urlparse(raw_url).netloc) for raw_url in raw_processed_urls}
+    return set(url_netlocs.values()) | {re.sub('www.', '', urlparse(url).netloc) for url in raw_processed_urls}
+
+
+def new_pipeline(raw_urls: list[str]) -> set:
+    raw_processed_urls = urls_processing(raw_urls)
+    url_netlocs = {raw_url: url_domain(cleaned_url) for raw_url, cleaned_url in raw_processed_urls.items()}
+    return set(url_netlocs.values()) | {url_domain(cleaned_url) for cleaned_url in raw_processed_urls.values()}
+
+
+def measure(pipeline, raw_urls: list[str], repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pipeline(raw_urls)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    url_counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    for url_count in url_counts:
+        raw_urls = make_urls(url_count)
+        assert old_pipeline(raw_urls) == new_pipeline(raw_urls)
+        old = measure(old_pipeline, raw_urls)
+        new = measure(new_pipeline, raw_urls)
+        print(f'URL={url_count:>7} прежний разбор={old * 1000:.0f}мс однократный разбор={new * 1000:.0f}мс '
+              f'ускорение={old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,82 @@
 import asyncio
 import datetime
-import io
 import traceback
-from contextlib import asynccontextmanager
 import logging
 
-import aiohttp
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, \
-    BufferedInputFile
+from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from aiogram.filters import Command
-from aiohttp import ClientSession
-from sqlalchemy import select, insert, update
+from aiohttp import web
+from sqlalchemy import insert
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiohttp.client_exceptions import ClientResponseError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from utils.ym_api import YMRequest
-from utils.url_processing import IncorrectUrl, extract_urls_from_message, MaxCountUrlError, \
-    BadRequestError
-from utils.xlsx_file_formatter import xlsx_writter
+from utils.url_processing import IncorrectUrl, extract_urls_from_message, extract_urls_from_file, \
+    MaxCountUrlError, BadRequestError, urls_to_json, urls_from_json
 from utils.custom_exceptions import NotAccessUserError
 from utils.logging import write_error_to_db
-from settings import tg_token, ym_token
+from utils.job_queue import job_queue
+from utils.user_cache import user_cache
+from utils.request_log import request_log
+from utils.subscriptions import subscriptions
+from settings import tg_token, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, MAX_QUEUED_JOBS
 from database.db import async_session_maker
-from database.models import User, RequestsLog
-from utils.load_file_to_minio import storage
+from database.fsm_storage import PostgresStorage
+from database.models import RequestsLog
 
 bot = Bot(token=tg_token)
-dp = Dispatcher()
+# состояния диалогов хранятся в БД: переживают перезапуск и доступны всем экземплярам бота
+dp = Dispatcher(storage=PostgresStorage())
 
 logging.basicConfig(level=logging.INFO, format='[{asctime}] #{levelname:4} {name}:{lineno} - {message}', style='{')
 logger = logging.getLogger('bot.main')
 
-
-class SessionManager:
-    def __init__(self):
-        self._session = None
-        self._active_requests = 0
-        self._lock = asyncio.Lock()
-        self._close_task = None
-
-    @asynccontextmanager
-    async def get_session(self):
-        """Контекстный менеджер для сессии с подсчетом ссылок"""
-        # Увеличиваем счетчик активных запросов
-        async with self._lock:
-            self._active_requests += 1
-            if self._session is None or self._session.closed:
-                self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=5, limit=5))
-                logging.info(f'Сессия создана. Активных запросов: {self._active_requests}')
-
-            # Отменяем задачу закрытия если она есть
-            if self._close_task:
-                self._close_task.cancel()
-                self._close_task = None
-
-        try:
-            yield self._session
-        finally:
-            # Уменьшаем счетчик и планируем закрытие
-            async with self._lock:
-                self._active_requests -= 1
-                logging.info(f'Активных запросов: {self._active_requests}')
-
-                if self._active_requests == 0 and self._session and not self._session.closed:
-                    # Планируем закрытие через 5 секунд
-                    self._close_task = asyncio.create_task(self._delayed_close())
-
-    async def _delayed_close(self):
-        """Закрывает сессию через 5 секунд если нет активных запросов"""
-        try:
-            await asyncio.sleep(5)  # Ждем 5 секунд
-            async with self._lock:
-                if self._active_requests == 0 and self._session and not self._session.closed:
-                    await self._session.close()
-                    self._session = None
-                    logging.info(f'Сессия закрыта (нет активных запросов)')
-        except asyncio.CancelledError:
-            # Задача отменена - значит появились новые запросы
-            pass
-
-
-# Глобальный менеджер сессий для всех пользователей
-session_manager = SessionManager()
+# максимальная длительность периода отчёта по подписке (дней)
+MAX_SUBSCRIPTION_DAYS = 366
 
 
 class States(StatesGroup):
     waiting_two_dates = State()
     waiting_one_date = State()
     waiting_response = State()
+    waiting_subscription_urls = State()
+    waiting_subscription_schedule = State()
 
 
 async def check_user(user_tg_id, user_message):
     """
-    Проверка наличия доступа (пользователя) в БД
+    Проверка наличия доступа (пользователя) по кэшу пользователей и запись запроса в лог
     :param user_tg_id: ID пользователя в телеграм
-    :return: user_obj
+    :return: № запроса в RequestsLog
     """
-    async with async_session_maker() as session:
-        user = await session.execute(select(User).where(User.telegram_id == user_tg_id, User.active == True))
-        user = user.scalar()
-
-        # если пользователя нет в БД, не берем его запрос в обработку, иначе добавляем запрос в лог
-        if not bool(user):
-            err_msg = f'К сожалению, у вас нет доступа к этому боту. Пожалуйста, обратитесь к администратору @antoxaSV'
-            raise NotAccessUserError(err_msg)
+    # если пользователя нет в БД, не берем его запрос в обработку, иначе добавляем запрос в лог
+    user_id = await user_cache.get_user_id(user_tg_id)
+    if user_id is None:
+        err_msg = f'К сожалению, у вас нет доступа к этому боту. Пожалуйста, обратитесь к администратору @antoxaSV'
+        raise NotAccessUserError(err_msg)
 
+    async with async_session_maker() as session:
         request_id = await session.execute(insert(RequestsLog).values(
-            user_id=user.id, request=user_message, status='ok').returning(RequestsLog.id))
+            user_id=user_id, request=user_message, status='ok').returning(RequestsLog.id))
         request_id = request_id.scalar_one()
         await session.commit()
     return request_id
 
 
+def period_keyboard() -> InlineKeyboardMarkup:
+    """
+    Инлайн-клавиатура выбора временного интервала сбора статистики
+    :return: InlineKeyboardMarkup
+    """
+    button_1 = InlineKeyboardButton(text='Дата начала - по сегодняшний день', callback_data='date_from-today')
+    button_2 = InlineKeyboardButton(text='Дата начала - дата окончания', callback_data='date_from-date_to')
+    button_3 = InlineKeyboardButton(text="За всё время", callback_data="all_time_statistics")
+    cancel_button = InlineKeyboardButton(text='Отмена', callback_data='cancel')
+    # Создаем объект инлайн-клавиатуры
+    return InlineKeyboardMarkup(inline_keyboard=[[button_1], [button_2], [button_3], [cancel_button]])
+
+
 @dp.message(Command('start'))
 async def start_handler(message: Message):
     await message.answer(
@@ -121,6 +84,7 @@ async def start_handler(message: Message):
         "\nПри вводе нескольких URL в качестве разделителей допустимо использовать: " \
         "многострочный ввод (каждый новый URL начинается с новой строки), проблелы или запятые. " \
         "\n\n <u>Внимание!</u> При вводе нескольких URL одновременно допускается не более 20 URL в сообщении!" \
+        "\n\nДля массового отчёта отправьте CSV- или XLSX-файл со списком URL." \
         "\n\nДля получения дополнительной справки воспользуйтесь командой /help",
         parse_mode='html'
     )
@@ -136,11 +100,104 @@ async def start_handler(message: Message):
         "\nhttps://example.com2\nhttps://example.com3"
         "\n\n3. Пробелы:\nhttps://example.com1 https://example.com2 https://example.com3" \
         "\n\n4. Запятые:\nhttps://example.com1,https://example.com2,https://example.com3" \
-        "\n\n Пример корректного URL: https://um.mos.ru/quizzes/kvest-kosmonavtiki/",
+        "\n\n5. Файл: CSV или XLSX, каждый URL в отдельной ячейке (для большого количества URL)" \
+        "\n\n Пример корректного URL: https://um.mos.ru/quizzes/kvest-kosmonavtiki/" \
+        "\n\n***Ежедневный отчёт***" \
+        "\n\n/subscribe - подписаться на ежедневный отчёт по URL в выбранное время" \
+        "\n/unsubscribe - отключить все подписки",
         parse_mode='html'
     )
 
 
+@dp.message(Command('subscribe'))
+async def subscribe_handler(message: Message, state: FSMContext):
+    """
+    Начало оформления подписки на ежедневный отчёт: запрос URL
+    :param message:
+    :param state:
+    :return:
+    """
+    if await user_cache.get_user_id(message.from_user.id) is None:
+        await message.answer('К сожалению, у вас нет доступа к этому боту. Пожалуйста, обратитесь к администратору '
+                             '@antoxaSV')
+        return
+    await state.set_state(States.waiting_subscription_urls)
+    await message.answer('Отправьте URL-адреса для ежедневного отчёта (не более 20 URL в сообщении).')
+
+
+@dp.message(Command('unsubscribe'))
+async def unsubscribe_handler(message: Message):
+    """
+    Отключение всех подписок пользователя
+    :param message:
+    :return:
+    """
+    count = await subscriptions.deactivate(message.from_user.id)
+    await message.answer(f'Отключено подписок: {count}.' if count else 'У вас нет активных подписок.')
+
+
+@dp.message(States.waiting_subscription_urls)
+async def get_subscription_urls(message: Message, state: FSMContext):
+    """
+    Получение URL для подписки и запрос периода и времени отправки отчёта
+    :param message:
+    :param state:
+    :return:
+    """
+    try:
+        raw_processed_urls = await extract_urls_from_message(message.text or '')
+    except (IncorrectUrl, MaxCountUrlError) as err:
+        await message.answer(str(err), parse_mode='html')
+        return
+    except BadRequestError:
+        await state.clear()
+        await message.answer('Оформление подписки отменено: не найдено ни одного URL-адреса.')
+        return
+    await state.update_data(subscription_urls=urls_to_json(raw_processed_urls))
+    await state.set_state(States.waiting_subscription_schedule)
+    await message.answer('Введите длительность периода отчёта в днях (период заканчивается вчерашним днём) '
+                         'и время получения отчёта в формате <b>N HH:MM</b>, например: <b>30 09:00</b>',
+                         parse_mode='html')
+
+
+@dp.message(States.waiting_subscription_schedule)
+async def get_subscription_schedule(message: Message, state: FSMContext):
+    """
+    Получение периода и времени отправки отчёта, сохранение подписки
+    :param message:
+    :param state:
+    :return:
+    """
+    try:
+        period_days, delivery_time = (message.text or '').split()
+        period_days = int(period_days)
+        delivery_time = datetime.datetime.strptime(delivery_time, '%H:%M').time()
+        if not 1 <= period_days <= MAX_SUBSCRIPTION_DAYS:
+            raise ValueError
+    except ValueError:
+        await message.answer(f'Некорректный формат. Введите количество дней (от 1 до {MAX_SUBSCRIPTION_DAYS}) '
+                             f'и время, например: 30 09:00. Чтобы начать заново, отправьте /subscribe')
+        return
+    user_id = await user_cache.get_user_id(message.from_user.id)
+    if user_id is None:
+        await state.clear()
+        await message.answer('К сожалению, у вас нет доступа к этому боту. Пожалуйста, обратитесь к администратору '
+                             '@antoxaSV')
+        return
+    data = await state.get_data()
+    try:
+        subscription_id = await subscriptions.add(
+            user_id, message.from_user.id, message.chat.id, message.from_user.username,
+            urls_from_json(data['subscription_urls']), period_days, delivery_time)
+    except Exception as err:
+        logger.exception('Ошибка сохранения подписки')
+        await message.answer(f'Непредвиденная ошибка.\n\n{str(err)[:4000]}')
+    else:
+        await message.answer(f'Подписка №{subscription_id} оформлена: отчёт за последние {period_days} дн. '
+                             f'будет приходить ежедневно в {delivery_time.strftime("%H:%M")}.')
+    await state.clear()
+
+
 @dp.message(F.text.strip().startswith('https://'))
 async def get_message(message: Message, state: FSMContext):
     """
@@ -154,15 +211,10 @@ async def get_message(message: Message, state: FSMContext):
         # обрабатываем полученные URL
         raw_processed_urls = await extract_urls_from_message(message.text)
 
-        await state.update_data(user_request=raw_processed_urls, request_id=request_id)
+        await state.update_data(user_request=urls_to_json(raw_processed_urls), request_id=request_id)
 
-        button_1 = InlineKeyboardButton(text='Дата начала - по сегодняшний день', callback_data='date_from-today')
-        button_2 = InlineKeyboardButton(text='Дата начала - дата окончания', callback_data='date_from-date_to')
-        button_3 = InlineKeyboardButton(text="За всё время", callback_data="all_time_statistics")
-        cancel_button = InlineKeyboardButton(text='Отмена', callback_data='cancel')
-        # Создаем объект инлайн-клавиатуры
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[button_1], [button_2], [button_3], [cancel_button]])
-        await message.answer('Задайте временной интервал сбора статистики:', reply_markup=keyboard, parse_mode='html')
+        await message.answer('Задайте временной интервал сбора статистики:', reply_markup=period_keyboard(),
+                             parse_mode='html')
 
     except IncorrectUrl as err:
         await message.answer(str(err), parse_mode='html')
@@ -181,6 +233,33 @@ async def get_message(message: Message, state: FSMContext):
         await message.answer(f'Непредвиденная ошибка.\n\n{str(err)[:4000]}')
 
 
+@dp.message(F.document)
+async def get_document(message: Message, state: FSMContext):
+    """
+    Функция получает от пользователя CSV/XLSX-файл со списком URL для массового отчёта и запршивает интервал дат
+    :param message:
+    :param state:
+    :return:
+    """
+    request_id = await check_user(message.from_user.id, message.document.file_name)
+    try:
+        file = await message.bot.download(message.document)
+        raw_processed_urls = extract_urls_from_file(message.document.file_name, file.read())
+
+        await state.update_data(user_request=urls_to_json(raw_processed_urls), request_id=request_id)
+        await message.answer(f'Получено <u><b>{len(raw_processed_urls)}</b></u> URL.\n\n'
+                             f'Задайте временной интервал сбора статистики:', reply_markup=period_keyboard(),
+                             parse_mode='html')
+
+    except (IncorrectUrl, MaxCountUrlError, BadRequestError) as err:
+        await message.answer(str(err), parse_mode='html')
+        await write_error_to_db(request_id, traceback.format_exc())
+
+    except Exception as err:
+        await write_error_to_db(request_id, traceback.format_exc(), unexpected=True)
+        await message.answer(f'Непредвиденная ошибка.\n\n{str(err)[:4000]}')
+
+
 @dp.message(States.waiting_one_date)
 async def get_one_date(message: Message, state: FSMContext):
     """
@@ -192,7 +271,7 @@ async def get_one_date(message: Message, state: FSMContext):
     date_format = '%d.%m.%Y'
     data = await state.get_data()
     request_id = data.get('request_id')
-    raw_processing_urls = data.get('user_request')
+    raw_processing_urls = urls_from_json(data['user_request'])
     try:
         date1 = datetime.datetime.strptime(message.text, date_format)
         date1 = date1.date()
@@ -200,11 +279,8 @@ async def get_one_date(message: Message, state: FSMContext):
 
         header = f'Статистика за период с {date1.strftime("%d.%m.%Y")} по {date2.strftime("%d.%m.%Y")}'
 
-        async with session_manager.get_session() as http_client_session:
-            await request_processing(raw_processed_urls=raw_processing_urls, http_request_session=http_client_session,
-                                     date1=str(date1), date2=str(date2), header=header, message=message,
-                                     state=state)
-        await state.clear()
+        await request_processing(raw_processed_urls=raw_processing_urls, date1=str(date1), date2=str(date2),
+                                 header=header, message=message, state=state)
     except ValueError:
         await message.answer('Некорректный формат даты')
     except Exception as err:
@@ -223,7 +299,7 @@ async def get_two_dates(message: Message, state: FSMContext):
     date_format = '%d.%m.%Y'
     data = await state.get_data()
     request_id = data.get('request_id')
-    raw_processed_urls = data.get('user_request')
+    raw_processed_urls = urls_from_json(data['user_request'])
     try:
         date1, date2 = message.text.split('-')
         date1, date2 = datetime.datetime.strptime(date1, date_format), datetime.datetime.strptime(date2, date_format)
@@ -236,12 +312,8 @@ async def get_two_dates(message: Message, state: FSMContext):
             await message.answer(f'Дата окончания периода не может кончаться позже сегодняшней даты.')
         else:
             header = f'Статистика за период с {date1.strftime("%d.%m.%Y")} по {date2.strftime("%d.%m.%Y")}'
-            async with session_manager.get_session() as http_client_session:
-                await request_processing(raw_processed_urls=raw_processed_urls,
-                                         http_request_session=http_client_session,
-                                         date1=str(date1), date2=str(date2), header=header, message=message,
-                                         state=state)
-            await state.clear()
+            await request_processing(raw_processed_urls=raw_processed_urls, date1=str(date1), date2=str(date2),
+                                     header=header, message=message, state=state)
     except ValueError as err:
         await message.answer('Некорректный формат даты.')
     except Exception as err:
@@ -258,14 +330,10 @@ async def stat_all_time(callback: CallbackQuery, state: FSMContext):
     :return: None
     """
     data = await state.get_data()
-    raw_processed_urls = data.get('user_request')
+    raw_processed_urls = urls_from_json(data['user_request'])
 
     header = f'Статистика на {datetime.date.today().strftime("%d.%m.%Y")}'
-    async with session_manager.get_session() as http_request_session:
-        await request_processing(raw_processed_urls=raw_processed_urls, callback=callback,
-                                 http_request_session=http_request_session, header=header,
-                                 state=state)
-    await state.clear()
+    await request_processing(raw_processed_urls=raw_processed_urls, callback=callback, header=header, state=state)
 
 
 @dp.callback_query(F.data == 'date_from-today')
@@ -330,14 +398,13 @@ async def other_message(message: Message):
                          '\n\nПример корректного URL: https://um.mos.ru/quizzes/kvest-kosmonavtiki/')
 
 
-async def request_processing(raw_processed_urls: dict, http_request_session: ClientSession, header: str,
-                             date1: str = None, date2:str=None, callback: CallbackQuery = None,
-                             message: Message = None, state: FSMContext = None):
+async def request_processing(raw_processed_urls: dict, header: str, date1: str = None, date2: str = None,
+                             callback: CallbackQuery = None, message: Message = None, state: FSMContext = None):
     """
-    Функция запускает сбор статистики для полученных URL-адресов в асинхронном режиме, формирует файл, отправляет файл
-    пользователю и в S3-хранилище
+    Функция ставит запрос в очередь формирования отчётов. Статистику собирает, файл формирует и отправляет
+    пользователю отдельный процесс-воркер (bot/worker.py); он же возвращает пользователя в исходное состояние.
+    Если в очереди уже MAX_QUEUED_JOBS задач, запрос отклоняется
     :param raw_processed_urls:
-    :param http_request_session:
     :param header: заголовок excel-таблицы
     :param date1: дата начала интервала
     :param date2: дата окончания интервала
@@ -352,58 +419,82 @@ async def request_processing(raw_processed_urls: dict, http_request_session: Cli
     request_id = data.get('request_id')
     try:
         if callback:
-            username = callback.from_user.username
+            user = callback.from_user
             message = callback.message
             await message.delete()
         else:
-            username = message.from_user.username
+            user = message.from_user
 
-        ym_request = YMRequest(ym_token)
+        # очередь отчётов заполнена: запрос отклоняется сразу, а не ожидает обработки неопределённо долго
+        if await job_queue.depth(MAX_QUEUED_JOBS) >= MAX_QUEUED_JOBS:
+            await write_error_to_db(request_id, f'Очередь отчётов заполнена ({MAX_QUEUED_JOBS} задач)')
+            await message.answer('Сейчас формируется слишком много отчётов. '
+                                 'Пожалуйста, повторите запрос через несколько минут.')
+            await state.clear()
+            return
 
+        # сообщение о ходе обработки, которое обновляет воркер
         progress_msg = await message.answer(
-            f'Получено <u><b>{len(raw_processed_urls)}</b></u> URL. Сбор статистики...', parse_mode='html')
-        tasks = [ym_request.get_statistics(http_request_session, raw_url, raw_processed_urls[raw_url], date1, date2) for
-                 raw_url in raw_processed_urls]
-        result = await asyncio.gather(*tasks)
-
-        filename = f"{username}_{datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
-        # путь в S3-хранилище
-        s3_file_name = f'bot_tg_urls_stats/{filename}'
-        await progress_msg.edit_text('Подвожу итоги...')
-        sum_stat_for_url = await ym_request.get_sum_statistics(raw_processed_urls.keys(),
-                                                               raw_processed_urls.values(), date1, date2)
-        await progress_msg.edit_text('Формирую ответ...')
-        file: bytes = xlsx_writter(result, filename, sum_stat_for_url, header)
-        # загрузка в S3-хранилище
-        storage.upload_memory_file(file_name=s3_file_name, data=io.BytesIO(file), length=len(file))
-
-        async with async_session_maker() as session:
-            await session.execute(
-                update(RequestsLog).where(RequestsLog.id == request_id).values(s3_file_path=s3_file_name))
-            await session.commit()
-
-        await progress_msg.delete()
-        await bot.send_document(chat_id=message.chat.id, document=BufferedInputFile(file=file, filename=filename),
-                                caption=f'Обработка завершена успешно!\n\nОбработано <u><b>{len(raw_processed_urls)}</b></u> URL.',
-                                parse_mode='html')
-
-    except BadRequestError as err:
-        await write_error_to_db(request_id, traceback.format_exc())
-        await message.answer(str(err))
-    except ClientResponseError as err:
-        await write_error_to_db(request_id, traceback.format_exc())
-        await message.answer(
-            'Ошибка выполнения запроса к Яндекс Метрике.' \
-            ' Вероятно, сервис сейчас перегружен. Пожалуйста попробуйте позднее.' \
-            ' Если проблема повторяется, пожалуйста, обратитесь к администратору @antoxaSV'
-        )
+            f'Получено <u><b>{len(raw_processed_urls)}</b></u> URL. Запрос поставлен в очередь...', parse_mode='html')
+        await job_queue.enqueue(request_id, {
+            'urls': raw_processed_urls, 'date1': date1, 'date2': date2, 'header': header,
+            'username': user.username, 'user_id': user.id, 'chat_id': message.chat.id,
+            'progress_message_id': progress_msg.message_id})
+
     except Exception as err:
         await write_error_to_db(request_id, traceback.format_exc(), unexpected=True)
         await message.answer(f'Произошла непредвиденная ошибка\n\n{str(err)[:4000]}')
+        await state.clear()
+
+
+@dp.startup()
+async def on_startup():
+    """
+    Действия при запуске бота: загрузка кэша пользователей и запуск фоновой записи RequestsLog
+    :return: None
+    """
+    await user_cache.start()
+    await request_log.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    """
+    Действия при остановке бота: запись оставшихся изменений RequestsLog
+    :return: None
+    """
+    await user_cache.stop()
+    await request_log.stop()
+
+
+async def start_webhook():
+    """
+    Запуск бота в режиме webhook: обновления принимает aiohttp-сервер, поэтому несколько экземпляров бота
+    могут работать за балансировщиком нагрузки с общим хранилищем состояний в БД
+    :return: None
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(f'{WEBHOOK_URL}{WEBHOOK_PATH}', secret_token=WEBHOOK_SECRET)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+    print(f'Бот запущен (webhook {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
+    if WEBHOOK_URL:
+        await start_webhook()
+        return
     print('Бот запущен')
+    # при переходе с webhook на long polling webhook необходимо удалить
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 
@@ -0,0 +1,391 @@
+import asyncio
+import datetime
+import time
+from collections.abc import Callable
+import traceback
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import FSInputFile
+from aiohttp import ClientSession, ClientError
+from aiohttp.client_exceptions import ClientResponseError
+from minio.error import S3Error
+
+from utils.ym_api import YMRequest, statistic
+from utils.quota_governor import quota_governor
+from utils.fair_scheduler import current_client
+from utils.http_client import http_client
+from utils.timings import ReportTimings, current_timings, timing_stage
+from utils.url_processing import BadRequestError
+from utils.xlsx_file_formatter import xlsx_writter_async, XlsxReportWriter, temporary_report_file
+from utils.logging import write_error_to_db
+from utils.request_log import request_log
+from utils.report_cache import report_cache
+from utils.load_file_to_minio import storage
+from settings import OUTER_ENDPOINT_URL
+
+logger = logging.getLogger(__name__)
+
+# максимальное количество URL в текстовом сообщении, запросы большего размера обрабатываются как массовый отчёт
+MAX_MESSAGE_URLS = 20
+# минимальный интервал между обновлениями сообщения о ходе массового отчёта (сек)
+PROGRESS_UPDATE_INTERVAL = 5
+
+
+async def edit_progress(bot: Bot, job: dict, text: str):
+    """
+    Обновляет сообщение о ходе обработки запроса. Ошибка обновления не прерывает формирование отчёта
+    :param bot:
+    :param job: параметры задачи (chat_id, progress_message_id)
+    :param text: новый текст сообщения
+    :return: None
+    """
+    # у отчётов по подписке нет сообщения о ходе обработки
+    if job.get('progress_message_id') is None:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['progress_message_id'],
+                                    parse_mode='html')
+    except TelegramAPIError as err:
+        logger.warning(f'Не удалось обновить сообщение о ходе обработки: {err}')
+
+
+async def delete_progress(bot: Bot, job: dict):
+    """
+    Удаляет сообщение о ходе обработки запроса перед отправкой отчёта
+    :param bot:
+    :param job: параметры задачи (chat_id, progress_message_id)
+    :return: None
+    """
+    if job.get('progress_message_id') is None:
+        return
+    try:
+        await bot.delete_message(chat_id=job['chat_id'], message_id=job['progress_message_id'])
+    except TelegramAPIError as err:
+        logger.warning(f'Не удалось удалить сообщение о ходе обработки: {err}')
+
+
+def report_priority(job: dict) -> str:
+    """
+    Класс запросов отчёта к API для распределения квоты между пользователями (см. FairScheduler)
+    :param job: параметры задачи (urls, subscription_id)
+    :return: interactive - небольшой отчёт по запросу пользователя, bulk - массовый отчёт или отчёт по подписке
+    """
+    if job.get('subscription_id') is None and len(job['urls']) <= MAX_MESSAGE_URLS:
+        return 'interactive'
+    return 'bulk'
+
+
+def report_filename(job: dict) -> str:
+    """
+    Имя файла отчёта для пользователя
+    :param job: параметры задачи (username)
+    :return: имя файла
+    """
+    return f"{job.get('username') or 'report'}_{datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
+
+
+def shared_report_filename(job: dict, report_key: str) -> str:
+    """
+    Имя файла отчёта, который повторно отправляется другим пользователям (по file_id): без имени пользователя
+    и времени формирования - период отчёта и начало хэша его параметров
+    :param job: параметры задачи (date1, date2)
+    :param report_key: хэш параметров отчёта
+    :return: имя файла
+    """
+    period = '_'.join(date for date in (job.get('date1'), job.get('date2')) if date)
+    return f"report_{period + '_' if period else ''}{report_key[:8]}.xlsx"
+
+
+async def process_report(bot: Bot, request_id: int, job: dict) -> str:
+    """
+    Формирует отчёт по задаче из очереди и отправляет его пользователю. Ошибки записываются в RequestsLog
+    и сообщаются пользователю
+    :param bot:
+    :param request_id: № запроса в RequestsLog
+    :param job: параметры задачи (urls, date1, date2, header, username, chat_id, progress_message_id)
+    :return: статус задачи: done / failed
+    """
+    # время этапов формирования отчёта сохраняется в request_timing
+    timings = ReportTimings(request_id)
+    context_token = current_timings.set(timings)
+    # запросы к API отчёта встают в очередь пользователя (справедливое распределение квоты)
+    client_token = current_client.set((job['user_id'], report_priority(job)))
+    status = 'failed'
+    try:
+        await build_report(bot, http_client.session, request_id, job)
+        status = 'done'
+
+    except BadRequestError as err:
+        await write_error_to_db(request_id, traceback.format_exc())
+        await bot.send_message(job['chat_id'], str(err))
+    except ClientResponseError as err:
+        await write_error_to_db(request_id, traceback.format_exc())
+        await bot.send_message(
+            job['chat_id'],
+            'Ошибка выполнения запроса к Яндекс Метрике.' \
+            ' Вероятно, сервис сейчас перегружен. Пожалуйста попробуйте позднее.' \
+            ' Если проблема повторяется, пожалуйста, обратитесь к администратору @antoxaSV'
+        )
+    except Exception as err:
+        await write_error_to_db(request_id, traceback.format_exc(), unexpected=True)
+        await bot.send_message(job['chat_id'], f'Произошла непредвиденная ошибка\n\n{str(err)[:4000]}')
+    finally:
+        current_client.reset(client_token)
+        current_timings.reset(context_token)
+        await timings.save(status)
+    return status
+
+
+async def build_report(bot: Bot, http_request_session: ClientSession, request_id: int, job: dict):
+    """
+    Функция запускает сбор статистики для полученных URL-адресов в асинхронном режиме, формирует файл, отправляет файл
+    пользователю и в S3-хранилище. URL, данные по которым получить не удалось, отмечаются в отчёте
+    :param bot:
+    :param http_request_session:
+    :param request_id: № запроса в RequestsLog
+    :param job: параметры задачи
+    :return: None
+    """
+    total = len(job['urls'])
+
+    # одинаковый отчёт уже сформирован: отправляется без запросов к API и загрузки в хранилище
+    report_key = report_cache.key(job)
+    if await send_cached_report(bot, request_id, job, report_key, total):
+        logger.info(f'Запрос {request_id}: отправлен ранее сформированный отчёт {report_key}')
+        return
+
+    await edit_progress(bot, job, f'Получено <u><b>{total}</b></u> URL. Сбор статистики...')
+    with temporary_report_file() as file_path:
+        failed = await render_report(bot, http_request_session, request_id, job, file_path)
+        await send_report(bot, file_path, request_id, job, total, failed, report_key)
+
+
+async def render_report(bot: Bot, http_request_session: ClientSession, request_id: int | None, job: dict,
+                        file_path: str) -> int:
+    """
+    Собирает статистику по URL задачи и формирует файл отчёта
+    :param bot:
+    :param http_request_session:
+    :param request_id: № запроса в RequestsLog (None - отчёт формируется заранее, без запроса пользователя)
+    :param job: параметры задачи
+    :param file_path: путь к файлу отчёта
+    :return: количество URL, данные по которым получить не удалось
+    """
+    raw_processed_urls = job['urls']
+    date1, date2 = job.get('date1'), job.get('date2')
+    ym_request = YMRequest()
+
+    if len(raw_processed_urls) > MAX_MESSAGE_URLS:
+        # массовый отчёт: строки записываются во временный xlsx-файл (constant_memory) по мере получения
+        writer = XlsxReportWriter(file_path, job['header'], {'constant_memory': True})
+        with timing_stage('statistics'):
+            failed = await collect_statistics(bot, ym_request, http_request_session, job, writer.write)
+        await edit_progress(bot, job, 'Формирую ответ...')
+        # итоги рассчитываются по строкам отчёта: суммарный запрос по тысячам URL не помещается в фильтр
+        with timing_stage('render'):
+            await asyncio.to_thread(writer.close)
+    else:
+        stats = {}
+        with timing_stage('statistics'):
+            failed = await collect_statistics(bot, ym_request, http_request_session, job,
+                                              lambda stat: stats.__setitem__(stat.raw_url, stat))
+
+        await edit_progress(bot, job, 'Подвожу итоги...')
+        # итоги запрашиваются только по URL, данные по которым получены
+        received_urls = {raw_url: cleaned_url for raw_url, cleaned_url in raw_processed_urls.items()
+                         if not stats[raw_url].error}
+        if len(set(received_urls.values())) == 1:
+            # итоги по одному URL - тот же запрос к API, что и строка URL: повторно не запрашиваются
+            sum_stat_for_url = stats[next(iter(received_urls))]._replace(raw_url=None)
+        else:
+            try:
+                with timing_stage('totals'):
+                    sum_stat_for_url = await ym_request.get_sum_statistics(
+                        http_request_session, received_urls.keys(), received_urls.values(), date1, date2)
+            except (BadRequestError, ClientError) as err:
+                # итоги будут рассчитаны по строкам отчёта
+                logger.warning(f'Не удалось получить итоговые данные по запросу {request_id}: {err}')
+                sum_stat_for_url = None
+        await edit_progress(bot, job, 'Формирую ответ...')
+        with timing_stage('render'):
+            await xlsx_writter_async([stats[raw_url] for raw_url in raw_processed_urls], file_path,
+                                     sum_stat_for_url, job['header'])
+    logger.info(f'Объединение запросов к Яндекс Метрике: {ym_request.single_flight.stats()}; '
+                f'квота API: {quota_governor.stats()}; выбор точности: {ym_request.accuracy_selector.stats()}; '
+                f'http-соединения: {http_client.stats()}')
+    return failed
+
+
+async def prepare_report(bot: Bot, job: dict) -> bool:
+    """
+    Формирует отчёт заранее (без отправки пользователю) и сохраняет его в S3-хранилище под ключом из хэша
+    параметров: при отправке отчёт с теми же параметрами берётся из хранилища (см. send_cached_report)
+    :param bot:
+    :param job: параметры задачи
+    :return: True, если отчёт сохранён; отчёт с URL, данные по которым получить не удалось, не сохраняется
+    """
+    report_key = report_cache.key(job)
+    if await report_cache.get(report_key) is not None:
+        return True
+    with temporary_report_file() as file_path:
+        # запросы к API выполняются, только если их нет у отчётов, которых ждут пользователи
+        client_token = current_client.set((job['user_id'], 'background'))
+        try:
+            failed = await render_report(bot, http_client.session, None, job, file_path)
+        finally:
+            current_client.reset(client_token)
+        if failed:
+            return False
+        s3_file_name = report_cache.s3_file_path(report_key)
+        if not await storage.object_exists_async(s3_file_name):
+            await storage.upload_file_async(file_name=s3_file_name, file_path=file_path)
+    await report_cache.save(report_key, s3_file_name)
+    return True
+
+
+async def collect_statistics(bot: Bot, ym_request: YMRequest, http_request_session: ClientSession, job: dict,
+                             on_stat: Callable[[statistic], None]) -> int:
+    """
+    Получает статистику по URL задачи по мере завершения запросов к API и передаёт каждую строку в on_stat.
+    Ход обработки (обработано N из M) отображается в сообщении о ходе обработки
+    не чаще раза в PROGRESS_UPDATE_INTERVAL секунд (ограничения telegram-API)
+    :param bot:
+    :param ym_request:
+    :param http_request_session:
+    :param job: параметры задачи
+    :param on_stat: функция, принимающая строку статистики
+    :return: количество URL, данные по которым получить не удалось
+    """
+    total = len(job['urls'])
+    processed = 0
+    failed = 0
+    error = None
+    last_update = time.monotonic()
+    async for chunk_stats in ym_request.iter_statistics_batch(http_request_session, job['urls'],
+                                                              job.get('date1'), job.get('date2')):
+        for stat in chunk_stats.values():
+            on_stat(stat)
+            if stat.error:
+                failed += 1
+                error = stat.error
+        processed += len(chunk_stats)
+        if processed < total and time.monotonic() - last_update >= PROGRESS_UPDATE_INTERVAL:
+            await edit_progress(bot, job, f'Сбор статистики: обработано <b>{processed}</b> из <b>{total}</b> URL...')
+            last_update = time.monotonic()
+
+    if failed == total:
+        raise BadRequestError(f'Не удалось получить данные ни по одному URL: {error}.')
+    return failed
+
+
+def report_caption(url_count: int, failed: int = 0) -> str:
+    """
+    Подпись к отчёту
+    :param url_count: количество обработанных URL
+    :param failed: количество URL, данные по которым получить не удалось
+    :return: текст подписи
+    """
+    caption = f'Обработка завершена успешно!\n\nОбработано <u><b>{url_count}</b></u> URL.'
+    if failed:
+        caption += f'\n\nНе удалось получить данные по <b>{failed}</b> URL, они отмечены в отчёте.'
+    return caption
+
+
+async def send_cached_report(bot: Bot, request_id: int, job: dict, report_key: str, url_count: int) -> bool:
+    """
+    Отправляет пользователю ранее сформированный одинаковый отчёт: по file_id ранее отправленного в telegram файла,
+    а если он недоступен - файлом из S3-хранилища или ссылкой на него
+    :param bot:
+    :param request_id: № запроса в RequestsLog
+    :param job: параметры задачи (chat_id, progress_message_id)
+    :param report_key: хэш параметров отчёта
+    :param url_count: количество URL в запросе
+    :return: True, если отчёт отправлен
+    """
+    cached = await report_cache.get(report_key)
+    if cached is None:
+        return False
+
+    caption = report_caption(url_count)
+    with timing_stage('telegram_send'):
+        sent = False
+        if cached.telegram_file_id:
+            try:
+                await bot.send_document(chat_id=job['chat_id'], document=cached.telegram_file_id, caption=caption,
+                                        parse_mode='html')
+                sent = True
+            except TelegramAPIError as err:
+                logger.warning(f'Не удалось отправить отчёт {report_key} по file_id: {err}')
+        if not sent:
+            # отчёт сформирован заранее и ещё не отправлялся в telegram
+            sent = await send_stored_report(bot, job, report_key, cached.s3_file_path, caption)
+        if not sent and OUTER_ENDPOINT_URL:
+            link = storage.share_file_from_bucket(cached.s3_file_path)
+            await bot.send_message(job['chat_id'], f'{caption}\n\n<a href="{link}">Скачать отчёт</a>',
+                                   parse_mode='html')
+            sent = True
+        if not sent:
+            return False
+        await delete_progress(bot, job)
+    request_log.update(request_id, s3_file_path=cached.s3_file_path)
+    return True
+
+
+async def send_stored_report(bot: Bot, job: dict, report_key: str, s3_file_path: str, caption: str) -> bool:
+    """
+    Отправляет пользователю файл отчёта из S3-хранилища и запоминает его file_id для следующих отправок
+    :param bot:
+    :param job: параметры задачи (date1, date2, chat_id)
+    :param report_key: хэш параметров отчёта
+    :param s3_file_path: путь к отчёту в S3-хранилище
+    :param caption: подпись к отчёту
+    :return: True, если отчёт отправлен
+    """
+    try:
+        with temporary_report_file() as file_path:
+            await storage.download_file_async(file_name=s3_file_path, file_path=file_path)
+            document = FSInputFile(file_path, filename=shared_report_filename(job, report_key))
+            message = await bot.send_document(chat_id=job['chat_id'], document=document, caption=caption,
+                                              parse_mode='html')
+    except (S3Error, TelegramAPIError) as err:
+        logger.warning(f'Не удалось отправить отчёт {report_key} из хранилища: {err}')
+        return False
+    await report_cache.save(report_key, s3_file_path, message.document.file_id)
+    return True
+
+
+async def send_report(bot: Bot, file_path: str, request_id: int, job: dict, url_count: int, failed: int = 0,
+                      report_key: str = None):
+    """
+    Загружает готовый отчёт в S3-хранилище и отправляет его пользователю. Файл читается с диска по частям
+    и не загружается в память целиком. Полный отчёт (без URL с ошибками) сохраняется под ключом из хэша
+    параметров для повторной отправки; если такой файл уже есть в хранилище, он не загружается повторно
+    :param bot:
+    :param file_path: путь к файлу отчёта
+    :param request_id: № запроса в RequestsLog
+    :param job: параметры задачи (username, chat_id, progress_message_id)
+    :param url_count: количество обработанных URL
+    :param failed: количество URL, данные по которым получить не удалось
+    :param report_key: хэш параметров отчёта
+    :return: None
+    """
+    # отчёт с ошибками получения данных не используется повторно
+    shared = report_key is not None and not failed
+    # file_id отправленного файла получат другие пользователи - имя файла не должно содержать имя пользователя
+    filename = shared_report_filename(job, report_key) if shared else report_filename(job)
+    # путь в S3-хранилище
+    s3_file_name = report_cache.s3_file_path(report_key) if shared else f'bot_tg_urls_stats/{filename}'
+    # загрузка в S3-хранилище
+    with timing_stage('upload'):
+        if not shared or not await storage.object_exists_async(s3_file_name):
+            await storage.upload_file_async(file_name=s3_file_name, file_path=file_path)
+    request_log.update(request_id, s3_file_path=s3_file_name)
+
+    with timing_stage('telegram_send'):
+        await delete_progress(bot, job)
+        message = await bot.send_document(chat_id=job['chat_id'], document=FSInputFile(file_path, filename=filename),
+                                          caption=report_caption(url_count, failed), parse_mode='html')
+    if shared:
+        await report_cache.save(report_key, s3_file_name, message.document.file_id)
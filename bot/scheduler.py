@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+import logging
+
+from aiogram import Bot
+from sqlalchemy import insert
+
+from bot.reports import prepare_report
+from database.db import async_session_maker
+from database.models import RequestsLog
+from settings import SUBSCRIPTION_PREPARE_FROM, SUBSCRIPTION_PREPARE_TO
+from utils.job_queue import job_queue
+from utils.subscriptions import subscriptions, subscription_job
+
+logger = logging.getLogger(__name__)
+
+# период проверки подписок (сек)
+SCHEDULER_INTERVAL = 60
+
+
+def is_prepare_time(now: datetime.datetime) -> bool:
+    """
+    Наступили ли часы заблаговременного формирования отчётов
+    :param now: текущее время
+    :return: True, если now в интервале [SUBSCRIPTION_PREPARE_FROM, SUBSCRIPTION_PREPARE_TO)
+    """
+    if SUBSCRIPTION_PREPARE_FROM <= SUBSCRIPTION_PREPARE_TO:
+        return SUBSCRIPTION_PREPARE_FROM <= now.hour < SUBSCRIPTION_PREPARE_TO
+    # интервал через полночь, например 22-6
+    return now.hour >= SUBSCRIPTION_PREPARE_FROM or now.hour < SUBSCRIPTION_PREPARE_TO
+
+
+async def deliver_due() -> int:
+    """
+    Ставит в очередь отчёты по подпискам, время отправки которых наступило. Отчёт обрабатывает воркер
+    как обычную задачу; отчёт, сформированный заранее, берётся из хранилища
+    :return: количество поставленных в очередь отчётов
+    """
+    delivered = 0
+    while True:
+        now = datetime.datetime.now()
+        subscription = await subscriptions.claim_delivery(now)
+        if subscription is None:
+            return delivered
+        async with async_session_maker() as session:
+            request_id = await session.execute(insert(RequestsLog).values(
+                user_id=subscription.user_id, request=f'Подписка {subscription.id}', status='ok'
+            ).returning(RequestsLog.id))
+            request_id = request_id.scalar_one()
+            await session.commit()
+        await job_queue.enqueue(request_id, subscription_job(subscription, now.date()))
+        logger.info(f'Отчёт по подписке {subscription.id} поставлен в очередь (запрос {request_id})')
+        delivered += 1
+
+
+async def prepare_next(bot: Bot) -> bool:
+    """
+    Заранее формирует отчёт по одной подписке
+    :param bot:
+    :return: True, если подписка для формирования отчёта была найдена
+    """
+    today = datetime.date.today()
+    subscription = await subscriptions.claim_prepare(today)
+    if subscription is None:
+        return False
+    try:
+        stored = await prepare_report(bot, subscription_job(subscription, today))
+        logger.info(f'Отчёт по подписке {subscription.id} сформирован заранее: {stored}')
+    except Exception:
+        # при отправке отчёт будет сформирован обычным образом
+        logger.exception(f'Ошибка заблаговременного формирования отчёта по подписке {subscription.id}')
+    return True
+
+
+async def scheduler_loop(bot: Bot):
+    """
+    Планировщик подписок: ставит в очередь отчёты, время отправки которых наступило, а в часы минимальной нагрузки
+    по одному формирует отчёты на сегодня заранее. Отчёты формируются последовательно, чтобы не занимать
+    квоту API, нужную запросам пользователей
+    :param bot:
+    :return: None
+    """
+    while True:
+        prepared = False
+        try:
+            await deliver_due()
+            if is_prepare_time(datetime.datetime.now()):
+                prepared = await prepare_next(bot)
+        except Exception:
+            logger.exception('Ошибка планировщика подписок')
+        # пока есть отчёты для заблаговременного формирования, следующий формируется сразу
+        if not prepared:
+            await asyncio.sleep(SCHEDULER_INTERVAL)
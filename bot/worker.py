@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import socket
+
+from aiogram import Bot
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.reports import process_report
+from bot.scheduler import scheduler_loop
+from database.fsm_storage import PostgresStorage
+from database.models import ReportJob
+from settings import tg_token, WORKER_CONCURRENCY, METRICS_HOST, METRICS_PORT
+from utils.counter_cache import counter_cache
+from utils.http_client import http_client
+from utils.job_queue import job_queue
+from utils.metrics import metrics
+from utils.logging import write_error_to_db
+from utils.request_log import request_log
+from utils.xlsx_file_formatter import report_executor
+
+logging.basicConfig(level=logging.INFO, format='[{asctime}] #{levelname:4} {name}:{lineno} - {message}', style='{')
+logger = logging.getLogger('bot.worker')
+
+# период опроса пустой очереди (сек)
+POLL_INTERVAL = 1
+
+
+async def heartbeat(request_id: int, worker_id: str):
+    """
+    Периодически подтверждает, что задача обрабатывается, чтобы её не забрал другой воркер
+    :param request_id: № запроса в RequestsLog
+    :param worker_id: идентификатор воркера
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(job_queue.lease / 3)
+        try:
+            await job_queue.heartbeat(request_id, worker_id)
+        except Exception:
+            logger.exception(f'Ошибка продления задачи {request_id}')
+
+
+async def handle_job(bot: Bot, fsm_storage: PostgresStorage, job: ReportJob, worker_id: str):
+    """
+    Обрабатывает задачу из очереди и возвращает пользователя в исходное состояние диалога
+    :param bot:
+    :param fsm_storage: хранилище состояний диалогов бота
+    :param job: задача
+    :param worker_id: идентификатор воркера
+    :return: None
+    """
+    payload = job_queue.payload(job)
+    heartbeat_task = asyncio.create_task(heartbeat(job.request_id, worker_id))
+    try:
+        if job.attempts > job_queue.max_attempts:
+            # задача несколько раз была брошена упавшими воркерами
+            status = 'failed'
+            await write_error_to_db(job.request_id, f'Превышено количество попыток обработки ({job_queue.max_attempts})',
+                                    unexpected=True)
+            await bot.send_message(payload['chat_id'], 'Не удалось сформировать отчёт. Пожалуйста, повторите запрос.')
+        else:
+            logger.info(f'Задача {job.request_id} (попытка {job.attempts}): {len(payload["urls"])} URL')
+            status = await process_report(bot, job.request_id, payload)
+    finally:
+        heartbeat_task.cancel()
+
+    await job_queue.finish(job.request_id, status)
+    if payload.get('subscription_id') is not None:
+        # отчёт по подписке не связан с диалогом пользователя
+        return
+    # пользователь снова может отправлять запросы
+    key = StorageKey(bot_id=bot.id, chat_id=payload['chat_id'], user_id=payload['user_id'])
+    await fsm_storage.set_state(key, None)
+    await fsm_storage.set_data(key, {})
+
+
+async def worker_loop(bot: Bot, fsm_storage: PostgresStorage, worker_id: str):
+    """
+    Цикл обработки задач: забирает задачи из очереди по одной, пока очередь не пуста
+    :param bot:
+    :param fsm_storage: хранилище состояний диалогов бота
+    :param worker_id: идентификатор воркера
+    :return: None
+    """
+    while True:
+        try:
+            job = await job_queue.claim(worker_id)
+            if job is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            await handle_job(bot, fsm_storage, job, worker_id)
+        except Exception:
+            # задача, которую не удалось завершить, будет повторно выдана после истечения lease
+            logger.exception('Ошибка обработки задачи')
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+async def on_startup():
+    """
+    Действия при запуске воркера: создание http-сессии к API Яндекс Метрики, прогрев кэша счётчиков,
+    запуск фоновой записи RequestsLog и http-сервера метрик
+    :return: None
+    """
+    await http_client.start()
+    await counter_cache.start()
+    await request_log.start()
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+
+async def on_shutdown():
+    """
+    Действия при остановке воркера: запись оставшихся изменений RequestsLog, закрытие соединений
+    :return: None
+    """
+    await metrics.stop_server()
+    await counter_cache.stop()
+    await request_log.stop()
+    await http_client.close()
+    report_executor.shutdown()
+
+
+async def main():
+    bot = Bot(token=tg_token)
+    fsm_storage = PostgresStorage()
+    process_id = f'{socket.gethostname()}:{os.getpid()}'
+
+    await on_startup()
+    print(f'Воркер {process_id} запущен, параллельных задач: {WORKER_CONCURRENCY}')
+    try:
+        await asyncio.gather(*(worker_loop(bot, fsm_storage, f'{process_id}:{i}') for i in range(WORKER_CONCURRENCY)),
+                             scheduler_loop(bot))
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
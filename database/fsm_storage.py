@@ -0,0 +1,70 @@
+import datetime
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from database.db import async_session_maker
+from database.models import FSMState
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM aiogram в PostgreSQL (таблица fsm_state).
+    Состояния диалогов сохраняются между перезапусками и доступны всем экземплярам бота
+    """
+
+    def __init__(self, key_builder: KeyBuilder = None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        stmt = insert(FSMState).values(
+            key=self.key_builder.build(key), state=state, data={}, updated_at=datetime.datetime.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FSMState.key], set_={'state': stmt.excluded.state, 'updated_at': stmt.excluded.updated_at})
+        async with async_session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        async with async_session_maker() as session:
+            state = await session.execute(select(FSMState.state).where(FSMState.key == self.key_builder.build(key)))
+            return state.scalar_one_or_none()
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        stmt = insert(FSMState).values(
+            key=self.key_builder.build(key), data=dict(data), updated_at=datetime.datetime.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FSMState.key], set_={'data': stmt.excluded.data, 'updated_at': stmt.excluded.updated_at})
+        async with async_session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        async with async_session_maker() as session:
+            data = await session.execute(select(FSMState.data).where(FSMState.key == self.key_builder.build(key)))
+            data = data.scalar_one_or_none()
+        return dict(data) if data else {}
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        """
+        Обновление данных одним запросом (объединение jsonb на стороне БД)
+        """
+        stmt = insert(FSMState).values(
+            key=self.key_builder.build(key), data=dict(data), updated_at=datetime.datetime.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FSMState.key],
+            set_={'data': FSMState.data.op('||')(stmt.excluded.data), 'updated_at': stmt.excluded.updated_at}
+        ).returning(FSMState.data)
+        async with async_session_maker() as session:
+            new_data = await session.execute(stmt)
+            new_data = new_data.scalar_one()
+            await session.commit()
+        return dict(new_data)
+
+    async def close(self) -> None:
+        # подключение к БД общее для всего приложения и закрывается вместе с ним
+        pass
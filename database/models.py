@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, Boolean, DateTime, ForeignKey, BIGINT, TEXT, ARRAY, String, Date
+from sqlalchemy import Column, Integer, Boolean, DateTime, ForeignKey, BIGINT, TEXT, ARRAY, String, Date, Float, Time, \
+    UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from database.db import Base, async_session_maker
 
 from sqlalchemy import select, update, delete
@@ -45,4 +47,185 @@ class RequestsLog(Base):
     error_msg = Column(TEXT, nullable=True)
     status = Column(String(5), nullable=False)
     s3_file_path = Column(TEXT, nullable=True)
-    created_at = Column(DateTime, nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime, nullable=False)
+
+
+class StatisticCache(Base):
+    __tablename__ = 'statistic_cache'
+    __table_args__ = (
+        UniqueConstraint('counter', 'url', 'date1', 'date2'),
+        {
+            'schema': 'bot_tg_url_stats',
+            'comment': 'Кэш статистики Яндекс Метрики по URL за период'
+        }
+    )
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    counter = Column(BIGINT, nullable=False)
+    url = Column(TEXT, nullable=False)
+    date1 = Column(Date, nullable=False)
+    date2 = Column(Date, nullable=False)
+    # точность (sampling), с которой получены данные
+    accuracy = Column(String(10), nullable=False)
+    visits = Column(Float, nullable=False)
+    users = Column(Float, nullable=False)
+    page_views = Column(Float, nullable=False)
+    page_depth = Column(Float, nullable=False)
+    visit_duration = Column(Float, nullable=False)
+    bounce_rate = Column(Float, nullable=False)
+    new_users = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    # NULL - запись не устаревает (период полностью в прошлом)
+    expires_at = Column(DateTime, nullable=True)
+
+
+class DailyStatistic(Base):
+    __tablename__ = 'daily_statistic'
+    __table_args__ = (
+        UniqueConstraint('counter', 'url', 'day'),
+        {
+            'schema': 'bot_tg_url_stats',
+            'comment': 'Аддитивные метрики Яндекс Метрики по URL за каждый завершившийся день'
+        }
+    )
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    counter = Column(BIGINT, nullable=False)
+    url = Column(TEXT, nullable=False)
+    day = Column(Date, nullable=False)
+    visits = Column(Float, nullable=False)
+    page_views = Column(Float, nullable=False)
+    # суммарное время визитов (сек)
+    visit_duration = Column(Float, nullable=False)
+    # количество отказов
+    bounces = Column(Float, nullable=False)
+    # количество визитов новых посетителей
+    new_visits = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class FSMState(Base):
+    __tablename__ = 'fsm_state'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Состояния и данные диалогов с пользователями (FSM aiogram)'
+    }
+
+    # ключ хранилища aiogram (бот, чат, пользователь)
+    key = Column(TEXT, primary_key=True)
+    state = Column(TEXT, nullable=True)
+    data = Column(JSONB, nullable=False, default=dict)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ReportJob(Base):
+    __tablename__ = 'report_job'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Очередь задач формирования отчётов'
+    }
+
+    # задача формируется по одному запросу из requests_log
+    request_id = Column(Integer, ForeignKey('bot_tg_url_stats.requests_log.id', ondelete='CASCADE'), primary_key=True)
+    # queued - ожидает обработки, running - обрабатывается, done - выполнена, failed - завершилась ошибкой
+    status = Column(String(10), nullable=False, index=True)
+    # параметры отчёта: URL (списком пар, см. urls_to_json), период, заголовок, получатель
+    payload = Column(JSONB, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker = Column(TEXT, nullable=True)
+    # время последнего подтверждения обработки воркером; задача с устаревшей отметкой считается брошенной
+    locked_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class YMQuotaToken(Base):
+    __tablename__ = 'ym_quota_token'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Ограничение частоты запросов к API Яндекс Метрики по токенам (общее для всех процессов)'
+    }
+
+    # хэш OAuth-токена (сами токены в БД не хранятся)
+    token_key = Column(String(16), primary_key=True)
+    # время, с которого разрешён следующий запрос по токену
+    next_request_at = Column(DateTime, nullable=False)
+    # запросы по токену приостановлены до этого времени после ответа 429
+    blocked_until = Column(DateTime, nullable=True)
+    # количество подряд полученных ответов 429
+    throttled = Column(Integer, nullable=False, default=0)
+
+
+class YMQuotaSlot(Base):
+    __tablename__ = 'ym_quota_slot'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Слоты одновременных запросов к API Яндекс Метрики по токенам (общие для всех процессов)'
+    }
+
+    token_key = Column(String(16), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    # процесс, выполняющий запрос; NULL - слот свободен
+    holder = Column(TEXT, nullable=True)
+    # слот, не освобождённый до этого времени (процесс упал), считается свободным
+    expires_at = Column(DateTime, nullable=True)
+
+
+class RequestTiming(Base):
+    __tablename__ = 'request_timing'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Время выполнения этапов формирования отчётов'
+    }
+
+    request_id = Column(Integer, ForeignKey('bot_tg_url_stats.requests_log.id', ondelete='CASCADE'), primary_key=True)
+    # done / failed
+    status = Column(String(10), nullable=False)
+    total_seconds = Column(Float, nullable=False)
+    # {этап: время (сек)}
+    stages = Column(JSONB, nullable=False)
+    # итоги запросов к API Яндекс Метрики: количество, время, объём ответов, неудачные попытки
+    api_summary = Column(JSONB, nullable=False)
+    # запросы к API Яндекс Метрики: описание, попытка, точность, http-статус, объём ответа, время
+    api_calls = Column(JSONB, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class ReportFile(Base):
+    __tablename__ = 'report_file'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Сформированные отчёты в S3-хранилище для повторной отправки одинаковых отчётов'
+    }
+
+    # хэш параметров отчёта: URL, период, заголовок, версия данных
+    report_hash = Column(String(64), primary_key=True)
+    s3_file_path = Column(TEXT, nullable=False)
+    # file_id отправленного файла в telegram: повторная отправка без передачи содержимого файла
+    telegram_file_id = Column(TEXT, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+
+class ReportSubscription(Base):
+    __tablename__ = 'report_subscription'
+    __table_args__ = {
+        'schema': 'bot_tg_url_stats',
+        'comment': 'Подписки пользователей на ежедневные отчёты'
+    }
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('bot_tg_url_stats.user.id', ondelete='CASCADE'), nullable=False, index=True)
+    telegram_id = Column(BIGINT, nullable=False)
+    chat_id = Column(BIGINT, nullable=False)
+    username = Column(TEXT, nullable=True)
+    # [[raw_url, cleaned_url], ...] в порядке URL запроса (см. urls_to_json)
+    urls = Column(JSONB, nullable=False)
+    # отчёт формируется за period_days дней, закончившихся вчера
+    period_days = Column(Integer, nullable=False)
+    # время отправки отчёта (время сервера)
+    delivery_time = Column(Time, nullable=False)
+    active = Column(Boolean, nullable=False, default=True)
+    # дата, на которую отчёт сформирован заранее, и дата последней отправки
+    prepared_on = Column(Date, nullable=True)
+    delivered_on = Column(Date, nullable=True)
+    created_at = Column(DateTime, nullable=False)
@@ -5,6 +5,20 @@ load_dotenv()
 
 tg_token = os.getenv('TG_TOKEN')
 ym_token = os.getenv('YM_TOKEN')
+# пул токенов API Яндекс Метрики через запятую (по умолчанию - один токен YM_TOKEN)
+YM_TOKENS = [token.strip() for token in (os.getenv('YM_TOKENS') or ym_token or '').split(',') if token.strip()]
+# ограничения API Яндекс Метрики на один токен: одновременные запросы и запросы в секунду
+YM_MAX_PARALLEL = int(os.getenv('YM_MAX_PARALLEL', 5))
+YM_RATE_LIMIT = float(os.getenv('YM_RATE_LIMIT', 10))
+# адрес API отчётов Яндекс Метрики (для нагрузочного тестирования можно указать локальную заглушку)
+YM_API_URL = os.getenv('YM_API_URL', 'https://api-metrika.yandex.net/stat/v1/data')
+
+# пул http-соединений к API Яндекс Метрики: размер, keep-alive и кэш DNS (сек), таймауты соединения и запроса (сек)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', 60))
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', 300))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 300))
 
 DB_USER = os.getenv('DB_USER')
 DB_NAME = os.getenv('DB_NAME')
@@ -18,3 +32,31 @@ ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
 SECRET_KEY = os.getenv('S3_SECRET_KEY')
 OUTER_ENDPOINT_URL = os.getenv('S3_OUTER_ENDPOINT_URL')
 MINIO_SECURE = os.getenv('S3_SECURE')
+
+# количество процессов для формирования xlsx-отчётов и потоков для загрузки файлов в хранилище
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', 4))
+STORAGE_WORKERS = int(os.getenv('STORAGE_WORKERS', 4))
+
+# максимальное количество URL в файле для массового отчёта
+BULK_MAX_URLS = int(os.getenv('BULK_MAX_URLS', 10000))
+
+# количество отчётов, одновременно формируемых одним процессом-воркером
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', 2))
+# максимальное количество отчётов в очереди: при заполненной очереди бот сразу отклоняет новые запросы
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', 200))
+
+# часы (время сервера), в которые воркер заранее формирует отчёты по подпискам: с SUBSCRIPTION_PREPARE_FROM
+# до SUBSCRIPTION_PREPARE_TO, когда нагрузка на API Яндекс Метрики минимальна
+SUBSCRIPTION_PREPARE_FROM = int(os.getenv('SUBSCRIPTION_PREPARE_FROM', 1))
+SUBSCRIPTION_PREPARE_TO = int(os.getenv('SUBSCRIPTION_PREPARE_TO', 7))
+
+# http-сервер метрик воркера в формате Prometheus (GET /metrics); METRICS_PORT=0 - сервер не запускается
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# режим webhook: если WEBHOOK_URL не задан, бот работает в режиме long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
@@ -0,0 +1,92 @@
+import datetime
+from collections import OrderedDict
+
+
+class AccuracySelector:
+    """
+    Выбор начальной точности (sampling) запроса к API Яндекс Метрики.
+    Для каждой пары (счётчик, длительность периода) запоминается наиболее точный уровень, с которым запрос
+    был выполнен успешно, и следующие запросы начинаются с него, не тратя попытки на заведомо неудачные уровни.
+    Чтобы не остаться на пониженной точности навсегда, после probe_after успешных запросов подряд
+    пробуется уровень на одну ступень точнее
+    """
+
+    # верхние границы длительности периода (дней) для группировки запросов
+    period_buckets = (7, 31, 92, 183, 366, 731)
+
+    def __init__(self, levels: list[str], probe_after: int = 20, maxsize: int = 10000):
+        """
+        :param levels: уровни точности от более точного к менее точному
+        :param probe_after: количество успешных запросов подряд, после которого пробуется более точный уровень
+        :param maxsize: максимальное количество запоминаемых пар (счётчик, длительность периода)
+        """
+        self.levels = levels
+        self.probe_after = probe_after
+        self.maxsize = maxsize
+        # (counter, bucket) -> [индекс уровня, успешных запросов подряд на этом уровне]
+        self._known = OrderedDict()
+        # счётчики для мониторинга
+        self.requests = 0
+        self.first_try = 0
+        self.failed_attempts = 0
+
+    def _key(self, counter, date1: str, date2: str) -> tuple:
+        days = (datetime.date.fromisoformat(date2) - datetime.date.fromisoformat(date1)).days + 1
+        bucket = next((i for i, limit in enumerate(self.period_buckets) if days <= limit), len(self.period_buckets))
+        return str(counter), bucket
+
+    def start_level(self, counter, date1: str, date2: str) -> int:
+        """
+        Уровень точности, с которого следует начинать запрос
+        :param counter: № счётчика (или несколько через запятую)
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :return: индекс уровня в levels
+        """
+        known = self._known.get(self._key(counter, date1, date2))
+        if known is None:
+            return 0
+        level, successes = known
+        if successes >= self.probe_after:
+            return max(level - 1, 0)
+        return level
+
+    def record(self, counter, date1: str, date2: str, start: int, level: int | None):
+        """
+        Запоминает результат запроса
+        :param counter: № счётчика (или несколько через запятую)
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :param start: индекс уровня, с которого начат запрос
+        :param level: индекс уровня, с которым запрос выполнен успешно; None - запрос не выполнен
+        :return: None
+        """
+        self.requests += 1
+        if level is None:
+            self.failed_attempts += len(self.levels) - start
+            return
+        self.failed_attempts += level - start
+        if level == start:
+            self.first_try += 1
+
+        key = self._key(counter, date1, date2)
+        known = self._known.get(key)
+        if known is not None and level == known[0]:
+            # после неудачной попытки повысить точность следующая попытка - через probe_after запросов
+            successes = 0 if start < known[0] else known[1] + 1
+        else:
+            successes = 0
+        self._known[key] = [level, successes]
+        self._known.move_to_end(key)
+        while len(self._known) > self.maxsize:
+            self._known.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Статистика выбора точности
+        :return: {'requests': запросов, 'first_try': выполнено с первой попытки, 'hit_rate': доля запросов,
+        выполненных с первой попытки, 'failed_attempts': неудачных попыток, 'known': запомненных пар}
+        """
+        return {'requests': self.requests, 'first_try': self.first_try,
+                'hit_rate': round(self.first_try / self.requests, 3) if self.requests else None,
+                'failed_attempts': self.failed_attempts, 'known': len(self._known)}
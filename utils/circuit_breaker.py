@@ -0,0 +1,168 @@
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from utils.custom_exceptions import ServiceUnavailableError
+from utils.metrics import ym_rejected_total
+
+logger = logging.getLogger(__name__)
+
+
+class CallResult:
+    """
+    Результат вызова, защищённого CircuitBreaker: вызывающий код отмечает неуспешный ответ сервиса
+    """
+
+    def __init__(self):
+        self.failed = False
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель запросов к внешнему сервису (в пределах процесса).
+    closed - запросы выполняются, результаты за последние window секунд учитываются; если за окно выполнено
+    не менее min_calls запросов и доля ошибок не меньше error_rate или доля медленных (дольше slow_call_duration)
+    не меньше slow_call_rate, выключатель размыкается.
+    open - запросы сразу отклоняются с ServiceUnavailableError, не занимая квоту и не ожидая таймаутов.
+    half_open - через open_timeout секунд выполняется не более half_open_probes пробных запросов: успешный пробный
+    запрос замыкает выключатель, неуспешный или медленный снова размыкает
+    """
+
+    def __init__(self, name: str, window: float = 60, min_calls: int = 10, error_rate: float = 0.5,
+                 slow_call_duration: float = 60, slow_call_rate: float = 0.8, open_timeout: float = 30,
+                 half_open_probes: int = 1):
+        """
+        :param name: название сервиса для журнала и сообщения пользователю
+        :param window: окно учёта результатов запросов (сек)
+        :param min_calls: минимальное количество запросов в окне для оценки доли ошибок
+        :param error_rate: доля ошибок, при которой выключатель размыкается
+        :param slow_call_duration: время запроса, начиная с которого запрос считается медленным (сек)
+        :param slow_call_rate: доля медленных запросов, при которой выключатель размыкается
+        :param open_timeout: время до пробных запросов после размыкания (сек)
+        :param half_open_probes: количество одновременных пробных запросов
+        """
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.open_timeout = open_timeout
+        self.half_open_probes = half_open_probes
+        self._state = 'closed'
+        self._opened_at = 0.0
+        # (время завершения, ошибка, медленный) запросов за окно
+        self._calls = deque()
+        self._probes = 0
+        # счётчики для мониторинга
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        """
+        Текущее состояние: closed / open / half_open
+        """
+        if self._state == 'open' and time.monotonic() - self._opened_at >= self.open_timeout:
+            self._state = 'half_open'
+        return self._state
+
+    def retry_after(self) -> int:
+        """
+        Через сколько секунд выключатель пропустит пробный запрос
+        :return: секунды (0 - если запросы не отклоняются)
+        """
+        if self.state != 'open':
+            return 0
+        return max(1, round(self.open_timeout - (time.monotonic() - self._opened_at)))
+
+    def _open(self, reason: str):
+        self._state = 'open'
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self.opened += 1
+        logger.warning(f'Запросы к {self.name} приостановлены на {self.open_timeout} сек: {reason}')
+
+    def _admit(self) -> bool:
+        """
+        Проверяет, можно ли выполнить запрос
+        :return: True - пробный запрос в состоянии half_open
+        """
+        state = self.state
+        if state == 'closed':
+            return False
+        if state == 'half_open' and self._probes < self.half_open_probes:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        ym_rejected_total.inc(reason='circuit_open')
+        raise ServiceUnavailableError(
+            f'{self.name} сейчас не отвечает или отвечает с ошибками. '
+            f'Пожалуйста, повторите запрос через {max(self.retry_after(), 1)} сек.')
+
+    def _record(self, failed: bool, duration: float, probe: bool):
+        slow = duration >= self.slow_call_duration
+        if probe:
+            if failed or slow:
+                self._open('ошибка пробного запроса' if failed else f'пробный запрос выполнялся {duration:.0f} сек')
+            elif self._state == 'half_open':
+                self._state = 'closed'
+                logger.info(f'Запросы к {self.name} возобновлены')
+            return
+        # результаты запросов, начатых до размыкания, не учитываются
+        if self._state != 'closed':
+            return
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        if len(self._calls) < self.min_calls:
+            return
+        failures = sum(call[1] for call in self._calls)
+        slow_calls = sum(call[2] for call in self._calls)
+        if failures >= self.error_rate * len(self._calls):
+            self._open(f'ошибок {failures} из {len(self._calls)} запросов за {self.window} сек')
+        elif slow_calls >= self.slow_call_rate * len(self._calls):
+            self._open(f'медленных запросов {slow_calls} из {len(self._calls)} за {self.window} сек')
+
+    def check(self):
+        """
+        Отклоняет запрос, если выключатель разомкнут (без учёта пробных запросов), например до ожидания квоты
+        :return: None
+        """
+        if self.state == 'open':
+            self._admit()
+
+    @contextmanager
+    def call(self):
+        """
+        Контекстный менеджер одного запроса к сервису: отклоняет запрос при разомкнутом выключателе
+        и учитывает время и результат запроса. Исключение внутри блока считается ошибкой сервиса,
+        ответ с ошибкой отмечается через CallResult.failed
+        :return: CallResult
+        """
+        probe = self._admit()
+        result = CallResult()
+        started = time.monotonic()
+        # отменённый запрос не учитывается
+        completed = False
+        try:
+            yield result
+            completed = True
+        except Exception:
+            result.failed = True
+            completed = True
+            raise
+        finally:
+            if probe:
+                self._probes -= 1
+            if completed:
+                self._record(result.failed, time.monotonic() - started, probe)
+
+    def stats(self) -> dict:
+        """
+        Статистика выключателя
+        :return: {'state': состояние, 'opened': количество размыканий, 'rejected': отклонено запросов}
+        """
+        return {'state': self.state, 'opened': self.opened, 'rejected': self.rejected}
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from database.db import async_session_maker
+from database.models import DomainCounter
+
+logger = logging.getLogger(__name__)
+
+
+class CounterCache:
+    """
+    Кэш соответствия домен -> № счётчика Яндекс Метрики.
+    Таблица ym_domain_counter меняется редко, поэтому кэш целиком загружается при запуске бота
+    и периодически обновляется в фоне. Отсутствующие домены кэшируются на короткое время
+    """
+
+    def __init__(self, ttl: int = 3600, negative_ttl: int = 60, maxsize: int = 10000, refresh_interval: int = 600):
+        """
+        :param ttl: время жизни найденного счётчика (сек)
+        :param negative_ttl: время жизни записи об отсутствующем домене (сек)
+        :param maxsize: максимальное количество доменов в кэше
+        :param refresh_interval: период фонового обновления кэша (сек)
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.refresh_interval = refresh_interval
+        # domain -> (counter, время истечения)
+        self._counters = OrderedDict()
+        # domain -> время истечения
+        self._missing = {}
+        self._refresh_task = None
+
+    def _put(self, domain: str, counter: int):
+        self._counters[domain] = (counter, time.monotonic() + self.ttl)
+        self._counters.move_to_end(domain)
+        self._missing.pop(domain, None)
+        # вытесняем самые давно использованные домены
+        while len(self._counters) > self.maxsize:
+            self._counters.popitem(last=False)
+
+    def _lookup(self, domain: str) -> tuple[bool, int | None]:
+        """
+        Поиск домена в кэше
+        :param domain:
+        :return: (найден ли домен в кэше, № счётчика или None для отсутствующего домена)
+        """
+        now = time.monotonic()
+        cached = self._counters.get(domain)
+        if cached:
+            counter, expires = cached
+            if expires > now:
+                self._counters.move_to_end(domain)
+                return True, counter
+            del self._counters[domain]
+        expires = self._missing.get(domain)
+        if expires:
+            if expires > now:
+                return True, None
+            del self._missing[domain]
+        return False, None
+
+    async def get_many(self, domains) -> dict[str, int | None]:
+        """
+        Получает счётчики для нескольких доменов. Домены, которых нет в кэше, запрашиваются из БД одним запросом
+        :param domains: итерируемый объект с доменами
+        :return: {domain: № счётчика или None}
+        """
+        result = {}
+        not_cached = set()
+        for domain in domains:
+            found, counter = self._lookup(domain)
+            if found:
+                result[domain] = counter
+            else:
+                not_cached.add(domain)
+
+        if not_cached:
+            async with async_session_maker() as session:
+                rows = await session.execute(
+                    select(DomainCounter.domain_name, DomainCounter.counter).where(
+                        DomainCounter.domain_name.in_(not_cached)))
+                rows = rows.all()
+            for domain, counter in rows:
+                self._put(domain, counter)
+                result[domain] = counter
+            for domain in not_cached - {domain for domain, _ in rows}:
+                self._missing[domain] = time.monotonic() + self.negative_ttl
+                result[domain] = None
+        return result
+
+    async def get(self, domain: str) -> int | None:
+        """
+        Получает счётчик для одного домена
+        :param domain:
+        :return: № счётчика или None, если домен не найден
+        """
+        counters = await self.get_many((domain,))
+        return counters[domain]
+
+    async def warm(self):
+        """
+        Загружает в кэш всю таблицу ym_domain_counter одним запросом
+        :return: None
+        """
+        async with async_session_maker() as session:
+            rows = await session.execute(select(DomainCounter.domain_name, DomainCounter.counter))
+            rows = rows.all()
+        self._missing.clear()
+        for domain, counter in rows:
+            self._put(domain, counter)
+        logger.info(f'Кэш счётчиков обновлён. Доменов: {len(rows)}')
+
+    def invalidate(self, domain: str = None):
+        """
+        Сбрасывает кэш для одного домена или полностью
+        :param domain: домен; если не передан - кэш очищается полностью
+        :return: None
+        """
+        if domain is None:
+            self._counters.clear()
+            self._missing.clear()
+        else:
+            self._counters.pop(domain, None)
+            self._missing.pop(domain, None)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception('Ошибка фонового обновления кэша счётчиков')
+
+    async def start(self):
+        """
+        Прогревает кэш и запускает его фоновое обновление
+        :return: None
+        """
+        await self.warm()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        """
+        Останавливает фоновое обновление кэша
+        :return: None
+        """
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+
+counter_cache = CounterCache()
@@ -16,10 +16,12 @@ class IncorrectUrl(Exception):
 
 
 class MaxCountUrlError(Exception):
-    def __init__(self, url_count):
+    def __init__(self, url_count, max_count=20):
         self.url_count = url_count
+        self.max_count = max_count
         self.message = f'Превышено максимально допустимое количество одновременно обрабатываемых URL.' \
-                       f'\n\n<u>Максимально допустимое количесво URL за один запрос = 20. Получено {self.url_count}</u>.'
+                       f'\n\n<u>Максимально допустимое количесво URL за один запрос = {self.max_count}. ' \
+                       f'Получено {self.url_count}</u>.'
 
     def __str__(self):
         return self.message
@@ -32,3 +34,8 @@ class BadRequestError(Exception):
 
     def __str__(self):
         return self.message
+
+
+class ServiceUnavailableError(BadRequestError):
+    def __init__(self, message='API Яндекс Метрики временно недоступно. Пожалуйста, повторите запрос позднее.'):
+        self.message = message
@@ -0,0 +1,77 @@
+import datetime
+import logging
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.db import async_session_maker
+from database.models import DailyStatistic
+
+logger = logging.getLogger(__name__)
+
+# аддитивные метрики за день в порядке хранения
+DAILY_COLUMNS = ['visits', 'page_views', 'visit_duration', 'bounces', 'new_visits']
+
+
+class DailyStatStore:
+    """
+    Хранилище аддитивных метрик по URL за каждый завершившийся день (таблица daily_statistic).
+    Позволяет для повторяющихся запросов "с даты начала по сегодня" запрашивать у API только недостающие дни
+    """
+
+    async def get_days(self, counter: int, urls, date1: datetime.date,
+                       date2: datetime.date) -> dict[str, dict[datetime.date, list]]:
+        """
+        Получает сохранённые метрики по дням
+        :param counter: № счётчика
+        :param urls: очищенные URL
+        :param date1: первый день периода
+        :param date2: последний день периода
+        :return: {url: {день: метрики в порядке DAILY_COLUMNS}}
+        """
+        days = {url: {} for url in urls}
+        if date1 > date2:
+            return days
+        try:
+            async with async_session_maker() as session:
+                rows = await session.execute(select(DailyStatistic).where(
+                    DailyStatistic.counter == counter,
+                    DailyStatistic.url.in_(days.keys()),
+                    DailyStatistic.day.between(date1, date2)
+                ))
+                rows = rows.scalars().all()
+        except SQLAlchemyError:
+            logger.exception('Ошибка чтения статистики по дням')
+            return days
+        for row in rows:
+            days[row.url][row.day] = [getattr(row, column) for column in DAILY_COLUMNS]
+        return days
+
+    async def save_days(self, counter: int, url_days: dict[str, dict[datetime.date, list]]):
+        """
+        Сохраняет метрики по дням (существующие записи перезаписываются)
+        :param counter: № счётчика
+        :param url_days: {url: {день: метрики в порядке DAILY_COLUMNS}}
+        :return: None
+        """
+        now = datetime.datetime.now()
+        values = [dict(counter=counter, url=url, day=day, created_at=now, **dict(zip(DAILY_COLUMNS, metrics)))
+                  for url, days in url_days.items() for day, metrics in days.items()]
+        if not values:
+            return
+        try:
+            async with async_session_maker() as session:
+                # ограничение количества параметров в одном запросе asyncpg (32767)
+                for i in range(0, len(values), 2000):
+                    stmt = insert(DailyStatistic).values(values[i:i + 2000])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=['counter', 'url', 'day'],
+                        set_={column: stmt.excluded[column] for column in DAILY_COLUMNS + ['created_at']})
+                    await session.execute(stmt)
+                await session.commit()
+        except SQLAlchemyError:
+            logger.exception('Ошибка записи статистики по дням')
+
+
+daily_store = DailyStatStore()
@@ -0,0 +1,111 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+# классы запросов от более приоритетного к менее приоритетному: interactive - небольшие отчёты, которых пользователь
+# ждёт в чате, bulk - массовые отчёты, background - заблаговременное формирование отчётов по подпискам
+PRIORITIES = ['interactive', 'bulk', 'background']
+
+# отчёт, для которого выполняется запрос к API: (ключ очереди - ID пользователя, класс запроса).
+# Устанавливается на время формирования отчёта и наследуется задачами, созданными при его формировании
+current_client: ContextVar[tuple | None] = ContextVar('current_client', default=None)
+
+
+class FairScheduler:
+    """
+    Справедливое распределение capacity одновременных запросов к API между отчётами разных пользователей.
+    Если свободных мест нет, запрос встаёт в очередь своего пользователя; освободившееся место получает следующий
+    по кругу пользователь, поэтому массовый отчёт одного пользователя не задерживает небольшие запросы других
+    пользователей на всё время своего формирования. Запросы класса interactive обслуживаются раньше bulk, но после
+    interactive_weight подряд выданных мест одно место получает ожидающий bulk, чтобы массовые отчёты
+    не простаивали; background получает место, только если других запросов нет
+    """
+
+    def __init__(self, capacity: int, interactive_weight: int = 4):
+        """
+        :param capacity: количество одновременных запросов
+        :param interactive_weight: сколько мест подряд могут получить запросы interactive при ожидающих bulk
+        """
+        self.capacity = capacity
+        self.interactive_weight = interactive_weight
+        self._active = 0
+        # класс запроса -> {пользователь: очередь ожидающих запросов}; порядок пользователей - порядок обхода
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._interactive_streak = 0
+        # счётчики для мониторинга
+        self.granted = dict.fromkeys(PRIORITIES, 0)
+        self.queued = 0
+
+    def _next_priority(self) -> str | None:
+        interactive, bulk = bool(self._queues['interactive']), bool(self._queues['bulk'])
+        if interactive and not (bulk and self._interactive_streak >= self.interactive_weight):
+            # считаются только места, полученные в обход ожидающих bulk
+            self._interactive_streak = self._interactive_streak + 1 if bulk else 0
+            return 'interactive'
+        if bulk:
+            self._interactive_streak = 0
+            return 'bulk'
+        if self._queues['background']:
+            return 'background'
+        return None
+
+    def _release(self):
+        """
+        Передаёт освободившееся место следующему ожидающему запросу или освобождает его
+        :return: None
+        """
+        priority = self._next_priority()
+        if priority is None:
+            self._active -= 1
+            return
+        queues = self._queues[priority]
+        # первый по кругу пользователь получает место и перемещается в конец обхода
+        user, waiters = queues.popitem(last=False)
+        waiter = waiters.popleft()
+        if waiters:
+            queues[user] = waiters
+        self.granted[priority] += 1
+        waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Контекстный менеджер места для одного запроса к API. Пользователь и класс запроса берутся из current_client
+        (без него запрос считается массовым запросом общего пользователя)
+        :return: None
+        """
+        user, priority = current_client.get() or (None, 'bulk')
+        if self._active < self.capacity and not any(self._queues.values()):
+            self._active += 1
+            self.granted[priority] += 1
+        else:
+            self.queued += 1
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self._queues[priority].setdefault(user, deque())
+            waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # место было передано отменённому запросу - передаётся следующему
+                    self._release()
+                else:
+                    waiters.remove(waiter)
+                    if not waiters and self._queues[priority].get(user) is waiters:
+                        del self._queues[priority][user]
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        """
+        Статистика распределения мест
+        :return: {'active': выполняется запросов, 'waiting': ожидают по классам, 'queued': запросов ожидали места,
+        'granted': выдано мест по классам}
+        """
+        waiting = {priority: sum(len(waiters) for waiters in queues.values())
+                   for priority, queues in self._queues.items()}
+        return {'active': self._active, 'waiting': waiting, 'queued': self.queued, 'granted': dict(self.granted)}
@@ -0,0 +1,114 @@
+import logging
+
+import aiohttp
+
+from settings import HTTP_POOL_SIZE, HTTP_KEEPALIVE, HTTP_DNS_TTL, HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    http-сессия для запросов к API Яндекс Метрики на всё время работы процесса.
+    Соединения переиспользуются между запросами (keep-alive), результаты DNS-запросов кэшируются,
+    поэтому повторные запросы не тратят время на DNS и TLS-рукопожатие
+    """
+
+    def __init__(self, pool_size: int = 10, keepalive: float = 60, dns_ttl: int = 300, connect_timeout: float = 10,
+                 timeout: float = 300):
+        """
+        :param pool_size: максимальное количество одновременных соединений
+        :param keepalive: время хранения неиспользуемого соединения (сек)
+        :param dns_ttl: время кэширования результатов DNS-запросов (сек)
+        :param connect_timeout: максимальное время установки соединения (сек)
+        :param timeout: максимальное время выполнения запроса (сек)
+        """
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._session = None
+        # счётчики для мониторинга
+        self.in_use = 0
+        self.waits = 0
+        self.created = 0
+        self.reused = 0
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self.in_use += 1
+
+        async def on_request_end(session, context, params):
+            self.in_use -= 1
+
+        async def on_connection_queued_start(session, context, params):
+            # все соединения пула заняты, запрос ожидает освобождения соединения
+            self.waits += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.reused += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_end)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def start(self):
+        """
+        Создаёт http-сессию
+        :return: None
+        """
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size,
+                                         keepalive_timeout=self.keepalive, ttl_dns_cache=self.dns_ttl)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout),
+            trace_configs=[self._trace_config()])
+        logger.info(f'http-сессия создана, соединений: {self.pool_size}')
+
+    async def close(self):
+        """
+        Закрывает http-сессию и все соединения
+        :return: None
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            logger.info(f'http-сессия закрыта: {self.stats()}')
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        http-сессия; должна быть создана через start() при запуске процесса
+        """
+        if self._session is None or self._session.closed:
+            raise RuntimeError('http-сессия не создана: вызовите http_client.start() при запуске')
+        return self._session
+
+    def stats(self) -> dict:
+        """
+        Статистика пула соединений
+        :return: {'in_use': выполняется запросов, 'idle': свободных соединений в пуле, 'waits': ожиданий
+        свободного соединения, 'created': создано соединений, 'reused': запросов по открытому соединению}
+        """
+        idle = 0
+        if self._session is not None:
+            # у TCPConnector нет публичного счётчика свободных соединений
+            idle = sum(len(conns) for conns in getattr(self._session.connector, '_conns', {}).values())
+        return {'in_use': self.in_use, 'idle': idle, 'waits': self.waits, 'created': self.created,
+                'reused': self.reused}
+
+
+http_client = HttpClient(pool_size=HTTP_POOL_SIZE, keepalive=HTTP_KEEPALIVE, dns_ttl=HTTP_DNS_TTL,
+                         connect_timeout=HTTP_CONNECT_TIMEOUT, timeout=HTTP_TIMEOUT)
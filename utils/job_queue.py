@@ -0,0 +1,109 @@
+import datetime
+
+from sqlalchemy import select, update, or_, and_, func
+from sqlalchemy.dialects.postgresql import insert
+
+from database.db import async_session_maker
+from database.models import ReportJob
+from utils.url_processing import urls_to_json, urls_from_json
+
+
+class JobQueue:
+    """
+    Очередь задач формирования отчётов в таблице report_job.
+    Задачу забирает один воркер (SELECT ... FOR UPDATE SKIP LOCKED) и периодически продлевает отметку locked_at.
+    Если воркер упал, по истечении lease секунд задача снова становится доступной другим воркерам
+    """
+
+    def __init__(self, lease: int = 120, max_attempts: int = 3):
+        """
+        :param lease: время (сек), после которого задача без подтверждения обработки считается брошенной
+        :param max_attempts: максимальное количество попыток обработки задачи
+        """
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    async def enqueue(self, request_id: int, payload: dict):
+        """
+        Добавляет задачу в очередь (повторная постановка задачи с тем же request_id перезапускает её)
+        :param request_id: № запроса в RequestsLog
+        :param payload: параметры отчёта
+        :return: None
+        """
+        # URL хранятся списком пар, чтобы сохранить их порядок в JSONB
+        payload = {**payload, 'urls': urls_to_json(payload['urls'])}
+        now = datetime.datetime.now()
+        stmt = insert(ReportJob).values(request_id=request_id, status='queued', payload=payload, attempts=0,
+                                        created_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReportJob.request_id],
+            set_={'status': 'queued', 'payload': payload, 'attempts': 0, 'worker': None, 'locked_at': None,
+                  'created_at': now, 'finished_at': None})
+        async with async_session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def depth(self, limit: int) -> int:
+        """
+        Количество задач, ожидающих обработки (подсчёт останавливается на limit)
+        :param limit: максимальное значение, до которого ведётся подсчёт
+        :return: количество задач в очереди, не больше limit
+        """
+        queued = select(ReportJob.request_id).where(ReportJob.status == 'queued').limit(limit).subquery()
+        async with async_session_maker() as session:
+            count = await session.execute(select(func.count()).select_from(queued))
+            return count.scalar_one()
+
+    async def claim(self, worker: str) -> ReportJob | None:
+        """
+        Забирает в обработку самую старую задачу из очереди или брошенную упавшим воркером задачу
+        :param worker: идентификатор воркера
+        :return: задача или None, если очередь пуста
+        """
+        now = datetime.datetime.now()
+        job_id = select(ReportJob.request_id).where(or_(
+            ReportJob.status == 'queued',
+            and_(ReportJob.status == 'running', ReportJob.locked_at < now - datetime.timedelta(seconds=self.lease))
+        )).order_by(ReportJob.created_at).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        stmt = update(ReportJob).where(ReportJob.request_id == job_id).values(
+            status='running', worker=worker, locked_at=now, attempts=ReportJob.attempts + 1).returning(ReportJob)
+        async with async_session_maker() as session:
+            job = await session.execute(stmt)
+            job = job.scalar_one_or_none()
+            await session.commit()
+        return job
+
+    @staticmethod
+    def payload(job: ReportJob) -> dict:
+        """
+        Параметры отчёта задачи в том виде, в котором они были переданы в enqueue
+        :param job: задача
+        :return: параметры отчёта ({raw_url: cleaned_url} в порядке URL запроса)
+        """
+        return {**job.payload, 'urls': urls_from_json(job.payload['urls'])}
+
+    async def heartbeat(self, request_id: int, worker: str):
+        """
+        Подтверждает, что задача всё ещё обрабатывается воркером
+        :return: None
+        """
+        async with async_session_maker() as session:
+            await session.execute(update(ReportJob).where(
+                ReportJob.request_id == request_id, ReportJob.worker == worker
+            ).values(locked_at=datetime.datetime.now()))
+            await session.commit()
+
+    async def finish(self, request_id: int, status: str = 'done'):
+        """
+        Завершает задачу
+        :param request_id: № запроса в RequestsLog
+        :param status: done / failed
+        :return: None
+        """
+        async with async_session_maker() as session:
+            await session.execute(update(ReportJob).where(ReportJob.request_id == request_id).values(
+                status=status, finished_at=datetime.datetime.now()))
+            await session.commit()
+
+
+job_queue = JobQueue()
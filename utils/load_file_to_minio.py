@@ -1,3 +1,5 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from io import BytesIO
 
@@ -8,8 +10,10 @@ from settings import (
     MINIO_SECURE,
     OUTER_ENDPOINT_URL,
     SECRET_KEY,
+    STORAGE_WORKERS,
 )
 from minio import Minio
+from minio.error import S3Error
 
 
 class MyStorage:
@@ -20,6 +24,7 @@ class MyStorage:
             secret_key: str,
             bucket_name,
             secure: bool = False,
+            max_workers: int = STORAGE_WORKERS,
     ):
         self.client = Minio(
             endpoint=endpoint,
@@ -27,6 +32,8 @@ class MyStorage:
             secret_key=secret_key,
             secure=secure,  # отключение подключения по HTTPS
         )
+        # пул потоков для блокирующих вызовов клиента MinIO
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='minio')
         print("Подключение к хранилищу успешно")
 
     def upload_file(
@@ -41,11 +48,85 @@ class MyStorage:
         """
         self.client.fput_object(bucket_name, file_name, file_path)
 
+    async def upload_file_async(
+            self, file_name: str, file_path: str, bucket_name: str = BUCKET_NAME
+    ):
+        """
+        Загрузка файла с диска в S3-хранилище в пуле потоков, без блокировки цикла событий
+        :param file_name:
+        :param file_path:
+        :param bucket_name:
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.upload_file, file_name, file_path, bucket_name)
+
+    def object_exists(self, file_name: str, bucket_name: str = BUCKET_NAME) -> bool:
+        """
+        Проверка наличия файла в S3-хранилище
+        :param file_name:
+        :param bucket_name:
+        :return: True, если файл есть в хранилище
+        """
+        try:
+            self.client.stat_object(bucket_name, file_name)
+        except S3Error as err:
+            if err.code in ('NoSuchKey', 'NoSuchObject'):
+                return False
+            raise
+        return True
+
+    async def object_exists_async(self, file_name: str, bucket_name: str = BUCKET_NAME) -> bool:
+        """
+        Проверка наличия файла в S3-хранилище в пуле потоков, без блокировки цикла событий
+        :param file_name:
+        :param bucket_name:
+        :return: True, если файл есть в хранилище
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.object_exists, file_name, bucket_name)
+
+    def download_file(self, file_name: str, file_path: str, bucket_name: str = BUCKET_NAME):
+        """
+        Скачивание файла из S3-хранилища на диск
+        :param file_name:
+        :param file_path:
+        :param bucket_name:
+        :return: None
+        """
+        self.client.fget_object(bucket_name, file_name, file_path)
+
+    async def download_file_async(self, file_name: str, file_path: str, bucket_name: str = BUCKET_NAME):
+        """
+        Скачивание файла из S3-хранилища на диск в пуле потоков, без блокировки цикла событий
+        :param file_name:
+        :param file_path:
+        :param bucket_name:
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.download_file, file_name, file_path, bucket_name)
+
     def upload_memory_file(
             self, file_name: str, data: BytesIO, length: int, bucket_name: str = BUCKET_NAME
     ):
         self.client.put_object(bucket_name, file_name, data, length)
 
+    async def upload_memory_file_async(
+            self, file_name: str, data: BytesIO, length: int, bucket_name: str = BUCKET_NAME
+    ):
+        """
+        Загрузка файла из памяти в S3-хранилище в пуле потоков, без блокировки цикла событий.
+        Одновременно выполняется не более max_workers загрузок
+        :param file_name:
+        :param data:
+        :param length:
+        :param bucket_name:
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.upload_memory_file, file_name, data, length, bucket_name)
+
     def share_file_from_bucket(
             self, file_name, expire=timedelta(seconds=60), bucket_name=BUCKET_NAME
     ):
@@ -1,7 +1,4 @@
-from database.models import RequestsLog
-from sqlalchemy.ext.asyncio import AsyncSession
-from database.db import async_session_maker
-from sqlalchemy import update
+from utils.request_log import request_log
 from utils.url_processing import IncorrectUrl, BadRequestError, MaxCountUrlError
 from aiogram.types import Message
 
@@ -17,9 +14,14 @@ def error_logging(func):
 
 
 async def write_error_to_db(request_id: int, trace: str, unexpected=False):
-    async with async_session_maker() as session:
-        if unexpected:
-            await session.execute(update(RequestsLog).where(RequestsLog.id == request_id).values(error_msg=trace, status='unexpected_error'))
-        else:
-            await session.execute(update(RequestsLog).where(RequestsLog.id == request_id).values(error_msg=trace))
-        await session.commit()
+    """
+    Записывает ошибку обработки запроса в RequestsLog (через буфер request_log, без ожидания записи в БД)
+    :param request_id: № запроса в RequestsLog
+    :param trace: текст ошибки
+    :param unexpected: непредвиденная ошибка
+    :return: None
+    """
+    if unexpected:
+        request_log.update(request_id, error_msg=trace, status='unexpected_error')
+    else:
+        request_log.update(request_id, error_msg=trace)
@@ -0,0 +1,143 @@
+import bisect
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# границы интервалов гистограмм длительности (сек)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    """
+    Счётчик в формате Prometheus: монотонно возрастающее значение для каждого набора меток
+    """
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        # (метки) -> значение
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus: количество наблюдений по интервалам, сумма и количество наблюдений
+    для каждого набора меток
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # (метки) -> [количество наблюдений по интервалам, сумма, количество]
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for labels, (bucket_counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(labels, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            bucket_labels = _format_labels(labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {round(total, 6)}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса в текстовом формате Prometheus, доступные по http (GET /metrics)
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._runner = None
+
+    def counter(self, name: str, description: str) -> Counter:
+        metric = Counter(name, description)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, description, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Все метрики в текстовом формате Prometheus
+        :return: текст ответа /metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    async def start_server(self, host: str, port: int):
+        """
+        Запускает http-сервер метрик
+        :param host: адрес сервера (для локального сбора метрик - 127.0.0.1)
+        :param port: порт сервера
+        :return: None
+        """
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=host, port=port).start()
+        logger.info(f'Метрики доступны по адресу http://{host}:{port}/metrics')
+
+    async def stop_server(self):
+        """
+        Останавливает http-сервер метрик
+        :return: None
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = MetricsRegistry()
+
+report_seconds = metrics.histogram('report_seconds', 'Время формирования отчёта')
+report_stage_seconds = metrics.histogram('report_stage_seconds', 'Время этапов формирования отчёта')
+ym_request_seconds = metrics.histogram('ym_request_seconds', 'Время выполнения http-запроса к API Яндекс Метрики')
+ym_requests_total = metrics.counter('ym_requests_total', 'Количество http-запросов к API Яндекс Метрики')
+ym_response_bytes_total = metrics.counter('ym_response_bytes_total', 'Объём ответов API Яндекс Метрики (байт)')
+ym_rejected_total = metrics.counter('ym_rejected_total', 'Количество отклонённых без выполнения запросов к API Яндекс Метрики')
@@ -0,0 +1,194 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select, update, func, or_, and_, exists, case, extract, literal
+from sqlalchemy.dialects.postgresql import insert
+
+from database.db import async_session_maker
+from database.models import YMQuotaToken, YMQuotaSlot
+from settings import YM_TOKENS, YM_MAX_PARALLEL, YM_RATE_LIMIT
+from utils.fair_scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaGovernor:
+    """
+    Ограничение нагрузки на API Яндекс Метрики, общее для всех процессов бота и воркеров:
+    - не более max_parallel одновременных запросов на токен (слоты с арендой в таблице ym_quota_slot);
+    - не более rate запросов в секунду на токен (время следующего запроса резервируется в таблице ym_quota_token);
+    - после ответа 429 запросы по токену приостанавливаются с экспоненциально растущей паузой.
+    Токены используются по кругу, запрос получает первый токен со свободным слотом.
+    Между отчётами разных пользователей одного процесса запросы распределяются по очереди (см. FairScheduler).
+    Запросы не отклоняются: один отчёт может ожидать разрешения на сотни запросов (по частям периода и URL),
+    поэтому нагрузка ограничивается при постановке отчёта в очередь (MAX_QUEUED_JOBS).
+    Все отметки времени берутся из БД, поэтому расхождение часов серверов не влияет на ограничения
+    """
+
+    def __init__(self, tokens: list[str], max_parallel: int = 5, rate: float = 10, lease: int = 300,
+                 poll_interval: float = 0.2, max_backoff: int = 60):
+        """
+        :param tokens: OAuth-токены API Яндекс Метрики
+        :param max_parallel: максимальное количество одновременных запросов на токен
+        :param rate: максимальное количество запросов в секунду на токен
+        :param lease: время (сек), после которого слот не освобождённый упавшим процессом считается свободным
+        :param poll_interval: период повторной попытки занять слот, если свободных слотов нет (сек)
+        :param max_backoff: максимальная пауза после ответа 429 (сек)
+        """
+        self.tokens = list(tokens)
+        self.keys = {token: hashlib.sha256(token.encode()).hexdigest()[:16] for token in self.tokens}
+        self.max_parallel = max_parallel
+        self.rate = rate
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._process = f'{socket.gethostname()}:{os.getpid()}'
+        # индекс токена, с которого начинается поиск свободного слота
+        self._next = 0
+        # в процессе не может выполняться больше запросов, чем слотов во всём пуле;
+        # места распределяются между пользователями по очереди, а не в порядке поступления запросов
+        self._local = FairScheduler(max(len(self.tokens), 1) * max_parallel)
+        self._ready = False
+        # запросы, ожидающие разрешения
+        self._waiting = 0
+        # счётчики для мониторинга
+        self.waits = 0
+        self.throttled = 0
+
+    async def _ensure_rows(self):
+        """
+        Создаёт строки токенов и слотов в БД при первом обращении
+        :return: None
+        """
+        if self._ready:
+            return
+        if not self.tokens:
+            raise RuntimeError('Не задан ни один токен API Яндекс Метрики (YM_TOKEN / YM_TOKENS)')
+        async with async_session_maker() as session:
+            await session.execute(insert(YMQuotaToken).values([
+                dict(token_key=key, next_request_at=datetime.datetime.now(), throttled=0)
+                for key in self.keys.values()]).on_conflict_do_nothing())
+            await session.execute(insert(YMQuotaSlot).values([
+                dict(token_key=key, slot=slot) for key in self.keys.values()
+                for slot in range(self.max_parallel)]).on_conflict_do_nothing())
+            await session.commit()
+        self._ready = True
+
+    async def _claim(self, key: str, holder: str) -> tuple[int, float] | None:
+        """
+        Занимает свободный слот токена, если запросы по токену не приостановлены, и резервирует время запроса
+        с учётом ограничения частоты - одним запросом к БД
+        :param key: хэш токена
+        :param holder: идентификатор запроса
+        :return: (№ слота, сколько секунд нужно подождать до начала запроса) или None, если свободных слотов нет
+        """
+        interval = datetime.timedelta(seconds=1 / self.rate)
+        now = func.localtimestamp()
+        blocked = exists().where(YMQuotaToken.token_key == key, YMQuotaToken.blocked_until > now)
+        free_slot = select(YMQuotaSlot.slot).where(
+            YMQuotaSlot.token_key == key,
+            YMQuotaSlot.slot < self.max_parallel,
+            or_(YMQuotaSlot.holder.is_(None), YMQuotaSlot.expires_at < now),
+            ~blocked
+        ).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        claimed = update(YMQuotaSlot).where(YMQuotaSlot.token_key == key, YMQuotaSlot.slot == free_slot).values(
+            holder=holder, expires_at=now + datetime.timedelta(seconds=self.lease)
+        ).returning(YMQuotaSlot.slot).cte('claimed')
+        # время резервируется, только если слот занят
+        reserved = update(YMQuotaToken).where(YMQuotaToken.token_key == key, exists(select(claimed.c.slot))).values(
+            next_request_at=func.greatest(YMQuotaToken.next_request_at, YMQuotaToken.blocked_until, now) + interval
+        ).returning(extract('epoch', YMQuotaToken.next_request_at - now).label('wait')).cte('reserved')
+        async with async_session_maker() as session:
+            row = await session.execute(select(claimed.c.slot, reserved.c.wait))
+            row = row.one_or_none()
+            await session.commit()
+        if row is None:
+            return None
+        return row.slot, float(row.wait) - interval.total_seconds()
+
+    async def _release(self, key: str, slot: int, holder: str):
+        async with async_session_maker() as session:
+            await session.execute(update(YMQuotaSlot).where(
+                YMQuotaSlot.token_key == key, YMQuotaSlot.slot == slot, YMQuotaSlot.holder == holder
+            ).values(holder=None, expires_at=None))
+            await session.commit()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Контекстный менеджер разрешения на один запрос к API: ожидает свободный слот одного из токенов
+        и допустимое по частоте время запроса
+        :return: OAuth-токен, с которым нужно выполнить запрос
+        """
+        self._waiting += 1
+        waiting = True
+        try:
+            async with self._local.slot():
+                await self._ensure_rows()
+                holder = f'{self._process}:{uuid.uuid4().hex}'
+                while True:
+                    for i in range(len(self.tokens)):
+                        token = self.tokens[(self._next + i) % len(self.tokens)]
+                        claimed = await self._claim(self.keys[token], holder)
+                        if claimed is not None:
+                            slot, wait = claimed
+                            break
+                    else:
+                        self.waits += 1
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+                    break
+                self._next = (self.tokens.index(token) + 1) % len(self.tokens)
+                self._waiting -= 1
+                waiting = False
+
+                try:
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    yield token
+                finally:
+                    # слот освобождается и при отмене запроса
+                    await asyncio.shield(self._release(self.keys[token], slot, holder))
+        finally:
+            if waiting:
+                self._waiting -= 1
+
+    async def throttle(self, token: str, retry_after: float = None):
+        """
+        Приостанавливает запросы по токену после ответа 429. Пауза удваивается при повторных ответах 429
+        (но не больше max_backoff) и сбрасывается, если ответов 429 не было дольше max_backoff
+        :param token: токен, по которому получен ответ 429
+        :param retry_after: пауза, указанная в ответе API (сек)
+        :return: None
+        """
+        self.throttled += 1
+        now = func.localtimestamp()
+        throttled = case(
+            (YMQuotaToken.blocked_until < now - datetime.timedelta(seconds=self.max_backoff), 1),
+            else_=YMQuotaToken.throttled + 1)
+        if retry_after:
+            backoff = literal(datetime.timedelta(seconds=retry_after))
+        else:
+            backoff = literal(datetime.timedelta(seconds=1)) * func.least(self.max_backoff, func.power(2, throttled - 1))
+        async with async_session_maker() as session:
+            await session.execute(update(YMQuotaToken).where(YMQuotaToken.token_key == self.keys[token]).values(
+                throttled=throttled, blocked_until=now + backoff))
+            await session.commit()
+
+    def stats(self) -> dict:
+        """
+        Статистика ограничения запросов в текущем процессе
+        :return: {'tokens': токенов в пуле, 'waits': ожиданий свободного слота, 'throttled': получено ответов 429,
+        'waiting': запросов ожидают разрешения, 'scheduler': распределение запросов между пользователями}
+        """
+        return {'tokens': len(self.tokens), 'waits': self.waits, 'throttled': self.throttled,
+                'waiting': self._waiting, 'scheduler': self._local.stats()}
+
+
+quota_governor = QuotaGovernor(YM_TOKENS, max_parallel=YM_MAX_PARALLEL, rate=YM_RATE_LIMIT)
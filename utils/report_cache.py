@@ -0,0 +1,97 @@
+import datetime
+import hashlib
+import json
+import logging
+import time
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.db import async_session_maker
+from database.models import ReportFile
+
+logger = logging.getLogger(__name__)
+
+# версия формата отчёта: при изменении содержимого или оформления отчёта ранее сформированные файлы не используются
+REPORT_VERSION = 2
+
+
+class ReportCache:
+    """
+    Повторное использование сформированных отчётов. Отчёт хранится в S3-хранилище под ключом из хэша параметров
+    (URL, период, заголовок, версия данных), поэтому одинаковые отчёты не формируются и не загружаются повторно,
+    а пользователю отправляется file_id ранее отправленного в telegram файла.
+    Данные за периоды, закончившиеся до сегодняшнего дня, не меняются; отчёт за период, включающий сегодняшний день,
+    используется повторно не дольше open_period_ttl
+    """
+
+    def __init__(self, open_period_ttl: int = 900, prefix: str = 'bot_tg_urls_stats/reports'):
+        """
+        :param open_period_ttl: время повторного использования отчёта за период, включающий сегодняшний день (сек)
+        :param prefix: каталог отчётов в S3-хранилище
+        """
+        self.open_period_ttl = open_period_ttl
+        self.prefix = prefix
+
+    def key(self, job: dict) -> str:
+        """
+        Хэш параметров отчёта
+        :param job: параметры задачи (urls, date1, date2, header)
+        :return: sha256 в шестнадцатеричном виде
+        """
+        date1, date2 = job.get('date1'), job.get('date2')
+        version = [REPORT_VERSION]
+        if date2 is None or datetime.date.fromisoformat(date2) >= datetime.date.today():
+            # данные за незавершившийся период меняются: отчёт действует до конца текущего интервала
+            version.append(int(time.time() // self.open_period_ttl))
+        # порядок URL сохраняется: строки отчёта следуют в порядке URL запроса
+        params = json.dumps([list(job['urls'].items()), date1, date2, job['header'], version], ensure_ascii=False)
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def s3_file_path(self, key: str) -> str:
+        """
+        Путь к отчёту в S3-хранилище
+        :param key: хэш параметров отчёта
+        :return: путь
+        """
+        return f'{self.prefix}/{key}.xlsx'
+
+    async def get(self, key: str) -> ReportFile | None:
+        """
+        Ранее сформированный отчёт. Ошибка БД не прерывает формирование отчёта
+        :param key: хэш параметров отчёта
+        :return: ReportFile или None
+        """
+        try:
+            async with async_session_maker() as session:
+                report = await session.execute(select(ReportFile).where(ReportFile.report_hash == key))
+                return report.scalar()
+        except SQLAlchemyError:
+            logger.exception('Ошибка чтения сформированных отчётов')
+            return None
+
+    async def save(self, key: str, s3_file_path: str, telegram_file_id: str = None):
+        """
+        Сохраняет сформированный отчёт. Ранее сохранённый file_id не заменяется пустым значением
+        :param key: хэш параметров отчёта
+        :param s3_file_path: путь к отчёту в S3-хранилище
+        :param telegram_file_id: file_id отправленного в telegram файла
+        :return: None
+        """
+        statement = insert(ReportFile).values(report_hash=key, s3_file_path=s3_file_path,
+                                              telegram_file_id=telegram_file_id, created_at=func.localtimestamp())
+        statement = statement.on_conflict_do_update(
+            index_elements=[ReportFile.report_hash],
+            set_={'s3_file_path': statement.excluded.s3_file_path,
+                  'telegram_file_id': func.coalesce(statement.excluded.telegram_file_id,
+                                                    ReportFile.telegram_file_id)})
+        try:
+            async with async_session_maker() as session:
+                await session.execute(statement)
+                await session.commit()
+        except SQLAlchemyError:
+            logger.exception('Ошибка сохранения сформированного отчёта')
+
+
+report_cache = ReportCache()
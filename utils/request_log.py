@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.db import async_session_maker
+from database.models import RequestsLog
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLogWriter:
+    """
+    Буферизованная запись изменений RequestsLog (статус, текст ошибки, путь к файлу в хранилище).
+    Изменения накапливаются в памяти и записываются пачкой в одной транзакции, когда накопится max_batch запросов
+    или пройдёт flush_interval, поэтому запись лога не задерживает ответ пользователю.
+    При остановке процесса оставшиеся изменения записываются
+    """
+
+    def __init__(self, max_batch: int = 100, flush_interval: float = 1):
+        """
+        :param max_batch: количество изменённых запросов, при котором запись выполняется сразу
+        :param flush_interval: максимальное время хранения изменений в памяти (сек)
+        """
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        # request_id -> {поле: значение}
+        self._pending = {}
+        self._full = asyncio.Event()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        # счётчики для мониторинга
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+
+    def update(self, request_id: int, **values):
+        """
+        Добавляет изменение запроса в буфер. Более поздние значения полей заменяют более ранние
+        :param request_id: № запроса в RequestsLog
+        :param values: поля RequestsLog и их значения
+        :return: None
+        """
+        self._pending.setdefault(request_id, {}).update(values)
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    async def _write(self, session, rows: list[dict]):
+        # bulk update по первичному ключу: строки с одинаковым набором полей - одним выражением
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            await session.execute(update(RequestsLog), group)
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения в БД одной транзакцией. Если пачку записать не удалось,
+        изменения записываются по одному, а не записанные отбрасываются с записью в журнал
+        :return: None
+        """
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            self._full.clear()
+            if not pending:
+                return
+            rows = [{'id': request_id, **values} for request_id, values in pending.items()]
+            try:
+                async with async_session_maker() as session:
+                    await self._write(session, rows)
+                    await session.commit()
+                self.written += len(rows)
+            except SQLAlchemyError:
+                logger.exception(f'Ошибка записи изменений RequestsLog ({len(rows)} запросов), запись по одному')
+                for row in rows:
+                    try:
+                        async with async_session_maker() as session:
+                            await self._write(session, [row])
+                            await session.commit()
+                        self.written += 1
+                    except SQLAlchemyError:
+                        self.dropped += 1
+                        logger.exception(f'Не удалось записать изменения запроса {row["id"]}: {row}')
+            self.flushes += 1
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                # отмена фоновой задачи при остановке не должна прерывать начатую запись
+                await asyncio.shield(self.flush())
+            except Exception:
+                logger.exception('Ошибка фоновой записи RequestsLog')
+
+    async def start(self):
+        """
+        Запускает фоновую запись изменений
+        :return: None
+        """
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """
+        Останавливает фоновую запись и записывает оставшиеся изменения
+        :return: None
+        """
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # дожидается начатой фоновой записи (блокировка) и записывает остальное
+        await self.flush()
+        logger.info(f'Запись RequestsLog остановлена: {self.stats()}')
+
+    def stats(self) -> dict:
+        """
+        Статистика записи
+        :return: {'pending': запросов в буфере, 'flushes': записей в БД, 'written': записано изменений запросов,
+        'dropped': не удалось записать}
+        """
+        return {'pending': len(self._pending), 'flushes': self.flushes, 'written': self.written,
+                'dropped': self.dropped}
+
+
+request_log = RequestLogWriter()
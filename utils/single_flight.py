@@ -0,0 +1,53 @@
+import asyncio
+import contextvars
+from collections.abc import Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов: пока запрос с ключом key выполняется,
+    повторные вызовы с тем же ключом не создают новый запрос, а ожидают результат уже запущенного.
+    Запрос выполняется в пустом контексте (contextvars): он не относится ни к одному из вызовов, объединённых в него.
+    Запрос отменяется, когда отменены все ожидающие его вызовы
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+        # количество вызовов, ожидающих запрос
+        self._waiters: dict[Hashable, int] = {}
+        # счётчики для мониторинга
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        """
+        Выполняет func() или присоединяется к уже выполняющемуся вызову с тем же ключом
+        :param key: ключ запроса
+        :param func: функция, возвращающая корутину запроса
+        :return: результат func()
+        """
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(func(), context=contextvars.Context())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: отмена одного из ожидающих не отменяет общий запрос для остальных
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                # запрос больше никто не ожидает (например, истекло время ожидания URL) - квота освобождается
+                task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Статистика объединения запросов
+        :return: {'calls': всего вызовов, 'coalesced': присоединено к выполняющимся, 'in_flight': выполняется}
+        """
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
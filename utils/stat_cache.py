@@ -0,0 +1,148 @@
+import datetime
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import select, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.db import async_session_maker
+from database.models import StatisticCache
+
+logger = logging.getLogger(__name__)
+
+# уровни точности Яндекс Метрики от более точного к менее точному
+ACCURACY_LEVELS = ['full', 'high', 'medium', 'low']
+
+# порядок метрик совпадает с порядком метрик в запросе YMRequest
+METRIC_COLUMNS = ['visits', 'users', 'page_views', 'page_depth', 'visit_duration', 'bounce_rate', 'new_users']
+
+
+class StatCache:
+    """
+    Двухуровневый кэш статистики по URL: LRU в памяти процесса и таблица statistic_cache в БД.
+    Данные за периоды, закончившиеся до сегодняшнего дня, не устаревают; периоды, включающие сегодняшний день,
+    хранятся ttl секунд. Из кэша возвращаются только данные с точностью не ниже запрошенной
+    """
+
+    def __init__(self, ttl: int = 900, maxsize: int = 5000):
+        """
+        :param ttl: время жизни данных за период, включающий сегодняшний день (сек)
+        :param maxsize: максимальное количество записей в памяти
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # (counter, url, date1, date2) -> (metrics, accuracy, expires_at)
+        self._memory = OrderedDict()
+
+    @staticmethod
+    def _is_usable(accuracy: str, expires_at: datetime.datetime | None, min_accuracy: str) -> bool:
+        if ACCURACY_LEVELS.index(accuracy) > ACCURACY_LEVELS.index(min_accuracy):
+            return False
+        return expires_at is None or expires_at > datetime.datetime.now()
+
+    def _remember(self, key: tuple, metrics: list, accuracy: str, expires_at: datetime.datetime | None):
+        self._memory[key] = (metrics, accuracy, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    async def get_many(self, counter: int, urls, date1: str, date2: str,
+                       min_accuracy: str = 'full', stale: bool = False) -> dict[str, list]:
+        """
+        Получает из кэша метрики для нескольких URL одного счётчика за период
+        :param counter: № счётчика
+        :param urls: очищенные URL
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :param min_accuracy: минимально допустимая точность данных
+        :param stale: вернуть и устаревшие данные с любой точностью (когда API недоступно)
+        :return: {url: metrics} только для найденных URL
+        """
+        if stale:
+            min_accuracy = ACCURACY_LEVELS[-1]
+        result = {}
+        not_cached = []
+        for url in urls:
+            key = (counter, url, date1, date2)
+            cached = self._memory.get(key)
+            if cached and (stale or self._is_usable(cached[1], cached[2], min_accuracy)):
+                self._memory.move_to_end(key)
+                result[url] = cached[0]
+            else:
+                not_cached.append(url)
+        if not not_cached:
+            return result
+
+        allowed_accuracy = ACCURACY_LEVELS[:ACCURACY_LEVELS.index(min_accuracy) + 1]
+        conditions = [
+            StatisticCache.counter == counter,
+            StatisticCache.date1 == datetime.date.fromisoformat(date1),
+            StatisticCache.date2 == datetime.date.fromisoformat(date2),
+            StatisticCache.url.in_(not_cached),
+            StatisticCache.accuracy.in_(allowed_accuracy)
+        ]
+        if not stale:
+            conditions.append(
+                or_(StatisticCache.expires_at.is_(None), StatisticCache.expires_at > datetime.datetime.now()))
+        try:
+            async with async_session_maker() as session:
+                rows = await session.execute(select(StatisticCache).where(*conditions))
+                rows = rows.scalars().all()
+        except SQLAlchemyError:
+            logger.exception('Ошибка чтения кэша статистики')
+            return result
+
+        for row in rows:
+            metrics = [getattr(row, column) for column in METRIC_COLUMNS]
+            self._remember((counter, row.url, date1, date2), metrics, row.accuracy, row.expires_at)
+            result[row.url] = metrics
+        return result
+
+    async def set_many(self, counter: int, url_metrics: dict[str, list], date1: str, date2: str,
+                       accuracy: str):
+        """
+        Сохраняет в кэш метрики для нескольких URL одного счётчика за период
+        :param counter: № счётчика
+        :param url_metrics: {url: metrics}
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :param accuracy: точность, с которой получены данные
+        :return: None
+        """
+        if not url_metrics:
+            return
+        now = datetime.datetime.now()
+        expires_at = None
+        if datetime.date.fromisoformat(date2) >= datetime.date.today():
+            expires_at = now + datetime.timedelta(seconds=self.ttl)
+
+        values = []
+        for url, metrics in url_metrics.items():
+            self._remember((counter, url, date1, date2), metrics, accuracy, expires_at)
+            values.append(dict(
+                counter=counter, url=url, date1=datetime.date.fromisoformat(date1),
+                date2=datetime.date.fromisoformat(date2), accuracy=accuracy, created_at=now, expires_at=expires_at,
+                **dict(zip(METRIC_COLUMNS, metrics))))
+
+        stmt = insert(StatisticCache).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['counter', 'url', 'date1', 'date2'],
+            set_={column: stmt.excluded[column] for column in
+                  METRIC_COLUMNS + ['accuracy', 'created_at', 'expires_at']})
+        try:
+            async with async_session_maker() as session:
+                await session.execute(stmt)
+                await session.commit()
+        except SQLAlchemyError:
+            logger.exception('Ошибка записи в кэш статистики')
+
+    def invalidate(self):
+        """
+        Очищает кэш в памяти процесса
+        :return: None
+        """
+        self._memory.clear()
+
+
+stat_cache = StatCache()
@@ -0,0 +1,109 @@
+import datetime
+
+from sqlalchemy import select, update, or_, func, insert
+
+from database.db import async_session_maker
+from database.models import ReportSubscription, User
+from utils.url_processing import urls_to_json, urls_from_json
+
+
+class SubscriptionStore:
+    """
+    Подписки на ежедневные отчёты (таблица report_subscription).
+    Подписку для заблаговременного формирования отчёта и для отправки забирает один процесс
+    (SELECT ... FOR UPDATE SKIP LOCKED), отметка prepared_on / delivered_on ставится в той же транзакции,
+    поэтому каждый отчёт формируется заранее и отправляется не более одного раза в день
+    """
+
+    async def add(self, user_id: int, telegram_id: int, chat_id: int, username: str | None, urls: dict,
+                  period_days: int, delivery_time: datetime.time) -> int:
+        """
+        Создаёт подписку. Если время отправки сегодня уже прошло, первый отчёт будет отправлен завтра
+        :param user_id: User.id
+        :param telegram_id: ID пользователя в телеграм
+        :param chat_id: чат для отправки отчётов
+        :param username: имя пользователя (для имени файла отчёта)
+        :param urls: {raw_url: cleaned_url}
+        :param period_days: длительность периода отчёта (дней, по вчерашний день)
+        :param delivery_time: время отправки отчёта
+        :return: № подписки
+        """
+        now = datetime.datetime.now()
+        async with async_session_maker() as session:
+            subscription_id = await session.execute(insert(ReportSubscription).values(
+                user_id=user_id, telegram_id=telegram_id, chat_id=chat_id, username=username, urls=urls_to_json(urls),
+                period_days=period_days, delivery_time=delivery_time, active=True,
+                delivered_on=now.date() if delivery_time <= now.time() else None, created_at=now
+            ).returning(ReportSubscription.id))
+            subscription_id = subscription_id.scalar_one()
+            await session.commit()
+        return subscription_id
+
+    async def deactivate(self, telegram_id: int) -> int:
+        """
+        Отключает все подписки пользователя
+        :param telegram_id: ID пользователя в телеграм
+        :return: количество отключённых подписок
+        """
+        async with async_session_maker() as session:
+            result = await session.execute(update(ReportSubscription).where(
+                ReportSubscription.telegram_id == telegram_id, ReportSubscription.active == True
+            ).values(active=False))
+            await session.commit()
+        return result.rowcount
+
+    async def _claim(self, condition, values: dict, order_by) -> ReportSubscription | None:
+        subscription_id = select(ReportSubscription.id).where(
+            ReportSubscription.active == True,
+            ReportSubscription.user_id.in_(select(User.id).where(User.active == True)),
+            condition
+        ).order_by(order_by).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        statement = update(ReportSubscription).where(ReportSubscription.id == subscription_id).values(
+            **values).returning(ReportSubscription)
+        async with async_session_maker() as session:
+            subscription = await session.execute(statement)
+            subscription = subscription.scalar_one_or_none()
+            await session.commit()
+        return subscription
+
+    async def claim_prepare(self, today: datetime.date) -> ReportSubscription | None:
+        """
+        Забирает подписку, отчёт по которой сегодня ещё не формировался заранее и не отправлялся
+        :param today: текущая дата
+        :return: подписка или None
+        """
+        return await self._claim(
+            (func.coalesce(ReportSubscription.prepared_on, datetime.date.min) < today) &
+            (func.coalesce(ReportSubscription.delivered_on, datetime.date.min) < today),
+            {'prepared_on': today}, ReportSubscription.delivery_time)
+
+    async def claim_delivery(self, now: datetime.datetime) -> ReportSubscription | None:
+        """
+        Забирает подписку, время отправки отчёта по которой наступило, а сегодня отчёт ещё не отправлялся
+        :param now: текущее время
+        :return: подписка или None
+        """
+        return await self._claim(
+            (ReportSubscription.delivery_time <= now.time()) &
+            or_(ReportSubscription.delivered_on.is_(None), ReportSubscription.delivered_on < now.date()),
+            {'delivered_on': now.date()}, ReportSubscription.delivery_time)
+
+
+def subscription_job(subscription: ReportSubscription, today: datetime.date) -> dict:
+    """
+    Параметры отчёта по подписке. Для заблаговременного формирования и отправки в один день параметры совпадают,
+    поэтому при отправке используется заранее сформированный отчёт (см. ReportCache)
+    :param subscription: подписка
+    :param today: текущая дата
+    :return: параметры задачи (urls, date1, date2, header, username, user_id, chat_id, subscription_id)
+    """
+    date2 = today - datetime.timedelta(days=1)
+    date1 = today - datetime.timedelta(days=subscription.period_days)
+    return {
+        'urls': urls_from_json(subscription.urls), 'date1': str(date1), 'date2': str(date2),
+        'header': f'Статистика за период с {date1.strftime("%d.%m.%Y")} по {date2.strftime("%d.%m.%Y")}',
+        'username': subscription.username, 'user_id': subscription.telegram_id, 'chat_id': subscription.chat_id,
+        'progress_message_id': None, 'subscription_id': subscription.id}
+
+
+subscriptions = SubscriptionStore()
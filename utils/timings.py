@@ -0,0 +1,137 @@
+import datetime
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.db import async_session_maker
+from database.models import RequestTiming
+from utils.metrics import report_seconds, report_stage_seconds, ym_request_seconds, ym_requests_total, \
+    ym_response_bytes_total
+
+logger = logging.getLogger(__name__)
+
+
+class ReportTimings:
+    """
+    Время выполнения этапов формирования одного отчёта и запросов к API Яндекс Метрики.
+    Сохраняется в таблицу request_timing с привязкой к RequestsLog.id
+    """
+
+    # максимальное количество сохраняемых запросов к API (для массовых отчётов сохраняются только итоги)
+    max_api_calls = 1000
+
+    def __init__(self, request_id: int):
+        """
+        :param request_id: № запроса в RequestsLog
+        """
+        self.request_id = request_id
+        self.started = time.monotonic()
+        # этап -> время (сек); время повторяющихся этапов суммируется
+        self.stages = {}
+        self.api_calls = []
+        self.api_summary = {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'failed': 0}
+
+    def add_stage(self, name: str, seconds: float):
+        self.stages[name] = round(self.stages.get(name, 0) + seconds, 3)
+
+    def add_api_call(self, call: dict):
+        self.api_summary['calls'] += 1
+        self.api_summary['seconds'] = round(self.api_summary['seconds'] + call['seconds'], 3)
+        self.api_summary['bytes'] += call['bytes']
+        if call['status'] != 200:
+            self.api_summary['failed'] += 1
+        if len(self.api_calls) < self.max_api_calls:
+            self.api_calls.append(call)
+
+    async def save(self, status: str):
+        """
+        Сохраняет время выполнения в БД (повторная обработка запроса перезаписывает запись)
+        :param status: итог обработки запроса: done / failed
+        :return: None
+        """
+        total_seconds = round(time.monotonic() - self.started, 3)
+        report_seconds.observe(total_seconds, status=status)
+        values = dict(status=status, total_seconds=total_seconds, stages=self.stages, api_summary=self.api_summary,
+                      api_calls=self.api_calls, created_at=datetime.datetime.now())
+        stmt = insert(RequestTiming).values(request_id=self.request_id, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[RequestTiming.request_id], set_=values)
+        try:
+            async with async_session_maker() as session:
+                await session.execute(stmt)
+                await session.commit()
+        except SQLAlchemyError:
+            logger.exception(f'Ошибка сохранения времени выполнения запроса {self.request_id}')
+
+
+class SharedTimings:
+    """
+    Время запроса к API, общего для нескольких отчётов (см. SingleFlight): этапы и запросы к API записываются
+    в ReportTimings каждого отчёта, ожидающего общий запрос
+    """
+
+    def __init__(self):
+        self.reports: set[ReportTimings] = set()
+
+    def add_stage(self, name: str, seconds: float):
+        for timings in self.reports:
+            timings.add_stage(name, seconds)
+
+    def add_api_call(self, call: dict):
+        for timings in self.reports:
+            timings.add_api_call(call)
+
+
+# время выполнения отчёта, который формируется в текущей задаче asyncio (дочерние задачи наследуют значение)
+current_timings: ContextVar[ReportTimings | SharedTimings | None] = ContextVar('current_timings', default=None)
+
+
+def record_stage(name: str, seconds: float):
+    """
+    Записывает время этапа формирования отчёта. Время этапов, которые выполняются параллельно
+    (например, ожидание квоты API), суммируется
+    :param name: название этапа
+    :param seconds: время выполнения
+    :return: None
+    """
+    report_stage_seconds.observe(seconds, stage=name)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add_stage(name, seconds)
+
+
+@contextmanager
+def timing_stage(name: str):
+    """
+    Замеряет время этапа формирования отчёта
+    :param name: название этапа
+    :return: None
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(name, time.monotonic() - started)
+
+
+def record_api_call(description: str, attempt: int, accuracy: str, status: int, size: int, seconds: float):
+    """
+    Записывает результат одного http-запроса к API Яндекс Метрики
+    :param description: описание запроса
+    :param attempt: № попытки запроса
+    :param accuracy: точность запроса
+    :param status: http-статус ответа
+    :param size: объём ответа (байт)
+    :param seconds: время выполнения запроса
+    :return: None
+    """
+    ym_request_seconds.observe(seconds, status=status)
+    ym_requests_total.inc(status=status, accuracy=accuracy)
+    ym_response_bytes_total.inc(size)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add_api_call({'request': description, 'attempt': attempt, 'accuracy': accuracy, 'status': status,
+                              'bytes': size, 'seconds': round(seconds, 3)})
@@ -1,12 +1,21 @@
+import csv
+import io
 import re
-from urllib.parse import urlparse
+
+from openpyxl import load_workbook
+
+from settings import BULK_MAX_URLS
 from utils.custom_exceptions import MaxCountUrlError, IncorrectUrl, BadRequestError
 
+# разделители URL в текстовом сообщении
+URL_SEPARATORS = re.compile(r'[ ,\n]')
+# схема://[www.]домен/путь - параметры запроса и якорь в очищенный URL не входят, www удаляется только в начале домена
+URL_PATTERN = re.compile(r'([a-z][a-z0-9+.\-]*)://(?:www\.)?([^/?#]*)([^?#]*)', re.IGNORECASE)
 
 
 async def extract_urls_from_message(text: str) -> dict:
     # заменяем разделители на пробелы и нарезаем строку на отдельные части
-    url_list = re.sub(r'[ ,\n]', ' ', text).split()
+    url_list = URL_SEPARATORS.sub(' ', text).split()
     if len(url_list) > 20:
         raise MaxCountUrlError(len(url_list))
     raw_processed_urls = urls_processing(url_list)
@@ -15,22 +24,83 @@ async def extract_urls_from_message(text: str) -> dict:
     return raw_processed_urls
 
 
-def urls_processing(raw_urls: list) -> dict:
-    processed_urls = []
+def extract_urls_from_file(filename: str, content: bytes) -> dict:
+    """
+    Извлекает URL-адреса из CSV- или XLSX-файла для массового отчёта.
+    URL-адресом считается любая ячейка, начинающаяся с http(s)://, повторы отбрасываются
+    :param filename: имя файла (по расширению определяется формат)
+    :param content: содержимое файла
+    :return: {raw_url: cleaned_url}
+    """
+    if filename.lower().endswith('.xlsx'):
+        workbook = load_workbook(io.BytesIO(content), read_only=True)
+        cells = (cell for row in workbook.active.iter_rows(values_only=True) for cell in row)
+    elif filename.lower().endswith(('.csv', '.txt')):
+        try:
+            text = content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = content.decode('cp1251')
+        cells = (cell for row in csv.reader(io.StringIO(text), delimiter=';' if ';' in text else ',') for cell in row)
+    else:
+        raise BadRequestError('Поддерживаются только файлы в формате CSV или XLSX.')
 
-    for raw_url in raw_urls:
-        parse_url = urlparse(raw_url)
-        scheme = parse_url.scheme
-        # удаляем из доменов www
-        netloc = re.sub('www.', '', parse_url.netloc)
-        path = parse_url.path
+    # dict сохраняет порядок URL и отбрасывает повторы
+    url_list = list(dict.fromkeys(
+        cell.strip() for cell in cells if isinstance(cell, str) and cell.strip().startswith(('https://', 'http://'))))
+    if len(url_list) > BULK_MAX_URLS:
+        raise MaxCountUrlError(len(url_list), BULK_MAX_URLS)
+    raw_processed_urls = urls_processing(url_list)
+    if not raw_processed_urls:
+        raise BadRequestError('В полученном файле не найдено не одного URL-адреса.')
+    return raw_processed_urls
 
-        if not all((scheme, netloc, path)):
-            raise IncorrectUrl(f'Получен некорректный url-адрес: <u>{raw_url}</u>')
 
-        process_url = netloc + path
-        processed_urls.append(process_url)
+def normalize_url(raw_url: str) -> str:
+    """
+    Разбирает URL один раз за запрос: на следующих этапах используется только очищенный URL,
+    домен берётся из него без повторного разбора (url_domain)
+    :param raw_url: исходный URL
+    :return: очищенный URL (домен без www + путь)
+    """
+    match = URL_PATTERN.match(raw_url)
+    if match is None or not all(match.groups()):
+        raise IncorrectUrl(f'Получен некорректный url-адрес: <u>{raw_url}</u>')
+    _, domain, path = match.groups()
+    return domain + path
 
-    raw_processed_urls = dict(zip(raw_urls, processed_urls))
 
-    return raw_processed_urls
+def url_domain(cleaned_url: str) -> str:
+    """
+    Домен очищенного URL, без повторного разбора исходного URL
+    :param cleaned_url: очищенный URL (домен + путь)
+    :return: домен
+    """
+    return cleaned_url.partition('/')[0]
+
+
+def urls_to_json(raw_processed_urls: dict) -> list:
+    """
+    URL запроса для хранения в JSONB (состояние диалога, задача очереди, подписка): JSONB не сохраняет порядок
+    ключей объекта, поэтому URL хранятся списком пар - строки отчёта следуют в порядке URL запроса
+    :param raw_processed_urls: {raw_url: cleaned_url}
+    :return: [[raw_url, cleaned_url], ...]
+    """
+    return [[raw_url, cleaned_url] for raw_url, cleaned_url in raw_processed_urls.items()]
+
+
+def urls_from_json(url_pairs: list) -> dict:
+    """
+    URL запроса, сохранённые urls_to_json
+    :param url_pairs: [[raw_url, cleaned_url], ...]
+    :return: {raw_url: cleaned_url} в исходном порядке
+    """
+    return {raw_url: cleaned_url for raw_url, cleaned_url in url_pairs}
+
+
+def urls_processing(raw_urls: list) -> dict:
+    """
+    Очищает URL запроса: удаляет схему, www в начале домена, параметры запроса и якорь
+    :param raw_urls: исходные URL
+    :return: {raw_url: cleaned_url}
+    """
+    return {raw_url: normalize_url(raw_url) for raw_url in raw_urls}
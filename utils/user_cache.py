@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from database.db import async_engine, async_session_maker
+from database.models import User
+
+logger = logging.getLogger(__name__)
+
+# канал уведомлений PostgreSQL об изменении таблицы пользователей (NOTIFY отправляет триггер, см. README)
+USER_CHANNEL = 'bot_tg_url_stats_user'
+
+
+class UserCache:
+    """
+    Кэш доступа к боту: telegram_id активного пользователя -> User.id.
+    Таблица пользователей небольшая, поэтому загружается целиком при запуске бота и перезагружается
+    по уведомлению PostgreSQL (LISTEN/NOTIFY) об её изменении, а без уведомлений - раз в refresh_interval.
+    Проверка доступа не обращается к БД, пока загруженная таблица не старше ttl. Пользователь, которого нет
+    в кэше, ищется в БД не чаще раза в negative_ttl: отказ в доступе кэшируется
+    """
+
+    def __init__(self, ttl: int = 300, negative_ttl: int = 60, max_denied: int = 10000, refresh_interval: int = 60,
+                 channel: str = USER_CHANNEL):
+        """
+        :param ttl: максимальный возраст загруженной таблицы пользователей (сек), после которого доступ
+        проверяется по БД (если фоновое обновление не удаётся)
+        :param negative_ttl: время жизни записи об отказе в доступе (сек)
+        :param max_denied: максимальное количество записей об отказе в доступе
+        :param refresh_interval: период фоновой перезагрузки таблицы пользователей (сек)
+        :param channel: канал уведомлений PostgreSQL об изменении таблицы пользователей
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_denied = max_denied
+        self.refresh_interval = refresh_interval
+        self.channel = channel
+        # telegram_id -> User.id
+        self._users = {}
+        # время загрузки таблицы пользователей
+        self._loaded_at = None
+        # telegram_id -> время истечения отказа в доступе
+        self._denied = OrderedDict()
+        self._changed = asyncio.Event()
+        self._refresh_task = None
+        # соединение с БД, на котором выполнен LISTEN
+        self._listen_connection = None
+        # счётчики для мониторинга
+        self.hits = 0
+        self.denied_hits = 0
+        self.db_lookups = 0
+
+    def _fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _deny(self, telegram_id: int):
+        self._denied[telegram_id] = time.monotonic() + self.negative_ttl
+        self._denied.move_to_end(telegram_id)
+        while len(self._denied) > self.max_denied:
+            self._denied.popitem(last=False)
+
+    async def get_user_id(self, telegram_id: int) -> int | None:
+        """
+        Проверка доступа пользователя к боту
+        :param telegram_id: ID пользователя в телеграм
+        :return: User.id активного пользователя или None, если доступа нет
+        """
+        if self._fresh() and telegram_id in self._users:
+            self.hits += 1
+            return self._users[telegram_id]
+        expires = self._denied.get(telegram_id)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.denied_hits += 1
+                return None
+            del self._denied[telegram_id]
+
+        # пользователь мог быть добавлен после загрузки таблицы или таблица давно не обновлялась
+        self.db_lookups += 1
+        async with async_session_maker() as session:
+            user_id = await session.execute(
+                select(User.id).where(User.telegram_id == telegram_id, User.active == True))
+            user_id = user_id.scalar()
+        if user_id is None:
+            self._users.pop(telegram_id, None)
+            self._deny(telegram_id)
+        else:
+            self._users[telegram_id] = user_id
+        return user_id
+
+    async def warm(self):
+        """
+        Загружает в кэш всех активных пользователей одним запросом
+        :return: None
+        """
+        async with async_session_maker() as session:
+            rows = await session.execute(select(User.telegram_id, User.id).where(
+                User.active == True, User.telegram_id.is_not(None)))
+            rows = rows.all()
+        self._users = dict(rows)
+        self._denied.clear()
+        self._loaded_at = time.monotonic()
+        logger.info(f'Кэш пользователей обновлён. Пользователей: {len(rows)}')
+
+    def _on_notify(self, connection, pid, channel, payload):
+        # уведомления, пришедшие во время перезагрузки, приводят к ещё одной перезагрузке
+        self._changed.set()
+
+    async def _listen(self):
+        """
+        Подписывается на уведомления об изменении таблицы пользователей, если подписки нет
+        или соединение с БД потеряно
+        :return: None
+        """
+        if self._listen_connection is not None:
+            raw_connection = await self._listen_connection.get_raw_connection()
+            if not raw_connection.driver_connection.is_closed():
+                return
+            await self._close_listen_connection()
+        connection = await async_engine.connect()
+        try:
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.add_listener(self.channel, self._on_notify)
+        except Exception:
+            await connection.close()
+            raise
+        self._listen_connection = connection
+
+    async def _close_listen_connection(self):
+        connection, self._listen_connection = self._listen_connection, None
+        try:
+            await connection.invalidate()
+        except Exception:
+            logger.exception('Ошибка закрытия соединения подписки на изменения пользователей')
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            try:
+                await self._listen()
+            except Exception:
+                logger.exception('Не удалось подписаться на изменения таблицы пользователей')
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception('Ошибка фонового обновления кэша пользователей')
+
+    async def start(self):
+        """
+        Загружает кэш, подписывается на изменения таблицы пользователей и запускает фоновое обновление
+        :return: None
+        """
+        try:
+            await self._listen()
+        except Exception:
+            logger.exception('Не удалось подписаться на изменения таблицы пользователей, '
+                             f'кэш будет обновляться раз в {self.refresh_interval} с')
+        await self.warm()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        """
+        Останавливает фоновое обновление кэша и закрывает подписку
+        :return: None
+        """
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._listen_connection is not None:
+            await self._close_listen_connection()
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша
+        :return: {'users': пользователей в кэше, 'denied': записей об отказе, 'hits': проверок без БД,
+        'denied_hits': отказов без БД, 'db_lookups': проверок по БД}
+        """
+        return {'users': len(self._users), 'denied': len(self._denied), 'hits': self.hits,
+                'denied_hits': self.denied_hits, 'db_lookups': self.db_lookups}
+
+
+user_cache = UserCache()
@@ -1,83 +1,235 @@
-import io
+import asyncio
+import os
+import tempfile
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
 import xlsxwriter
+from settings import REPORT_WORKERS
 from utils.ym_api import statistic
 
+# пул процессов для формирования отчётов вне цикла событий бота
+report_executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS)
+
 
-def xlsx_writter(statistics: statistic, filename: str, sum_stat: statistic, header: str):
+class XlsxReportWriter:
     """
-    Функция записывает данные статистики с excel-файл
-    :param statistics: список с объектами statistic (namedtuple)
-    :param filename: имя выходного файла
-    :param sum_stat:
-    :param header:
-    :return: None
+    Построчная запись отчёта со статистикой в excel-файл.
+    Строки записываются по мере поступления, поэтому в режиме constant_memory в памяти не хранится весь отчёт.
+    Если итоговая статистика не передана при закрытии, она рассчитывается по записанным строкам
     """
-    with io.BytesIO() as out_file_bytes:
-        workbook = xlsxwriter.Workbook(out_file_bytes, {'in_memory': True})
-        worksheet = workbook.add_worksheet()
-        worksheet.merge_range(
+    headers = [
+        '№', 'URL-адрес', 'Количество визитов', 'Количество посещений', 'Количество просмотров',
+        'Глубина просмотра', 'Время на сайте',
+        'Доля отказов',
+        'Доля новых'
+    ]
+    # примечание к приблизительному количеству посетителей
+    approximate_note = '≈ - приблизительное количество посетителей (может быть завышено): посетитель учтён ' \
+                       'в каждой части периода или в каждом URL, где у него были визиты'
+    # количество URL, записываемых гиперссылками: xlsxwriter хранит гиперссылки в памяти до закрытия файла
+    # (и не более 65530 на лист), поэтому в больших отчётах остальные URL записываются обычным текстом
+    max_url_links = 1000
+
+    def __init__(self, out_file, header: str, options: dict = None):
+        """
+        :param out_file: путь к файлу или файловый объект
+        :param header: заголовок excel-таблицы
+        :param options: параметры xlsxwriter.Workbook (in_memory, constant_memory и т.д.)
+        """
+        self.workbook = xlsxwriter.Workbook(out_file, options or {})
+        self.worksheet = self.workbook.add_worksheet()
+        self.worksheet.merge_range(
             'A1:I1',
             header,
-            workbook.add_format({'bold': True, 'align': 'center', 'font_size': 14, 'border': 2, 'bg_color': '#B0E0E6'}))
-        headers = [
-            '№', 'URL-адрес', 'Количество визитов', 'Количество посещений', 'Количество просмотров',
-            'Глубина просмотра', 'Время на сайте',
-            'Доля отказов',
-            'Доля новых'
-        ]
+            self.workbook.add_format(
+                {'bold': True, 'align': 'center', 'font_size': 14, 'border': 2, 'bg_color': '#B0E0E6'}))
         # запись заголовков таблицы
-        for col, header in enumerate(headers):
-            worksheet.write(1, col, header, workbook.add_format({'bold': True, 'border': 2, 'align': 'center'}))
+        header_format = self.workbook.add_format({'bold': True, 'border': 2, 'align': 'center'})
+        for col, col_header in enumerate(self.headers):
+            self.worksheet.write(1, col, col_header, header_format)
 
         # форматы записи статистики в ячейки
-        default_format = workbook.add_format({'border': 1, 'align': 'center'})
-        number_format = workbook.add_format({'num_format': '#,##0', 'align': 'center', 'border': 1})
-        url_format = workbook.add_format({'border': 1, 'align': 'left'})
-        time_format = workbook.add_format({'num_format': 'hh:mm:ss', 'align': 'center', 'border': 1})
-        percent_format = workbook.add_format({'num_format': '0.00%', 'align': 'center', 'border': 1})
-
-        # запись данных
-        for row, row_stat in enumerate(statistics, start=2):
-            worksheet.write(row, 0, row - 1, workbook.add_format({'border': 2, 'align': 'center'}))
-            worksheet.write(row, 1, row_stat.raw_url, url_format)
-            worksheet.write(row, 2, row_stat.visits, number_format)
-            worksheet.write(row, 3, row_stat.users, number_format)
-            worksheet.write(row, 4, row_stat.pageViews, number_format)
-            worksheet.write(row, 5, row_stat.pageDepth, default_format)
-            worksheet.write(row, 6, row_stat.visitDuration, time_format)
-            worksheet.write(row, 7, row_stat.bounceRate / 100, percent_format)
-            worksheet.write(row, 8, row_stat.newUsers / 100, percent_format)
+        self.index_format = self.workbook.add_format({'border': 2, 'align': 'center'})
+        self.default_format = self.workbook.add_format({'border': 1, 'align': 'center'})
+        self.number_format = self.workbook.add_format({'num_format': '#,##0', 'align': 'center', 'border': 1})
+        self.approximate_format = self.workbook.add_format({'num_format': '"≈ "#,##0', 'align': 'center',
+                                                            'border': 1, 'italic': True})
+        self.url_format = self.workbook.add_format({'border': 1, 'align': 'left'})
+        self.time_format = self.workbook.add_format({'num_format': 'hh:mm:ss', 'align': 'center', 'border': 1})
+        self.percent_format = self.workbook.add_format({'num_format': '0.00%', 'align': 'center', 'border': 1})
+        self.error_format = self.workbook.add_format({'border': 1, 'align': 'left', 'font_color': '#9C0006',
+                                                      'bg_color': '#FFC7CE'})
+
+        # № следующей строки для записи данных (2 строки заняты заголовками)
+        self.row = 2
+        # суммы для расчёта итогов: визиты, посетители, просмотры и взвешенные по визитам средние
+        self._totals = [0, 0, 0, 0, 0, 0]
+        # максимальная длина URL для ширины столбца
+        self._url_width = len(self.headers[1])
+        # количество URL, данные по которым получить не удалось
+        self.failed = 0
+        # записано значений с приблизительным количеством посетителей
+        self.approximate = 0
+
+    def _write_stat(self, row: int, row_stat: statistic):
+        self.worksheet.write(row, 2, row_stat.visits, self.number_format)
+        if row_stat.approximateUsers:
+            self.approximate += 1
+            self.worksheet.write(row, 3, row_stat.users, self.approximate_format)
+        else:
+            self.worksheet.write(row, 3, row_stat.users, self.number_format)
+        self.worksheet.write(row, 4, row_stat.pageViews, self.number_format)
+        self.worksheet.write(row, 5, row_stat.pageDepth, self.default_format)
+        self.worksheet.write(row, 6, row_stat.visitDuration, self.time_format)
+        self.worksheet.write(row, 7, row_stat.bounceRate / 100, self.percent_format)
+        self.worksheet.write(row, 8, row_stat.newUsers / 100, self.percent_format)
+
+    def write(self, row_stat: statistic):
+        """
+        Записывает строку статистики по одному URL. Для URL с ошибкой вместо метрик записывается текст ошибки,
+        такие строки не учитываются в итогах
+        :param row_stat: объект statistic
+        :return: None
+        """
+        self.worksheet.write(self.row, 0, self.row - 1, self.index_format)
+        if self.row - 2 < self.max_url_links:
+            self.worksheet.write(self.row, 1, row_stat.raw_url, self.url_format)
+        else:
+            self.worksheet.write_string(self.row, 1, row_stat.raw_url, self.url_format)
+        self._url_width = max(self._url_width, len(row_stat.raw_url or ''))
+        if row_stat.error:
+            self.worksheet.merge_range(self.row, 2, self.row, 8, f'Нет данных: {row_stat.error}', self.error_format)
+            self.row += 1
+            self.failed += 1
+            return
+        self._write_stat(self.row, row_stat)
+        self.row += 1
 
+        visit_duration = row_stat.visitDuration
+        if isinstance(visit_duration, timedelta):
+            visit_duration = visit_duration.total_seconds()
+        self._totals[0] += row_stat.visits
+        self._totals[1] += row_stat.users
+        self._totals[2] += row_stat.pageViews
+        self._totals[3] += row_stat.visits * visit_duration
+        self._totals[4] += row_stat.visits * row_stat.bounceRate
+        self._totals[5] += row_stat.visits * row_stat.newUsers
+
+    def calculated_sum_statistics(self) -> statistic:
+        """
+        Итоговая статистика по записанным строкам: визиты, посетители и просмотры суммируются,
+        средние показатели рассчитываются с весом по визитам. Сумма посетителей по нескольким URL приблизительная:
+        посетитель нескольких URL учитывается в каждом из них
+        :return: объект statistic
+        """
+        visits, users, page_views, duration, bounce_rate, new_users = self._totals
+        approximate = self.row - 2 - self.failed > 1 or self.approximate > 0
+        if not visits:
+            return statistic(raw_url=None, users=users, pageViews=page_views, approximateUsers=approximate)
+        return statistic(
+            raw_url=None, visits=visits, users=users, pageViews=page_views, pageDepth=round(page_views / visits, 2),
+            visitDuration=timedelta(seconds=round(duration / visits)), bounceRate=round(bounce_rate / visits, 2),
+            newUsers=round(new_users / visits, 2), approximateUsers=approximate)
+
+    def close(self, sum_stat: statistic = None):
+        """
+        Записывает итоговую строку, применяет форматирование и закрывает файл
+        :param sum_stat: итоговая статистика; если не передана - рассчитывается по записанным строкам
+        :return: None
+        """
+        if sum_stat is None:
+            sum_stat = self.calculated_sum_statistics()
         # Запись итогов
         # № строки для записи итогов (+2 строки с учетом заголовков)
-        itog_row = len(statistics) + 2
-        worksheet.merge_range(f'A{itog_row + 1}:B{itog_row + 1}', 'ИТОГО',
-                              worksheet.workbook_add_format({'bold': True, 'align': 'center', 'border': 1}))
-        worksheet.write(itog_row, 1, '', default_format)
-        worksheet.write(itog_row, 2, sum_stat.visits, number_format)
-        worksheet.write(itog_row, 3, sum_stat.users, number_format)
-        worksheet.write(itog_row, 4, sum_stat.pageViews, number_format)
-        worksheet.write(itog_row, 5, sum_stat.pageDepth, default_format)
-        worksheet.write(itog_row, 6, sum_stat.visitDuration, time_format)
-        worksheet.write(itog_row, 7, sum_stat.bounceRate / 100, percent_format)
-        worksheet.write(itog_row, 8, sum_stat.newUsers / 100, percent_format)
+        itog_row = self.row
+        self.worksheet.merge_range(f'A{itog_row + 1}:B{itog_row + 1}', 'ИТОГО',
+                                   self.workbook.add_format({'bold': True, 'align': 'center', 'border': 1}))
+        self.worksheet.write(itog_row, 1, '', self.default_format)
+        self._write_stat(itog_row, sum_stat)
+        if self.approximate:
+            self.worksheet.merge_range(itog_row + 1, 0, itog_row + 1, 8, self.approximate_note,
+                                       self.workbook.add_format({'italic': True, 'align': 'left'}))
 
         # применение условного форматирования к заполненным данным
         for cell in ('C', 'D', 'E', 'F', 'G', 'H', 'I'):
             # для доли отказов применяем инвертированные цвета
             if cell == 'H':
-                worksheet.conditional_format(f'{cell}3:{cell}{itog_row}', {
+                self.worksheet.conditional_format(f'{cell}3:{cell}{itog_row}', {
                     'type': '3_color_scale',
                     'min_color': '#63BE7B',
                     'mid_color': '#FFEB84',
                     'max_color': '#F8696B'})
             else:
-                worksheet.conditional_format(f'{cell}3:{cell}{itog_row}', {'type': '3_color_scale'})
-
-        # выравнивание ширины ячеек по контенту (макс ширина = 300 px)
-        worksheet.autofit(300)
-        worksheet.set_column(0, 0, 6)
-        workbook.close()
-        out_file_bytes.seek(0)
-        out_file_bytes = out_file_bytes.getvalue()
-    return out_file_bytes
+                self.worksheet.conditional_format(f'{cell}3:{cell}{itog_row}', {'type': '3_color_scale'})
+
+        if self.workbook.constant_memory:
+            # в режиме constant_memory данные ячеек не хранятся и autofit недоступен,
+            # ширина столбцов задаётся по длине заголовков и URL (макс ширина ~ 300 px)
+            for col, col_header in enumerate(self.headers):
+                self.worksheet.set_column(col, col, min(len(col_header) + 2, 42))
+            self.worksheet.set_column(1, 1, min(self._url_width + 2, 42))
+        else:
+            # выравнивание ширины ячеек по контенту (макс ширина = 300 px)
+            self.worksheet.autofit(300)
+        self.worksheet.set_column(0, 0, 6)
+        self.workbook.close()
+
+
+@contextmanager
+def temporary_report_file():
+    """
+    Временный файл для отчёта, удаляется при выходе из контекста
+    :return: путь к файлу
+    """
+    file_descriptor, file_path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(file_descriptor)
+    try:
+        yield file_path
+    finally:
+        os.remove(file_path)
+
+
+def xlsx_writter(statistics: Iterable[statistic], out_file, sum_stat: statistic | None, header: str):
+    """
+    Функция записывает данные статистики с excel-файл.
+    Строки записываются в режиме constant_memory по мере чтения из statistics, поэтому потребление памяти
+    не зависит от количества строк, а готовый файл не копируется в память
+    :param statistics: итерируемый объект с объектами statistic (namedtuple)
+    :param out_file: путь к выходному файлу или файловый объект (например, tempfile.SpooledTemporaryFile)
+    :param sum_stat: итоговая статистика; None - итоги рассчитываются по строкам
+    :param header:
+    :return: None
+    """
+    writer = XlsxReportWriter(out_file, header, {'constant_memory': True})
+    for row_stat in statistics:
+        writer.write(row_stat)
+    writer.close(sum_stat)
+
+
+def _xlsx_writter_from_tuples(statistics: list[tuple], file_path: str, sum_stat: tuple | None, header: str):
+    """
+    Обёртка над xlsx_writter для вызова в дочернем процессе: statistic передаются как обычные кортежи,
+    т.к. namedtuple, объявленный через переменную statistic, не сериализуется pickle
+    """
+    xlsx_writter((statistic(*row) for row in statistics), file_path, statistic(*sum_stat) if sum_stat else None, header)
+
+
+async def xlsx_writter_async(statistics: Iterable[statistic], file_path: str, sum_stat: statistic | None,
+                             header: str):
+    """
+    Формирует excel-файл в пуле процессов report_executor, не блокируя цикл событий.
+    Одновременно формируется не более REPORT_WORKERS отчётов, остальные ожидают в очереди пула.
+    Файл записывается дочерним процессом на диск, содержимое файла между процессами не передаётся
+    :param statistics: итерируемый объект с объектами statistic (namedtuple)
+    :param file_path: путь к выходному файлу
+    :param sum_stat:
+    :param header:
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(report_executor, _xlsx_writter_from_tuples,
+                               [tuple(row) for row in statistics], file_path,
+                               tuple(sum_stat) if sum_stat else None, header)
@@ -1,206 +1,811 @@
 import asyncio
 import datetime
-import re
+import json
+import random
+import time
+from contextvars import ContextVar
 from datetime import timedelta
-from urllib.parse import urlparse
 from collections import namedtuple
+from collections.abc import Callable
 from _collections_abc import dict_keys, dict_values
 import logging
 
-import requests
-from sqlalchemy import select
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientError
 
-from database.db import async_session_maker
-from database.models import DomainCounter
-from utils.custom_exceptions import BadRequestError
+from utils.counter_cache import counter_cache
+from utils.daily_store import daily_store
+from utils.single_flight import SingleFlight
+from utils.circuit_breaker import CircuitBreaker
+from utils.accuracy_selector import AccuracySelector
+from utils.quota_governor import quota_governor
+from utils.fair_scheduler import current_client
+from utils.timings import timing_stage, record_stage, record_api_call, current_timings, SharedTimings
+from utils.stat_cache import stat_cache
+from utils.custom_exceptions import BadRequestError, ServiceUnavailableError
+from utils.url_processing import url_domain
+from settings import YM_API_URL
 
-# namedtuple для хранения данных (по-умолчанию все параметры=0)
+# namedtuple для хранения данных (по-умолчанию все параметры=0);
+# error - описание ошибки, если данные по URL получить не удалось;
+# approximateUsers - количество посетителей приблизительное (сумма по частям периода или по URL, может быть завышено)
 statistic = namedtuple('Statistic', [
-    'raw_url', 'visits', 'users', 'pageViews', 'pageDepth', 'visitDuration', 'bounceRate', 'newUsers'],
-                       defaults=[0 for _ in range(8)])
+    'raw_url', 'visits', 'users', 'pageViews', 'pageDepth', 'visitDuration', 'bounceRate', 'newUsers', 'error',
+    'approximateUsers'], defaults=[0 for _ in range(8)] + [None, False])
 
 logger = logging.getLogger(__name__)
 
 
+class SharedRequestWaiters:
+    """
+    Вызовы, ожидающие общий запрос к API (см. YMRequest._request): общий запрос выполняется вне контекста
+    вызовов, поэтому время запроса записывается в отчёт каждого вызова, а разрешение квоты запускает
+    отсчёт времени каждого URL
+    """
+
+    def __init__(self):
+        self.count = 0
+        # функции запуска отсчёта времени URL
+        self.clocks = set()
+        self.timings = SharedTimings()
+
+
+# запуск отсчёта времени получения статистики по URL (см. YMRequest._fetch_url_metrics)
+url_clock: ContextVar[Callable[[], None] | None] = ContextVar('url_clock', default=None)
+
+
 class YMRequest:
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super().__new__(cls)
-            cls._instance.semaphore = asyncio.Semaphore(5)
+            # объединение одинаковых одновременных запросов к API
+            cls._instance.single_flight = SingleFlight()
+            # {ключ запроса: вызовы, ожидающие этот запрос}
+            cls._instance.shared_waiters = {}
+            # выбор начальной точности запроса по истории успешных запросов
+            cls._instance.accuracy_selector = AccuracySelector(['full', 'high', 'medium', 'low'])
+            # быстрый отказ при недоступности API вместо повторов и ожидания таймаутов
+            cls._instance.circuit_breaker = CircuitBreaker('API Яндекс Метрики')
         return cls._instance
 
-    def __init__(self, oauth_token):
-        self.token = oauth_token
-        self.api_url = 'https://api-metrika.yandex.net/stat/v1/data'
-        self.headers = {'Authorization': self.token}
+    def __init__(self):
+        # токены, количество одновременных запросов и их частоту определяет quota_governor
+        self.api_url = YM_API_URL
         # минимальная дата начала интервала сбора статистики
         self.min_date = datetime.date(2020, 1, 1)
         self.sampling = ['full', 'high', 'medium', 'low']
+        self.metrics = 'ym:s:visits,ym:s:users,ym:s:pageviews,ym:s:pageDepth,ym:s:avgVisitDurationSeconds,' \
+                       'ym:s:bounceRate,ym:s:percentNewVisitors'
+        # метрики, которые можно суммировать по дням
+        self.additive_metrics = 'ym:s:visits,ym:s:pageviews,ym:s:avgVisitDurationSeconds,ym:s:bounceRate,' \
+                                'ym:s:percentNewVisitors'
+        # максимальное количество строк в ответе API при группировке
+        self.max_rows = 100000
+        # количество URL в одной части при потоковом получении статистики (по URL части - одно обращение к кэшу,
+        # запросы к API по URL части выполняются параллельно)
+        self.batch_size = 10
+        # количество одновременно обрабатываемых частей при потоковом получении статистики
+        self.stream_workers = 5
+        # максимальное время получения статистики по одному URL (сек); время ожидания квоты до первого
+        # разрешённого запроса по URL не учитывается
+        self.url_timeout = 180
+        # количество повторов запроса после ответа 429 (превышение квоты API)
+        self.throttle_retries = 5
+        # период длиннее max_period_days запрашивается частями параллельно; при ошибке 400 часть делится пополам,
+        # пока не станет короче min_period_days
+        self.max_period_days = 183
+        self.min_period_days = 31
+        # пауза перед повтором запроса (сек): base_backoff * 2^№ повтора, но не более max_backoff
+        self.base_backoff = 0.5
+        self.max_backoff = 10
 
-    async def _get_counter(self, raw_url: str) -> int:
+    async def _get_url_counters(self, raw_processed_urls: dict, strict: bool = True) -> dict[str, int]:
         """
-        Получает один счётчик для raw_url
-        :param raw_url:
-        :return: № счётчика
-        """
-        # домен
-        netloc = re.sub('www.', '', urlparse(raw_url).netloc)
-        # сессия базы данных
-        async with async_session_maker() as session:
-            domain_counter_obj = await session.execute(
-                select(DomainCounter.counter).where(DomainCounter.domain_name == netloc))
-            # получаем счётчик по домену
-            counter = domain_counter_obj.scalar_one_or_none()
-        if not counter:
-            raise BadRequestError(
-                f'Не удалось найти счётчик Яндекс Метрики по домену: {netloc}.'
-            )
-        return counter
+        Получает счётчик для каждого из переданных URL (не более одного запроса к БД)
+        :param raw_processed_urls: {raw_url: cleaned_url}
+        :param strict: True - выбросить BadRequestError, если для домена нет счётчика, False - пропустить такой URL
+        :return: {raw_url: № счётчика}
+        """
+        url_netlocs = {raw_url: url_domain(cleaned_url) for raw_url, cleaned_url in raw_processed_urls.items()}
+        netloc_counters = await counter_cache.get_many(set(url_netlocs.values()))
+        url_counters = {}
+        for raw_url, netloc in url_netlocs.items():
+            if not netloc_counters[netloc]:
+                if not strict:
+                    continue
+                raise BadRequestError(
+                    f'Не удалось найти счётчик Яндекс Метрики по домену: {netloc}.'
+                )
+            url_counters[raw_url] = netloc_counters[netloc]
+        return url_counters
 
-    async def _get_counters(self, raw_urls: list[str]) -> list:
+    async def _get_counters(self, cleaned_urls) -> list:
         """
         Получает № счётчиков для всех переданных URL
-        :param raw_urls: список URL-ов
+        :param cleaned_urls: очищенные URL
         :return:
         """
-        # домены из сырых URL
-        netlocs = map(lambda url: re.sub('www.', '', urlparse(url).netloc), raw_urls)
+        # домены очищенных URL
+        netlocs = {url_domain(cleaned_url) for cleaned_url in cleaned_urls}
+        counters = await counter_cache.get_many(netlocs)
+        return list({counter for counter in counters.values() if counter})
+
+    async def _request(self, session: ClientSession, parameters: dict, description: str) -> tuple:
+        """
+        Выполняет запрос к API Яндекс Метрики. Одинаковые одновременные запросы (счётчик, фильтры, даты)
+        объединяются в один запрос к API с общим результатом. Время общего запроса записывается в отчёт
+        каждого ожидающего его вызова, разрешение квоты запускает отсчёт времени URL каждого вызова
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса
+        :param description: описание запроса для логирования
+        :return: (data, accuracy, status, message) - см. _request_with_sampling
+        """
+        key = tuple(sorted((name, str(value)) for name, value in parameters.items() if name != 'accuracy'))
+        waiters = self.shared_waiters.setdefault(key, SharedRequestWaiters())
+        waiters.count += 1
+        start_clock, timings = url_clock.get(), current_timings.get()
+        if start_clock is not None:
+            waiters.clocks.add(start_clock)
+        if timings is not None:
+            waiters.timings.reports.add(timings)
+        # общий запрос получает класс вызова, создавшего его, но не пользователя (см. FairScheduler)
+        priority = (current_client.get() or (None, 'bulk'))[1]
+        try:
+            return await self.single_flight.do(
+                key, lambda: self._shared_request(session, dict(parameters), description, key, priority))
+        finally:
+            waiters.count -= 1
+            waiters.clocks.discard(start_clock)
+            waiters.timings.reports.discard(timings)
+            if not waiters.count:
+                del self.shared_waiters[key]
+
+    async def _shared_request(self, session: ClientSession, parameters: dict, description: str, key: tuple,
+                              priority: str) -> tuple:
+        """
+        Общий запрос single_flight: выполняется в пустом контексте, время запроса записывается в отчёты
+        ожидающих его вызовов
+        :param key: ключ запроса в single_flight
+        :param priority: класс запроса для FairScheduler
+        :return: (data, accuracy, status, message) - см. _request_with_sampling
+        """
+        current_client.set((None, priority))
+        current_timings.set(self.shared_waiters[key].timings)
+        return await self._request_with_sampling(session, parameters, description, key)
+
+    async def _request_with_sampling(self, session: ClientSession, parameters: dict, description: str,
+                                     key: tuple = None) -> tuple:
+        """
+        Выполняет запрос к API Яндекс Метрики с понижением точности (sampling) при каждой неудачной попытке.
+        Начальная точность выбирается по результатам предыдущих запросов к тому же счётчику за период такой же
+        длительности (accuracy_selector). При превышении квоты (429) запрос повторяется с той же точностью,
+        между повторами и после ошибок сервера выдерживается пауза (экспоненциальная со случайным разбросом)
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса (значение accuracy перезаписывается)
+        :param description: описание запроса для логирования
+        :param key: ключ запроса в single_flight
+        :return: (data, accuracy, status, message) - при успешном запросе status и message = None,
+        accuracy - точность, с которой получены данные
+        """
+        status = None
+        message = None
+        # количество выполненных http-запросов (попыток)
+        attempt = 0
+        counter = parameters.get('id', parameters.get('ids'))
+        start = self.accuracy_selector.start_level(counter, parameters['date1'], parameters['date2'])
+        # не более 4 попыток получить данные с яндекс метрики
+        for level in range(start, len(self.sampling)):
+            # понижение точности с каждой попыткой
+            acc = self.sampling[level]
+            parameters['accuracy'] = acc
+            for retry in range(self.throttle_retries + 1):
+                attempt += 1
+                status, body = await self._send(session, parameters, f'{description} ({parameters["date1"]} - '
+                                                                      f'{parameters["date2"]})', attempt, key)
+                if status != 429:
+                    break
+                logger.warning(f'Превышена квота API для {description}: {body.get("message") if body else None}')
+                await self._backoff(retry)
+            # если данные получены успешно
+            if status == 200:
+                self.accuracy_selector.record(counter, parameters['date1'], parameters['date2'], start, level)
+                return body.get('data'), acc, None, None
+            message = body.get('message') if body else None
+            logger.error(
+                f'Ошибка получения данных для {description}; Точность: {acc}; Попытка: {level - start + 1}; '
+                f'Ошибка: {status}:{message}')
+            # ошибка доступа не зависит от точности
+            if status in (401, 403):
+                break
+            if status >= 500:
+                await self._backoff(level - start)
+        self.accuracy_selector.record(counter, parameters['date1'], parameters['date2'], start, None)
+        return None, None, status, message
+
+    async def _backoff(self, retry: int):
+        """
+        Пауза перед повтором запроса: экспоненциально растущая верхняя граница со случайным значением паузы,
+        чтобы одновременно получившие ошибку запросы не повторялись одновременно
+        :param retry: № повтора, начиная с 0
+        :return: None
+        """
+        await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** retry)))
+
+    async def _send(self, session: ClientSession, parameters: dict, description: str,
+                    attempt: int, key: tuple = None) -> tuple[int, dict | None]:
+        """
+        Выполняет один http-запрос к API с разрешения quota_governor. Ответ 429 приостанавливает
+        запросы по использованному токену во всех процессах. Ошибки сервера, ошибки соединения и медленные
+        ответы учитываются circuit_breaker: при разомкнутом выключателе запрос сразу отклоняется
+        с ServiceUnavailableError, не ожидая квоты. Ответ не в формате JSON считается неуспешным (со статусом 502,
+        если статус ответа успешный). Время ожидания квоты и время запроса записываются в статистику отчёта
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса
+        :param description: описание запроса для статистики
+        :param attempt: № попытки запроса
+        :param key: ключ запроса в single_flight: после разрешения запроса запускается отсчёт времени
+        ожидающих его URL
+        :return: (http-статус, тело ответа)
+        """
+        self.circuit_breaker.check()
+        started = time.monotonic()
+        async with quota_governor.acquire() as token:
+            record_stage('ym_quota_wait', time.monotonic() - started)
+            waiters = self.shared_waiters.get(key)
+            for start_clock in list(waiters.clocks if waiters else ()):
+                start_clock()
+            started = time.monotonic()
+            with self.circuit_breaker.call() as call:
+                async with session.get(self.api_url, headers={'Authorization': token}, params=parameters) as response:
+                    raw_body = await response.read()
+                    status, retry_after = response.status, response.headers.get('Retry-After')
+                record_api_call(description, attempt, parameters['accuracy'], status, len(raw_body),
+                                time.monotonic() - started)
+                try:
+                    body = json.loads(raw_body) if raw_body else None
+                except ValueError:
+                    body = None
+                if raw_body and not isinstance(body, dict):
+                    # ответ не в формате JSON (например, страница ошибки прокси) - неуспешный запрос,
+                    # начало ответа передаётся в сообщении об ошибке
+                    text = raw_body[:200].decode(errors='replace')
+                    body = {'message': f'ответ API не в формате JSON (http {status}): {text}'}
+                    status = status if status >= 400 else 502
+                # 429 - ограничение квоты (см. quota_governor), остальные 4xx - ошибка запроса, а не сервиса
+                call.failed = status >= 500
+            if status == 429:
+                await quota_governor.throttle(token, float(retry_after) if retry_after and retry_after.isdigit()
+                                              else None)
+            return status, body
 
-        async with async_session_maker() as session:
-            smtm = select(DomainCounter.counter).where(DomainCounter.domain_name.in_(netlocs))
-            domain_counters_objects = await session.execute(smtm)
-            counters_dates = domain_counters_objects.scalars().all()
-        return counters_dates
+    def _prepare_dates(self, date1: str | None, date2: str | None) -> tuple[str, str]:
+        """
+        Приводит границы периода к допустимым значениям
+        :param date1: дата начала интервала (YYYY-MM-DD) или None
+        :param date2: дата окончания интервала (YYYY-MM-DD) или None
+        :return: (date1, date2)
+        """
+        # если дата начала периода < минимально установленого порога, берём дату установленного порога
+        if date1 is None or datetime.datetime.strptime(date1, '%Y-%m-%d').date() < self.min_date:
+            date1 = str(self.min_date)
+        if date2 is None:
+            date2 = str(datetime.date.today())
+        return date1, date2
 
-    def statistic_placeholder(self, stat: list, raw_url: str = None) -> statistic:
+    @staticmethod
+    def _raise_request_error(status: int, message: str):
+        """
+        Преобразует неуспешный ответ API Яндекс Метрики в BadRequestError
+        :param status: http-статус последней попытки
+        :param message: сообщение об ошибке от API
+        :return: None
+        """
+        if status == 400:
+            raise BadRequestError(
+                f'Не удалось получить данные от API Яндекс Метрики. \n\n error_message: {message}. '
+                f'\n\nВозможное решение: уменьшите период формирования статистики или попробуйте позднее.')
+        raise BadRequestError(
+            f'Не удалось получить данные от API Яндекс Метрики: {message}. Попробуйте повторить запрос позднее.')
+
+    def statistic_placeholder(self, stat: list, raw_url: str = None, approximate_users: bool = False) -> statistic:
         """
         Функция для заполнения именованного кортежа данными, с приведением их к определенному формату
         :param stat: список с данными
         :param raw_url:
+        :param approximate_users: количество посетителей приблизительное
         :return:
         """
         stat = statistic(
             raw_url=raw_url, visits=int(stat[0]), users=int(stat[1]), pageViews=int(stat[2]),
             pageDepth=round(float(stat[3]), 2), visitDuration=timedelta(seconds=round(stat[4])),
-            bounceRate=round(stat[5], 2), newUsers=round(stat[6], 2))
+            bounceRate=round(stat[5], 2), newUsers=round(stat[6], 2), approximateUsers=approximate_users)
         return stat
 
-    async def get_statistics(self, session: ClientSession, raw_url: str, cleaned_url: str, date1: str, date2: str):
+    @staticmethod
+    def failed_statistic(raw_url: str, error: str) -> statistic:
         """
-        Получает статистику по одному url. Извлекает из БД № счётчика для url -> форматирует даты для параметров
-        :param session:
+        Строка отчёта для URL, данные по которому получить не удалось
         :param raw_url:
-        :param cleaned_url:
+        :param error: описание ошибки
+        :return:
+        """
+        return statistic(raw_url=raw_url, error=error)
+
+    @staticmethod
+    def _url_filter(cleaned_url: str) -> str:
+        """
+        Фильтр визитов с просмотром URL. В API нет группировки по условию EXISTS, поэтому визиты с просмотром
+        нескольких URL не разделяются по URL в одном запросе: для каждого URL выполняется отдельный запрос
+        :param cleaned_url: очищенный URL
+        :return: filters
+        """
+        return f"EXISTS(ym:pv:URL=*'*{cleaned_url}*')"
+
+    async def _fetch(self, session: ClientSession, parameters: dict, description: str) -> tuple[list, str]:
+        """
+        Выполняет запрос к API, при неудаче выбрасывает BadRequestError
+        :return: (data, accuracy)
+        """
+        data, accuracy, status, message = await self._request_period(session, parameters, description)
+        if status is not None:
+            self._raise_request_error(status, message)
+        return data or [], accuracy
+
+    def _split_period(self, date1: str, date2: str, days: int) -> list[tuple[str, str]]:
+        """
+        Делит период на последовательные части не длиннее days дней
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :param days: максимальная длительность части
+        :return: список пар (date1, date2)
+        """
+        start = datetime.date.fromisoformat(date1)
+        end = datetime.date.fromisoformat(date2)
+        periods = []
+        while start <= end:
+            period_end = min(start + timedelta(days=days - 1), end)
+            periods.append((str(start), str(period_end)))
+            start = period_end + timedelta(days=1)
+        return periods
+
+    def _join_results(self, results: list[tuple]) -> tuple:
+        """
+        Объединяет результаты запросов за части периода: строки ответов складываются в один список,
+        точность - наименьшая из точностей частей
+        :param results: список (data, accuracy, status, message)
+        :return: (data, accuracy, status, message) - ошибка первой неудачной части, если она есть
+        """
+        data = []
+        accuracies = []
+        for rows, accuracy, status, message in results:
+            if status is not None:
+                return None, None, status, message
+            data.extend(rows or [])
+            accuracies.append(accuracy)
+        return data, max(accuracies, key=self.sampling.index), None, None
+
+    async def _request_period(self, session: ClientSession, parameters: dict, description: str) -> tuple:
+        """
+        Выполняет запрос за длинный период частями не длиннее max_period_days, части запрашиваются параллельно
+        (в пределах квоты API). Строки ответов за все части возвращаются одним списком: строки одной группировки
+        объединяются потребителем (_merge_parts) с пересчётом средних показателей с весом по визитам.
+        Посетители по частям периода не суммируются - см. _merge_parts, _request_users
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса (date1, date2 - весь период)
+        :param description: описание запроса для логирования
+        :return: (data, accuracy, status, message) - см. _request_with_sampling
+        """
+        periods = self._split_period(parameters['date1'], parameters['date2'], self.max_period_days)
+        if len(periods) == 1:
+            return await self._request_part(session, parameters, description)
+        results = await asyncio.gather(*(
+            self._request_part(session, {**parameters, 'date1': date1, 'date2': date2}, description)
+            for date1, date2 in periods))
+        return self._join_results(results)
+
+    async def _request_part(self, session: ClientSession, parameters: dict, description: str) -> tuple:
+        """
+        Выполняет запрос за часть периода. Если API не смогло обработать запрос (400) ни с одной точностью,
+        период делится пополам и половины запрашиваются по очереди
+        :return: (data, accuracy, status, message) - см. _request_with_sampling
+        """
+        result = await self._request(session, parameters, description)
+        date1 = datetime.date.fromisoformat(parameters['date1'])
+        date2 = datetime.date.fromisoformat(parameters['date2'])
+        if result[2] != 400 or (date2 - date1).days + 1 < 2 * self.min_period_days:
+            return result
+
+        middle = date1 + (date2 - date1) // 2
+        logger.info(f'Период {date1} - {date2} для {description} разделён на части по {middle}')
+        first = await self._request_part(session, {**parameters, 'date2': str(middle)}, description)
+        if first[2] is not None:
+            return first
+        second = await self._request_part(
+            session, {**parameters, 'date1': str(middle + timedelta(days=1))}, description)
+        return self._join_results([first, second])
+
+    async def _request_users(self, session: ClientSession, parameters: dict, description: str) -> tuple:
+        """
+        Запрашивает посетителей за весь период одним запросом, без деления периода на части: посетители,
+        просуммированные по частям периода, завышены (посетитель учитывается в каждой части, где у него есть визиты).
+        Если API не может обработать запрос с полной точностью, точность понижается (sampling)
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса за весь период (metrics заменяется на ym:s:users)
+        :param description: описание запроса для логирования
+        :return: (посетители, accuracy, status, message) - при неудаче посетители = None, см. _request_with_sampling
+        """
+        data, accuracy, status, message = await self._request(
+            session, {**parameters, 'metrics': 'ym:s:users'}, f'посетителей {description}')
+        if status is not None:
+            return None, None, status, message
+        return sum(row['metrics'][0] for row in data or []), accuracy, None, None
+
+    async def _merge_parts(self, session: ClientSession, parameters: dict, description: str, data: list,
+                           accuracy: str) -> tuple[list, str, bool]:
+        """
+        Объединяет строки ответа _request_period без группировок (по строке на часть периода) в одну строку.
+        Если период запрашивался частями, посетители запрашиваются за весь период одним запросом (_request_users);
+        если и это не удалось, используется сумма посетителей по частям, отмеченная как приблизительная
+        :param session: http-сессия aiohttp
+        :param parameters: параметры запроса за весь период
+        :param description: описание запроса для логирования
+        :param data: строки ответа
+        :param accuracy: точность, с которой получены строки
+        :return: (метрики в порядке self.metrics, точность, посетители приблизительные)
+        """
+        metrics = self._merge_rows([row['metrics'] for row in data])
+        if len(data) <= 1:
+            return metrics, accuracy, False
+        users, users_accuracy, status, message = await self._request_users(session, parameters, description)
+        if status is not None:
+            logger.warning(f'Не удалось получить посетителей {description} за весь период, использована сумма '
+                           f'по частям периода: {status}:{message}')
+            return metrics, accuracy, True
+        metrics[1] = users
+        return metrics, max([accuracy, users_accuracy], key=self.sampling.index), False
+
+    async def _get_url_metrics(self, session: ClientSession, counter_id: int, cleaned_url: str,
+                               date1: str, date2: str) -> tuple[list, str, bool]:
+        """
+        Получает метрики по URL за период. Для периодов, включающих сегодняшний день и запрашиваемых частями
+        (длиннее max_period_days), используется хранилище метрик по дням: запрашиваются только недостающие дни.
+        Период короче запрашивается одним запросом - это дешевле двух запросов (по дням и посетителей)
+        :param session:
+        :param counter_id: № счётчика
+        :param cleaned_url: очищенный URL
         :param date1:
         :param date2:
-        :return:
+        :return: (метрики в порядке self.metrics, точность полученных данных, посетители приблизительные)
         """
+        start, end = datetime.date.fromisoformat(date1), datetime.date.fromisoformat(date2)
+        if end >= datetime.date.today() and (end - start).days + 1 > self.max_period_days:
+            return await self._get_incremental_metrics(session, counter_id, cleaned_url, date1, date2)
 
-        counter_id = await self._get_counter(raw_url)
+        parameters = {
+            'id': counter_id,
+            'metrics': self.metrics,
+            'filters': self._url_filter(cleaned_url),
+            'date1': date1,
+            'date2': date2,
+            'accuracy': 'full'
+        }
+        data, accuracy = await self._fetch(session, parameters, f'URL: {cleaned_url}')
+        return await self._merge_parts(session, parameters, f'URL: {cleaned_url}', data, accuracy)
 
-        # если дата начала периода < минимально установленого порога, берём дату установленного порога
-        if date1 is None or datetime.datetime.strptime(date1, '%Y-%m-%d').date() < self.min_date:
-            date1 = str(self.min_date)
-        if date2 is None:
-            date2 = str(datetime.date.today())
+    async def _get_incremental_metrics(self, session: ClientSession, counter_id: int, cleaned_url: str,
+                                       date1: str, date2: str) -> tuple[list, str, bool]:
+        """
+        Получает метрики по URL за период с использованием хранилища метрик по дням.
+        Аддитивные метрики (визиты, просмотры, время, отказы, новые визиты) запрашиваются с группировкой по дням
+        только за отсутствующие в хранилище дни URL (непрерывными диапазонами) и суммируются локально.
+        Посетители не суммируются по дням и запрашиваются за весь период отдельным запросом (_request_users)
+        при каждом обновлении данных, т.е. не чаще раза в stat_cache.ttl секунд для URL и периода
+        :return: (метрики в порядке self.metrics, точность полученных данных, посетители приблизительные)
+        """
+        start = datetime.date.fromisoformat(date1)
+        end = datetime.date.fromisoformat(date2)
+        # в хранилище попадают только завершившиеся дни
+        last_closed_day = min(end, datetime.date.today() - timedelta(days=1))
+        closed_days = [start + timedelta(days=i) for i in range((last_closed_day - start).days + 1)]
+
+        days = (await daily_store.get_days(counter_id, (cleaned_url,), start, last_closed_day))[cleaned_url]
+        # текущий день в хранилище не попадает и запрашивается всегда
+        missing_days = [day for day in closed_days if day not in days] + [
+            last_closed_day + timedelta(days=i) for i in range(1, (end - last_closed_day).days + 1)]
+        missing_ranges = []
+        for day in missing_days:
+            if missing_ranges and missing_ranges[-1][1] == day - timedelta(days=1):
+                missing_ranges[-1][1] = day
+            else:
+                missing_ranges.append([day, day])
+
+        filters = self._url_filter(cleaned_url)
+        parameters = {
+            'id': counter_id,
+            'metrics': self.additive_metrics,
+            'dimensions': 'ym:s:date',
+            'filters': filters,
+            'limit': self.max_rows,
+            'accuracy': 'full'
+        }
+        results = await asyncio.gather(*(
+            self._fetch(session, {**parameters, 'date1': str(range_start), 'date2': str(range_end)},
+                        f'URL по дням: {cleaned_url}') for range_start, range_end in missing_ranges))
+        accuracies = [accuracy for _, accuracy in results]
+        # дни без визитов в ответ API не попадают
+        fetched_days = {day: [0] * 5 for day in missing_days}
+        for row in (row for data, _ in results for row in data):
+            day = datetime.date.fromisoformat(row['dimensions'][0]['name'])
+            visits, page_views, duration, bounce_rate, new_visitors = row['metrics']
+            day_metrics = fetched_days.setdefault(day, [0] * 5)
+            for i, value in enumerate((visits, page_views, visits * duration, visits * bounce_rate / 100,
+                                       visits * new_visitors / 100)):
+                day_metrics[i] += value
+
+        # данные, полученные с пониженной точностью, не сохраняются
+        if all(accuracy == 'full' for accuracy in accuracies):
+            await daily_store.save_days(counter_id, {
+                cleaned_url: {day: metrics for day, metrics in fetched_days.items() if day <= last_closed_day}})
+        days.update(fetched_days)
 
         parameters = {
             'id': counter_id,
-            'metrics': 'ym:s:visits,ym:s:users,ym:s:pageviews,ym:s:pageDepth,ym:s:avgVisitDurationSeconds,ym:s:bounceRate,ym:s:percentNewVisitors',
-            'filters': f"EXISTS(ym:pv:URL=*'*{cleaned_url}*')",
+            'metrics': 'ym:s:users',
+            'filters': filters,
             'date1': date1,
             'date2': date2,
             'accuracy': 'full'
         }
+        users, accuracy, status, message = await self._request_users(session, parameters, f'URL: {cleaned_url}')
+        approximate = False
+        if status == 400:
+            # посетители за весь период не получены ни с одной точностью - сумма по частям периода
+            data, accuracy = await self._fetch(session, parameters, f'посетителей URL: {cleaned_url}')
+            users = sum(row['metrics'][0] for row in data)
+            approximate = len(data) > 1
+        elif status is not None:
+            self._raise_request_error(status, message)
+        accuracies.append(accuracy)
+
+        visits, page_views, duration, bounces, new_visits = (sum(values) for values in zip([0] * 5, *days.values()))
+        # итоговая точность - наименьшая из точностей запросов
+        accuracy = max(accuracies, key=self.sampling.index)
+        if not visits:
+            return [0, users, page_views, 0, 0, 0, 0], accuracy, approximate
+        return [visits, users, page_views, page_views / visits, duration / visits, bounces / visits * 100,
+                new_visits / visits * 100], accuracy, approximate
+
+    async def _fetch_url_metrics(self, session: ClientSession, counter_id: int, cleaned_url: str,
+                                 date1: str, date2: str) -> tuple[list, bool]:
+        """
+        Получает метрики по URL из API и сохраняет их в кэш (кроме данных с приблизительным количеством
+        посетителей). Если API недоступно (ServiceUnavailableError), возвращаются данные из кэша с любой точностью,
+        в том числе устаревшие, - при их наличии. Если данные не получены за url_timeout секунд после разрешения
+        quota_governor на первый запрос по URL, выбрасывается TimeoutError
+        :return: (метрики в порядке self.metrics, посетители приблизительные)
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async with asyncio.timeout(None) as timeout:
 
-        async with self.semaphore:
-            status = None
-            message = None
-            # 4 попытки получить данные с яндекс метрики
-            for _ in range(4):
-                acc = self.sampling[_]
-                # понижение точности с каждой попыткой
-                parameters['accuracy'] = acc
-                async with session.get(self.api_url, headers=self.headers, params=parameters) as response:
-                    # если данные получены успешно
-                    if response.status == 200:
-                        stat = await response.json()
-                        stat = stat.get('data')
-                        status = None
-                        message = None
+                def start_clock():
+                    if timeout.when() is None:
+                        timeout.reschedule(loop.time() + self.url_timeout)
+
+                token = url_clock.set(start_clock)
+                try:
+                    metrics, accuracy, approximate = await self._get_url_metrics(
+                        session, counter_id, cleaned_url, date1, date2)
+                finally:
+                    url_clock.reset(token)
+        except ServiceUnavailableError:
+            cached = await stat_cache.get_many(counter_id, (cleaned_url,), date1, date2, stale=True)
+            if cleaned_url not in cached:
+                raise
+            logger.warning(f'API недоступно, для URL {cleaned_url} использованы данные из кэша')
+            return cached[cleaned_url], False
+        if not approximate:
+            await stat_cache.set_many(counter_id, {cleaned_url: metrics}, date1, date2, accuracy)
+        return metrics, approximate
+
+    @staticmethod
+    def _merge_rows(rows: list[list]) -> list:
+        """
+        Объединяет метрики нескольких строк группировки в одну строку.
+        Визиты, посетители и просмотры суммируются, средние показатели пересчитываются с весом по визитам.
+        Посетители, суммированные по частям периода, завышены - см. _merge_parts
+        :param rows: списки метрик в порядке self.metrics
+        :return: список метрик в порядке self.metrics
+        """
+        visits = sum(row[0] for row in rows)
+        users = sum(row[1] for row in rows)
+        page_views = sum(row[2] for row in rows)
+        if not visits:
+            return [0, users, page_views, 0, 0, 0, 0]
+        page_depth = page_views / visits
+        visit_duration = sum(row[0] * row[4] for row in rows) / visits
+        bounce_rate = sum(row[0] * row[5] for row in rows) / visits
+        new_users = sum(row[0] * row[6] for row in rows) / visits
+        return [visits, users, page_views, page_depth, visit_duration, bounce_rate, new_users]
+
+    def _start_accuracy(self, counter_id: int, date1: str, date2: str) -> str:
+        """
+        Точность, с которой начнётся запрос по URL счётчика за период (см. accuracy_selector): данные из кэша
+        с такой или более высокой точностью не хуже данных, которые вернёт новый запрос
+        :param counter_id: № счётчика
+        :param date1: дата начала интервала (YYYY-MM-DD)
+        :param date2: дата окончания интервала (YYYY-MM-DD)
+        :return: уровень точности
+        """
+        # длинный период запрашивается частями - точность данных определяет наименее точная часть
+        periods = [(date1, date2)] + self._split_period(date1, date2, self.max_period_days)
+        return self.sampling[max(self.accuracy_selector.start_level(counter_id, period1, period2)
+                                 for period1, period2 in periods)]
+
+    @staticmethod
+    def _error_text(err: Exception) -> str:
+        """
+        Описание ошибки получения данных для строки отчёта
+        :param err: исключение
+        :return: описание ошибки
+        """
+        if isinstance(err, asyncio.TimeoutError):
+            return 'превышено время ожидания ответа Яндекс Метрики'
+        # сообщение для пользователя может быть многострочным - в отчёт попадает первая строка
+        return str(err).strip().split('\n')[0][:200]
+
+    async def _get_counter_statistics(self, session: ClientSession, counter_id: int, urls: list[tuple[str, str]],
+                                      date1: str, date2: str) -> dict[str, statistic]:
+        """
+        Получает статистику по URL одного счётчика: данные из кэша, по остальным URL - параллельно
+        по одному запросу на URL. Ошибка запроса по одному URL не прерывает получение остальных:
+        такой URL помечается как неудачный
+        :param session:
+        :param counter_id: № счётчика
+        :param urls: список пар (raw_url, cleaned_url)
+        :param date1:
+        :param date2:
+        :return: {raw_url: statistic}
+        """
+        cleaned_urls = {cleaned_url for _, cleaned_url in urls}
+        url_metrics = await stat_cache.get_many(counter_id, cleaned_urls, date1, date2,
+                                                self._start_accuracy(counter_id, date1, date2))
+        # URL, которых нет в кэше
+        missing_urls = sorted(cleaned_urls - url_metrics.keys())
+
+        results = await asyncio.gather(*(
+            self._fetch_url_metrics(session, counter_id, cleaned_url, date1, date2) for cleaned_url in missing_urls),
+            return_exceptions=True)
+        errors = {}
+        approximate_urls = set()
+        for cleaned_url, result in zip(missing_urls, results):
+            if isinstance(result, (BadRequestError, ClientError, asyncio.TimeoutError)):
+                errors[cleaned_url] = self._error_text(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                url_metrics[cleaned_url], approximate = result
+                if approximate:
+                    approximate_urls.add(cleaned_url)
+        if errors:
+            logger.warning(f'Не удалось получить статистику счётчика {counter_id} для {len(errors)} URL: '
+                           f'{next(iter(errors.values()))}')
+
+        return {raw_url: self.failed_statistic(raw_url, errors[cleaned_url]) if cleaned_url in errors
+                else self.statistic_placeholder(url_metrics[cleaned_url], raw_url, cleaned_url in approximate_urls)
+                for raw_url, cleaned_url in urls}
+
+    def _split_by_counter(self, raw_processed_urls: dict, url_counters: dict) -> list[tuple[int, list]]:
+        """
+        Группирует URL по счётчикам, каждая группа разбивается на части не более batch_size URL
+        :param raw_processed_urls: {raw_url: cleaned_url}
+        :param url_counters: {raw_url: № счётчика}
+        :return: список пар (№ счётчика, [(raw_url, cleaned_url), ...])
+        """
+        counter_urls = {}
+        for raw_url, cleaned_url in raw_processed_urls.items():
+            counter_urls.setdefault(url_counters[raw_url], []).append((raw_url, cleaned_url))
+        chunks = []
+        for counter_id, urls in counter_urls.items():
+            for i in range(0, len(urls), self.batch_size):
+                chunks.append((counter_id, urls[i:i + self.batch_size]))
+        return chunks
+
+    async def _get_chunk_statistics(self, session: ClientSession, counter_id: int, urls: list[tuple[str, str]],
+                                    date1: str, date2: str) -> dict[str, statistic]:
+        """
+        Получает статистику по части URL одного счётчика (время ожидания ограничено для каждого URL,
+        см. _fetch_url_metrics). Ошибка запроса не прерывает формирование отчёта: URL помечаются как неудачные
+        :return: {raw_url: statistic}
+        """
+        try:
+            return await self._get_counter_statistics(session, counter_id, urls, date1, date2)
+        except (BadRequestError, ClientError) as err:
+            error = self._error_text(err)
+        logger.warning(f'Не удалось получить статистику счётчика {counter_id} для {len(urls)} URL: {error}')
+        return {raw_url: self.failed_statistic(raw_url, error) for raw_url, _ in urls}
+
+    async def iter_statistics_batch(self, session: ClientSession, raw_processed_urls: dict, date1: str, date2: str):
+        """
+        Потоковое получение статистики: части URL одного счётчика обрабатываются не более чем в stream_workers
+        потоков, результаты отдаются по мере завершения частей (в порядке завершения, а не в порядке URL).
+        URL, по которым данные получить не удалось (нет счётчика, ошибка API, превышено время ожидания),
+        возвращаются как failed_statistic
+        :param session:
+        :param raw_processed_urls: {raw_url: cleaned_url}
+        :param date1:
+        :param date2:
+        :return: асинхронный генератор словарей {raw_url: statistic} (по одному на часть URL)
+        """
+        date1, date2 = self._prepare_dates(date1, date2)
+        with timing_stage('counters'):
+            url_counters = await self._get_url_counters(raw_processed_urls, strict=False)
+        unknown_urls = [raw_url for raw_url in raw_processed_urls if raw_url not in url_counters]
+        if unknown_urls:
+            yield {raw_url: self.failed_statistic(raw_url, 'не найден счётчик Яндекс Метрики для домена')
+                   for raw_url in unknown_urls}
+        chunks = iter(self._split_by_counter(
+            {raw_url: cleaned_url for raw_url, cleaned_url in raw_processed_urls.items() if raw_url in url_counters},
+            url_counters))
+
+        pending = set()
+        try:
+            while True:
+                # поддерживаем не более stream_workers одновременно обрабатываемых частей
+                while len(pending) < self.stream_workers:
+                    chunk = next(chunks, None)
+                    if chunk is None:
                         break
-                    status = response.status
-                    error = await response.json()
-                    message = error.get('message')
-                    logger.error(
-                        f'Ошибка получения данных для URL: {raw_url}; Точность: {acc}; Попытка: {_ + 1}; Ошибка: {status}:{message}')
-            if status == 400:
-                raise BadRequestError(
-                    f'Не удалось получить данные от API Яндекс Метрики. \n\n error_message: {message}. '
-                    f'\n\nВозможное решение: уменьшите период формирования статистики или попробуйте позднее.')
-            elif status == 429:
-                raise BadRequestError(
-                    f'Не удалось получить данные от API Яндекс Метрики: {message}. Попробуйте повторить запрос позднее.')
-        if stat:
-            # т.к группировки не используются всегда берём первый элемент из data
-            stat = stat[0]['metrics']
-            # передаём статистику для заполнения namedtuple
-            stat = self.statistic_placeholder(stat, raw_url)
-        else:
-            # иначе берем namedtuple по-умолчанию
-            stat = statistic(raw_url=raw_url)
-        return stat
+                    counter_id, urls = chunk
+                    pending.add(asyncio.create_task(
+                        self._get_chunk_statistics(session, counter_id, urls, date1, date2)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
-    async def get_sum_statistics(self, raw_urls: dict_keys, cleaned_urls: dict_values, date1: str, date2: str) -> statistic:
+    async def get_sum_statistics(self, session: ClientSession, raw_urls: dict_keys, cleaned_urls: dict_values,
+                                 date1: str, date2: str) -> statistic:
         """
         Метод для получения итоговой суммы статистики для всех полученных URL
+        :param session:
         :param raw_urls:
         :param cleaned_urls:
         :param date1:
         :param date2:
         :return:
         """
-        counters = await self._get_counters(raw_urls)
-        counter_ids = ','.join(counters)
-        if date1 is None or datetime.datetime.strptime(date1, '%Y-%m-%d').date() < self.min_date:
-            date1 = str(self.min_date)
-        if date2 is None:
-            date2 = str(datetime.date.today())
+        with timing_stage('counters'):
+            counters = await self._get_counters(cleaned_urls)
+        counter_ids = ','.join(map(str, counters))
+        date1, date2 = self._prepare_dates(date1, date2)
         filters = ' OR '.join([f"EXISTS(ym:pv:URL=*'*{cleaned_url}*')" for cleaned_url in cleaned_urls])
         parameters = {
             'ids': counter_ids,
-            'metrics': 'ym:s:visits,ym:s:users,ym:s:pageviews,ym:s:pageDepth,ym:s:avgVisitDurationSeconds,ym:s:bounceRate,ym:s:percentNewVisitors',
+            'metrics': self.metrics,
             'filters': filters,
             'date1': date1,
             'date2': date2,
             'accuracy': 'full'
         }
-        message = None
-        # 4 попытки получить данные с яндекс метрики
-        for _ in range(4):
-            # понижение точности с каждой попыткой
-            acc = self.sampling[_]
-            parameters['accuracy'] = acc
-            stat = requests.get(self.api_url, headers=self.headers, params=parameters)
-            if stat.status_code == 200:
-                stat = stat.json().get('data')
-                if stat:
-                    # т.к группировки не используются всегда берём первый элемент из data
-                    stat = stat[0]['metrics']
-                    # передаём статистику для заполнения namedtuple
-                    stat = self.statistic_placeholder(stat)
-                else:
-                    # иначе берем namedtuple по-умолчанию
-                    stat = statistic()
-                return stat
-            message = stat.json().get('message')
-            logger.error(
-                f'Ошибка получения суммы данных точность: {acc}; Попытка: {_ + 1}; Ошибка: {message}')
+        stat, accuracy, status, message = await self._request_period(session, parameters, 'суммы данных')
+        if status is None:
+            if stat:
+                # группировки не используются: в data по одной строке на каждую часть периода
+                stat, _, approximate = await self._merge_parts(session, parameters, 'суммы данных', stat, accuracy)
+                # передаём статистику для заполнения namedtuple
+                stat = self.statistic_placeholder(stat, approximate_users=approximate)
+            else:
+                # иначе берем namedtuple по-умолчанию
+                stat = statistic()
+            return stat
 
-        if 'Quota exceeded for quantity of parallel user requests' in message:
+        if 'Quota exceeded for quantity of parallel user requests' in (message or ''):
             raise BadRequestError(
                 f'Не удалось получить итоговые данные от Яндекс Метрики.' \
                 f'\n\nerror_message: {message}' \